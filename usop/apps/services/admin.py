@@ -1,3 +1,47 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import LifecycleEvent, Node, Service, ServiceBackup, ServiceOperation
+from usop.apps.users.permissions import filter_for_user
+
+
+@admin.register(Service)
+class ServiceAdmin(admin.ModelAdmin):
+    list_display = ["name", "org", "region", "status", "template_sku", "template_version", "created"]
+    list_filter = ["status", "region"]
+    search_fields = ["name", "extid", "pid"]
+    ordering = ["name"]
+
+    def get_queryset(self, request):
+        return filter_for_user(super().get_queryset(request).with_deployment_context(), request.user)
+
+
+@admin.register(LifecycleEvent)
+class LifecycleEventAdmin(admin.ModelAdmin):
+    list_display = ["created", "model", "object_id", "label", "event_type", "source", "target", "operation", "count"]
+    list_filter = ["event_type", "model", "operation"]
+    search_fields = ["label"]
+    list_select_related = ["org"]
+
+
+@admin.register(Node)
+class NodeAdmin(admin.ModelAdmin):
+    list_display = ["name", "region", "cpu_capacity", "memory_capacity", "disabled"]
+    list_filter = ["region", "disabled"]
+    search_fields = ["name"]
+    list_select_related = ["region"]
+
+
+@admin.register(ServiceOperation)
+class ServiceOperationAdmin(admin.ModelAdmin):
+    list_display = ["created", "service", "operation", "status", "requests", "started", "finished"]
+    list_filter = ["status", "operation"]
+    search_fields = ["service__name", "task_id"]
+    list_select_related = ["service"]
+
+
+@admin.register(ServiceBackup)
+class ServiceBackupAdmin(admin.ModelAdmin):
+    list_display = ["created", "service", "status", "files", "size", "stored_size", "new_chunks", "chunks", "finished"]
+    list_filter = ["status"]
+    search_fields = ["service__name", "key"]
+    list_select_related = ["service"]
@@ -1,11 +1,287 @@
+import bisect
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import TextChoices
+from django.utils.translation import gettext_lazy as _
+
+
+class PlacementPolicy(TextChoices):
+    NONE = 'NONE', _('None')
+    """ Services are not pinned to nodes, the cluster scheduler places them """
+
+    BINPACK = 'BINPACK', _('Bin packing')
+    """ Services go to the fullest node they fit in, leaving whole nodes free """
+
+    SPREAD = 'SPREAD', _('Spread')
+    """ Services go to the emptiest node, balancing load across nodes """
+
+
+CPU_UNITS = {"n": 10 ** -6, "u": 10 ** -3, "m": 1, "": 1000}
+MEMORY_UNITS = {
+    "": 1, "k": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9, "T": 10 ** 12,
+    "Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40,
+}
+QUANTITY = re.compile(r"^([0-9.]+)([a-zA-Z]*)$")
+
+
+def parse_quantity(value, units) -> int:
+    """ Parse a kubernetes quantity, ex: 500m or 2Gi, into millicores or bytes """
+    match = QUANTITY.match(str(value).strip())
+    if not match or match.group(2) not in units:
+        raise ValueError(f"Invalid resource quantity: {value}")
+    return int(float(match.group(1)) * units[match.group(2)])
+
+
+def service_requests(service) -> Tuple[int, int]:
+    """ CPU millicores and memory bytes requested by a service, from resources.requests of its helm values """
+    from .values import values_resolver
+    requests = values_resolver.resolve(service).get("resources", {}).get("requests", {})
+    cpu = requests.get("cpu", settings.NODE_DEFAULT_CPU_REQUEST)
+    memory = requests.get("memory", settings.NODE_DEFAULT_MEMORY_REQUEST)
+    return parse_quantity(cpu, CPU_UNITS), parse_quantity(memory, MEMORY_UNITS)
+
 
 class NodeAllocator(object):
 
     def allocate(self, service) -> str:
         raise NotImplementedError
-    
-    
-    
-class DefaultNodeAllocator():
+
+    def allocate_many(self, services) -> Dict[int, str]:
+        """ Place many services in one pass, returns the node of every service id """
+        return {service.pk: self.allocate(service) for service in services}
+
+    def release(self, service):
+        """ Free the resources committed by a service """
+        pass
+
+
+class DefaultNodeAllocator(NodeAllocator):
     def allocate(self, service) -> str:
-        return "localhost"
\ No newline at end of file
+        return "localhost"
+
+
+class SortedBuckets:
+    """
+        Sorted list split in buckets of bounded size, so adding and removing an item costs
+        a binary search and a shift of one bucket instead of a shift of the whole list.
+    """
+
+    load = 64
+
+    def __init__(self, items: Iterable = ()):
+        items = sorted(items)
+        self._buckets: List[list] = [items[start:start + self.load] for start in range(0, len(items), self.load)]
+        self._maxes: list = [bucket[-1] for bucket in self._buckets]
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets)
+
+    def __iter__(self):
+        for bucket in self._buckets:
+            yield from bucket
+
+    def __reversed__(self):
+        for bucket in reversed(self._buckets):
+            yield from reversed(bucket)
+
+    def add(self, item):
+        if not self._buckets:
+            self._buckets.append([item])
+            self._maxes.append(item)
+            return
+        position = min(bisect.bisect_left(self._maxes, item), len(self._maxes) - 1)
+        bucket = self._buckets[position]
+        bisect.insort(bucket, item)
+        self._maxes[position] = bucket[-1]
+        if len(bucket) > 2 * self.load:
+            self._buckets[position:position + 1] = [bucket[:self.load], bucket[self.load:]]
+            self._maxes[position:position + 1] = [bucket[self.load - 1], bucket[-1]]
+
+    def remove(self, item):
+        position = bisect.bisect_left(self._maxes, item)
+        bucket = self._buckets[position]
+        del bucket[bisect.bisect_left(bucket, item)]
+        if bucket:
+            self._maxes[position] = bucket[-1]
+        else:
+            del self._buckets[position]
+            del self._maxes[position]
+
+    def from_item(self, item) -> Iterable:
+        """ Items greater or equal than the given one, in ascending order """
+        position = bisect.bisect_left(self._maxes, item)
+        if position == len(self._buckets):
+            return
+        bucket = self._buckets[position]
+        yield from bucket[bisect.bisect_left(bucket, item):]
+        for bucket in self._buckets[position + 1:]:
+            yield from bucket
+
+
+class PlacementIndex:
+    """
+        In-memory index of the free capacity of the nodes of a region.
+        Nodes are kept sorted by free CPU, so finding a node is a binary search
+        followed by a check of the free memory of the candidates.
+    """
+
+    def __init__(self, capacity: Dict[str, Tuple[int, int]], policy: str):
+        self.policy = policy
+        self._free: Dict[str, List[int]] = {name: [cpu, memory] for name, (cpu, memory) in capacity.items()}
+        self._order = SortedBuckets((cpu, name) for name, (cpu, _) in self._free.items())
+
+    def _candidates(self, cpu: int) -> Iterable[str]:
+        if self.policy == PlacementPolicy.SPREAD:
+            for free_cpu, name in reversed(self._order):
+                if free_cpu < cpu:
+                    return
+                yield name
+        else:
+            for _, name in self._order.from_item((cpu, "")):
+                yield name
+
+    def find(self, cpu: int, memory: int) -> Optional[str]:
+        """ Name of the node a service with these requests should go to, None if no node fits """
+        for name in self._candidates(cpu):
+            if self._free[name][1] >= memory:
+                return name
+        return None
+
+    def free(self, name: str) -> Optional[Tuple[int, int]]:
+        """ Free CPU and memory of a node, None for unknown nodes """
+        free = self._free.get(name)
+        return tuple(free) if free else None
+
+    def _move(self, name: str, cpu: int, memory: int):
+        if name not in self._free:
+            return
+        free = self._free[name]
+        self._order.remove((free[0], name))
+        free[0] += cpu
+        free[1] += memory
+        self._order.add((free[0], name))
+
+    def commit(self, name: str, cpu: int, memory: int):
+        self._move(name, -cpu, -memory)
+
+    def release(self, name: str, cpu: int, memory: int):
+        self._move(name, cpu, memory)
+
+
+class CapacityNodeAllocator(NodeAllocator):
+    """
+        Places the services of a region on its nodes according to the placement policy of the region.
+        The index is built from the Node capacity model and the services already placed, then updated
+        incrementally on every placement and release. It is rebuilt after NODE_INDEX_TTL seconds to pick
+        up placements made by other processes.
+    """
+
+    _allocators: Dict[int, "CapacityNodeAllocator"] = {}
+    _allocators_lock = threading.Lock()
+
+    def __init__(self, region):
+        self.region = region
+        self.policy = region.placement_policy
+        self._index: Optional[PlacementIndex] = None
+        self._nodes = {}
+        self._built = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_region(cls, region) -> "CapacityNodeAllocator":
+        """ Process wide allocator of a region """
+        with cls._allocators_lock:
+            allocator = cls._allocators.get(region.pk)
+            if allocator is None or allocator.policy != region.placement_policy:
+                allocator = cls._allocators[region.pk] = cls(region)
+            return allocator
+
+    def _build(self) -> PlacementIndex:
+        from .models import Node, Service
+        from .status import ServiceStatus
+        self._nodes = {node.name: node for node in Node.objects.filter(region=self.region, disabled=False)}
+        capacity = {node.name: (node.cpu_capacity, node.memory_capacity) for node in self._nodes.values()}
+        index = PlacementIndex(capacity, self.policy)
+        placed = (
+            Service.objects
+            .with_deployment_context()
+            .select_related("node")
+            .filter(region=self.region, node__isnull=False)
+            .exclude(status__in=[ServiceStatus.NEW, ServiceStatus.STOPPED, ServiceStatus.DESTROYED])
+        )
+        for service in placed.iterator(chunk_size=1000):
+            index.commit(service.node.name, *service_requests(service))
+        return index
+
+    def _get_index(self) -> PlacementIndex:
+        if self._index is None or time.monotonic() - self._built > settings.NODE_INDEX_TTL:
+            self._index = self._build()
+            self._built = time.monotonic()
+        return self._index
+
+    def _place(self, index: PlacementIndex, service, requests: Tuple[int, int]) -> str:
+        name = index.find(*requests)
+        if name is None:
+            raise Exception(_("No node in region %(region)s has capacity for service %(service)s") % {
+                "region": self.region, "service": service})
+        index.commit(name, *requests)
+        service.node = self._nodes[name]
+        return name
+
+    def allocate(self, service) -> str:
+        """ Place a service, unless another process placed it first, then its node is kept """
+        from .models import Service
+        requests = service_requests(service)
+        with self._lock:
+            index = self._get_index()
+            name = self._place(index, service, requests)
+            if Service.objects.filter(pk=service.pk, node__isnull=True).update(node=service.node):
+                return name
+            index.release(name, *requests)
+            service.node = Service.objects.select_related("node").get(pk=service.pk).node
+            index.commit(service.node.name, *requests)
+        return service.node.name
+
+    def allocate_many(self, services) -> Dict[int, str]:
+        """
+            Place the largest services first, which packs nodes tighter, and store the placements with one update
+            per node. Services placed meanwhile by other processes keep their node, services that fit in no node
+            are left out, their own transition reports the error.
+        """
+        from .models import Service
+        requests = {service.pk: service_requests(service) for service in services if service.node_id is None}
+        services = sorted((s for s in services if s.pk in requests), key=lambda s: requests[s.pk], reverse=True)
+        placements = {}
+        by_node = defaultdict(list)
+        with self._lock, transaction.atomic():
+            pending = set(
+                Service.objects.select_for_update().filter(pk__in=requests, node__isnull=True)
+                .values_list("pk", flat=True))
+            index = self._get_index()
+            for service in services:
+                if service.pk not in pending:
+                    continue
+                try:
+                    placements[service.pk] = self._place(index, service, requests[service.pk])
+                except Exception:
+                    continue
+                by_node[service.node].append(service.pk)
+            for node, ids in by_node.items():
+                Service.objects.filter(pk__in=ids).update(node=node)
+        return placements
+
+    def release(self, service):
+        from .models import Service
+        if service.node_id is None:
+            return
+        with self._lock:
+            if self._index is not None:
+                self._index.release(service.node.name, *service_requests(service))
+        service.node = None
+        Service.objects.filter(pk=service.pk).update(node=None)
@@ -5,7 +5,13 @@ from django.apps import AppConfig
 class ServicesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'usop.apps.services'
-    
+
     def ready(self):
+        import usop.apps.services.checks
         import usop.apps.services.signals
+        from usop.lib.CachedClassUtil import CachedClassUtil
+        from .registry import controller_registry
+        # Resolve the configured controllers now, so the first request doesn't pay for it
+        controller_registry.build()
+        CachedClassUtil.warm([], instance_paths=[settings.BILLING_CONTROLLER])
         return super().ready()
@@ -0,0 +1,292 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tarfile
+import tempfile
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Set
+
+from django.conf import settings
+from django.utils import timezone
+
+from usop.lib.CachedClassUtil import CachedClassUtil
+
+from .interfaces import IObjectStore
+from .models import ServiceBackup
+from .status import OperationStatus
+
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST_VERSION = 1
+
+RESTORE_MARKER = ".usop-restore-complete"
+""" Empty file ending the archive of a restore, its absence tells the volume the stream was cut short """
+
+
+def chunk_key(digest: str) -> str:
+    return f"chunks/{digest[:2]}/{digest}"
+
+
+class LocalObjectStore(IObjectStore):
+    """ Object store on a local or mounted filesystem, objects are written to a temporary file and renamed """
+
+    def __init__(self, root: Optional[str] = None):
+        self.root = root or settings.BACKUP_STORE_ROOT or os.path.join(tempfile.gettempdir(), "usop-backups")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+def get_object_store() -> IObjectStore:
+    """ Process wide backup store, the class is set in BACKUP_STORE """
+    return CachedClassUtil.get_instance(settings.BACKUP_STORE)
+
+
+class ChunkUploader:
+    """
+        Compresses and uploads the chunks of a backup from a pool of threads. Chunks referenced by the previous
+        backup of the service, or found in the store, are not uploaded again. At most twice the number of threads
+        chunks are held in memory, the reader waits for the uploads when it gets ahead of them.
+    """
+
+    def __init__(self, store: IObjectStore, known: Set[str], concurrency: int):
+        self.store = store
+        self.known = set(known)
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="usop-backup")
+        self.slots = threading.BoundedSemaphore(concurrency * 2)
+        self.futures: List[Future] = []
+        self.lock = threading.Lock()
+        self.new_chunks = 0
+        self.stored_size = 0
+
+    def _upload(self, digest: str, data: bytes):
+        try:
+            key = chunk_key(digest)
+            if self.store.exists(key):
+                return
+            compressed = zlib.compress(data, settings.BACKUP_COMPRESSION_LEVEL)
+            self.store.put(key, compressed)
+            with self.lock:
+                self.new_chunks += 1
+                self.stored_size += len(compressed)
+        finally:
+            self.slots.release()
+
+    def add(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self.known:
+            self.known.add(digest)
+            self.slots.acquire()
+            self.futures.append(self.pool.submit(self._upload, digest, data))
+        return digest
+
+    def close(self):
+        """ Wait for the uploads, raising the first error """
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+def member_entry(member: tarfile.TarInfo) -> Dict:
+    return {
+        "name": member.name, "type": member.type.decode(), "mode": member.mode, "mtime": member.mtime,
+        "uid": member.uid, "gid": member.gid, "uname": member.uname, "gname": member.gname,
+        "linkname": member.linkname, "size": member.size if member.isfile() else 0, "chunks": [],
+    }
+
+
+def snapshot_volume(stream, uploader: ChunkUploader) -> Dict:
+    """ Read a tar stream of a volume, storing the content of every file as chunks, returns its manifest entry """
+    members = []
+    with tarfile.open(fileobj=stream, mode="r|") as archive:
+        for member in archive:
+            entry = member_entry(member)
+            if member.isfile():
+                content = archive.extractfile(member)
+                for data in iter(lambda: content.read(settings.BACKUP_CHUNK_SIZE), b""):
+                    entry["chunks"].append(uploader.add(data))
+            members.append(entry)
+    return {"members": members}
+
+
+def load_manifest(store: IObjectStore, backup: ServiceBackup) -> Dict:
+    return json.loads(gzip.decompress(store.get(backup.manifest_key)))
+
+
+def previous_chunks(store: IObjectStore, service) -> Set[str]:
+    """ Chunks of the last successful backup of the service, known to be stored already """
+    previous = service.backups.filter(status=OperationStatus.SUCCEEDED).first()
+    if previous is None:
+        return set()
+    try:
+        manifest = load_manifest(store, previous)
+    except KeyError:
+        return set()
+    return {
+        digest
+        for volume in manifest["volumes"]
+        for member in volume["members"]
+        for digest in member["chunks"]
+    }
+
+
+def backup_service(controller) -> ServiceBackup:
+    """
+        Snapshot the volumes of the service of the controller into the backup store. Each volume is read as a tar
+        stream from a running pod, so the service keeps serving, and the content of every file is split in chunks
+        addressed by their sha256. Unchanged files produce the chunks already stored, so only what changed since
+        any earlier backup, of this or another service, is compressed and uploaded.
+    """
+    service = controller.service
+    store = get_object_store()
+    backup = ServiceBackup.objects.create(service=service)
+    uploader = ChunkUploader(store, previous_chunks(store, service), settings.BACKUP_UPLOAD_CONCURRENCY)
+    manifest = {"version": MANIFEST_VERSION, "service": str(service.pid), "created": backup.created.isoformat(),
+                "volumes": []}
+    try:
+        try:
+            for volume in controller.list_volumes():
+                with controller.read_volume(volume) as stream:
+                    entry = snapshot_volume(stream, uploader)
+                entry.update(claim=volume.claim, path=volume.path)
+                manifest["volumes"].append(entry)
+        finally:
+            uploader.close()
+        store.put(backup.manifest_key, gzip.compress(json.dumps(manifest).encode()))
+    except Exception as e:
+        backup.status, backup.error = OperationStatus.FAILED, str(e)[:2000]
+        raise
+    else:
+        backup.status = OperationStatus.SUCCEEDED
+    finally:
+        files = [member for volume in manifest["volumes"] for member in volume["members"]]
+        backup.volumes = len(manifest["volumes"])
+        backup.files = sum(1 for member in files if member["type"] in (tarfile.REGTYPE.decode(), tarfile.AREGTYPE.decode()))
+        backup.size = sum(member["size"] for member in files)
+        backup.chunks = sum(len(member["chunks"]) for member in files)
+        backup.new_chunks = uploader.new_chunks
+        backup.stored_size = uploader.stored_size
+        backup.finished = timezone.now()
+        backup.save()
+    logger.info(
+        "Backed up service %s: %s files, %s bytes, %s of %s chunks new, %s bytes stored",
+        service.pid, backup.files, backup.size, backup.new_chunks, backup.chunks, backup.stored_size)
+    return backup
+
+
+def fetch_chunks(store: IObjectStore, digests: List[str], concurrency: int) -> Iterator[bytes]:
+    """ Content of the chunks in order, downloaded and verified ahead of the reader by a pool of threads """
+
+    def fetch(digest):
+        data = zlib.decompress(store.get(chunk_key(digest)))
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise Exception(f"Chunk {digest} of the backup store is corrupted")
+        return data
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="usop-restore") as pool:
+        pending = deque()
+        remaining = iter(digests)
+        try:
+            for digest in remaining:
+                pending.append(pool.submit(fetch, digest))
+                if len(pending) >= concurrency * 2:
+                    break
+            while pending:
+                yield pending.popleft().result()
+                digest = next(remaining, None)
+                if digest is not None:
+                    pending.append(pool.submit(fetch, digest))
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class ChunkReader:
+    """ File object over the next chunks of a fetch_chunks iterator, the content of one file of the archive """
+
+    def __init__(self, chunks: Iterator[bytes], count: int):
+        self.chunks = chunks
+        self.count = count
+        self.buffer = b""
+
+    def read(self, size: int = -1) -> bytes:
+        while (size < 0 or len(self.buffer) < size) and self.count:
+            self.buffer += next(self.chunks)
+            self.count -= 1
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def restore_volume(stream, entry: Dict, store: IObjectStore):
+    """ Write the files of a manifest entry as a tar stream, fetching their chunks concurrently, then the restore marker """
+    digests = [digest for member in entry["members"] for digest in member["chunks"]]
+    chunks = fetch_chunks(store, digests, settings.BACKUP_DOWNLOAD_CONCURRENCY)
+    try:
+        with tarfile.open(fileobj=stream, mode="w|") as archive:
+            for member in entry["members"]:
+                info = tarfile.TarInfo(member["name"])
+                info.type = member["type"].encode()
+                for field in ("mode", "mtime", "uid", "gid", "uname", "gname", "linkname", "size"):
+                    setattr(info, field, member[field])
+                fileobj = ChunkReader(chunks, len(member["chunks"])) if info.isfile() else None
+                archive.addfile(info, fileobj)
+            archive.addfile(tarfile.TarInfo(RESTORE_MARKER))
+    finally:
+        chunks.close()
+
+
+def restore_service(controller, backup: Optional[ServiceBackup] = None) -> ServiceBackup:
+    """
+        Replace the content of the volumes of the service of the controller with a backup, the latest successful
+        one by default. Volumes are matched by claim name, the chunks are streamed back as they are downloaded.
+    """
+    service = controller.service
+    backup = backup or service.backups.filter(status=OperationStatus.SUCCEEDED).first()
+    if backup is None or backup.status != OperationStatus.SUCCEEDED:
+        raise Exception(f"Service {service.pid} has no successful backup to restore")
+    store = get_object_store()
+    manifest = load_manifest(store, backup)
+    volumes = {volume.claim: volume for volume in controller.list_volumes()}
+    missing = [entry["claim"] for entry in manifest["volumes"] if entry["claim"] not in volumes]
+    if missing:
+        raise Exception(f"Volumes of the backup are not mounted by the service: {', '.join(missing)}")
+    for entry in manifest["volumes"]:
+        with controller.write_volume(volumes[entry["claim"]]) as stream:
+            restore_volume(stream, entry, store)
+    logger.info("Restored service %s from backup %s", service.pid, backup.key)
+    return backup
@@ -0,0 +1,258 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from itertools import zip_longest
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import QuerySet
+from django.utils.translation import gettext_lazy as _
+from viewflow.fsm import TransitionNotAllowed
+
+from .allocation import PlacementPolicy
+from .fingerprint import is_up_to_date
+from .limits import operation_slot
+from .models import Service
+from .reconcile import move_services
+from .registry import controller_registry
+from .status import OperationStatus, ServiceStatus
+from .tasks import (ACTIVE_OPERATION_STATUSES, claim_operation, enqueue_operation, execute_operation, finish_operations,
+                    operations_heartbeat, start_operations)
+
+
+BILLED_OPERATIONS = ["deploy", "upgrade"]
+""" Operations that need the billing of the org to allow the service """
+
+
+@dataclass
+class BulkResult:
+    """ Outcome of an operation on a single service of a bulk run """
+
+    service_id: int
+    name: str
+    region: str
+    namespace: str
+    outcome: str
+    """ One of ok, failed, skipped or unchanged """
+    status: str
+    """ Status of the service after the operation """
+    duration: float = 0.0
+    error: str = ""
+
+
+class BulkOperation:
+    """
+        Runs a controller transition over a queryset of services using a pool of threads.
+        Concurrency is bounded globally, per region and per namespace. Upgrades of services whose desired
+        state was already applied are reported as unchanged without queueing them, unless forced.
+        Deploys and upgrades check billing for all the services up front, with one lookup per org, and place the
+        services that need a node with one allocation pass per region.
+    """
+
+    def __init__(
+            self,
+            queryset: QuerySet,
+            operation: str,
+            concurrency: Optional[int] = None,
+            per_region: Optional[int] = None,
+            per_namespace: Optional[int] = None,
+            progress: Optional[Callable[[int, int, BulkResult], None]] = None,
+            force: bool = False):
+        self.queryset = queryset
+        self.operation = operation
+        self.concurrency = concurrency or settings.BULK_CONCURRENCY
+        self.per_region = per_region or settings.BULK_REGION_CONCURRENCY
+        self.per_namespace = per_namespace or settings.BULK_NAMESPACE_CONCURRENCY
+        self.progress = progress
+        self.force = force
+        self._limits: Dict[str, threading.BoundedSemaphore] = {}
+        self._limits_lock = threading.Lock()
+        self._billing_denied: Set[int] = set()
+
+    def _limit(self, key: str, value: int) -> threading.BoundedSemaphore:
+        with self._limits_lock:
+            if key not in self._limits:
+                self._limits[key] = threading.BoundedSemaphore(value)
+            return self._limits[key]
+
+    def _schedule(self, services: List[Service]) -> List[Service]:
+        """
+            Interleave services of different namespaces, so the pool does not fill up
+            with threads waiting on the limit of a single namespace.
+        """
+        groups = OrderedDict()
+        for service in services:
+            groups.setdefault((service.region_id, service.namespace), []).append(service)
+        return [
+            service
+            for batch in zip_longest(*groups.values())
+            for service in batch
+            if service is not None
+        ]
+
+    def arguments(self) -> Dict:
+        """ Keyword arguments of the controller transition, billing was already checked for the whole run """
+        arguments = {}
+        if self.operation in BILLED_OPERATIONS:
+            arguments["billing_checked"] = True
+        if self.force and self.operation == "upgrade":
+            arguments["force"] = True
+        return arguments
+
+    def _run_one(self, service: Service) -> BulkResult:
+        namespace = service.namespace
+        region_limit = self._limit(f"region:{service.region_id}", self.per_region)
+        namespace_limit = self._limit(f"namespace:{service.region_id}:{namespace}", self.per_namespace)
+        result = BulkResult(
+            service_id=service.pk, name=service.name, region=service.region.name,
+            namespace=namespace, outcome="ok", status=service.status)
+        if self.operation == "upgrade" and not self.force and is_up_to_date(service):
+            result.outcome = "unchanged"
+            return result
+        if service.pk in self._billing_denied:
+            result.outcome = "failed"
+            result.error = str(_("Billing failed"))
+            return result
+        close_old_connections()
+        started = time.monotonic()
+        try:
+            with region_limit, namespace_limit:
+                try:
+                    operation = enqueue_operation(service, self.operation, dispatch=False)
+                except TransitionNotAllowed as e:
+                    result.outcome = "skipped"
+                    result.error = str(e)
+                    return result
+                claimed = claim_operation(operation.pk)
+                if claimed is None:
+                    # Merged into an operation already queued or running elsewhere, which will run it
+                    result.outcome = "skipped"
+                    result.error = f"Queued as operation {operation.task_id}"
+                    return result
+                service = claimed.service
+                execute_operation(claimed, arguments=self.arguments())
+        except Exception as e:
+            result.outcome = "failed"
+            result.error = str(e)
+        finally:
+            result.duration = time.monotonic() - started
+            result.status = service.status
+            connection.close()
+        return result
+
+    def _allocate_nodes(self, services: List[Service]):
+        """ Place the services that will be deployed without a node with one pass per region, largest first """
+        by_region = OrderedDict()
+        for service in services:
+            if service.region.placement_policy == PlacementPolicy.NONE or service.node_id is not None:
+                continue
+            if service.pk in self._billing_denied or (self.operation == "upgrade" and not self.force and is_up_to_date(service)):
+                continue
+            if not getattr(service.get_service_controller(), self.operation).can_proceed():
+                continue
+            by_region.setdefault(service.region_id, []).append(service)
+        for members in by_region.values():
+            members[0].region.get_node_allocator().allocate_many(members)
+
+    def run(self) -> List[BulkResult]:
+        """ Run the operation over all the services and return a result per service """
+        services = self._schedule(list(self.queryset.with_deployment_context().select_related("node")))
+        if self.operation in BILLED_OPERATIONS and services:
+            allowed = services[0].get_billing_controller().can_deploy_many(services)
+            self._billing_denied = {pk for pk, ok in allowed.items() if not ok}
+            self._allocate_nodes(services)
+        total = len(services)
+        results = []
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="usop-bulk") as pool:
+            futures = [pool.submit(self._run_one, service) for service in services]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if self.progress:
+                    self.progress(len(results), total, result)
+        return results
+
+    @staticmethod
+    def summarize(results: Iterable[BulkResult]) -> Dict[str, int]:
+        """ Count results per outcome """
+        summary = defaultdict(int)
+        for result in results:
+            summary[result.outcome] += 1
+        return dict(summary)
+
+
+RESTARTABLE_STATUSES = [ServiceStatus.RUNNING, ServiceStatus.DEGRADED]
+
+
+def _set_batch_status(sources: Dict[int, str], target: str):
+    """ Move the services of a batch from their current status to target, with one update per source status """
+    by_source = defaultdict(list)
+    for pk, source in sources.items():
+        by_source[source].append(pk)
+    for source, ids in by_source.items():
+        move_services(Service.objects, ids, source, target, "restart")
+
+
+def restart_in_batches(
+        queryset: QuerySet,
+        batch_size: Optional[int] = None,
+        progress: Optional[Callable[[int, int, BulkResult], None]] = None) -> List[BulkResult]:
+    """
+        Rolling restart of many services with one controller call per namespace and batch, instead of one per
+        service. Services that are not running or have operations queued are skipped. Every restarted service
+        gets a running operation record, so requests made meanwhile queue behind the batch.
+    """
+    batch_size = batch_size or settings.BULK_RESTART_BATCH_SIZE
+    services = list(queryset.with_deployment_context())
+    results = {
+        service.pk: BulkResult(
+            service_id=service.pk, name=service.name, region=service.region.name,
+            namespace=service.namespace, outcome="skipped", status=service.status,
+            error=f"Cannot restart service in status {service.status}")
+        for service in services
+    }
+    groups = OrderedDict()
+    for service in services:
+        controller_class = controller_registry.get_for_service(service)
+        groups.setdefault((controller_class, service.namespace), []).append(service)
+
+    done = 0
+    for (controller_class, namespace), members in groups.items():
+        for start in range(0, len(members), batch_size):
+            batch = {service.pk: service for service in members[start:start + batch_size]}
+            started = time.monotonic()
+            with transaction.atomic():
+                sources = dict(
+                    Service.objects
+                    .select_for_update()
+                    .filter(pk__in=batch, status__in=RESTARTABLE_STATUSES)
+                    .exclude(operations__status__in=ACTIVE_OPERATION_STATUSES)
+                    .values_list("pk", "status")
+                )
+                for pk, source in sources.items():
+                    batch[pk].status = source
+                operations = start_operations([batch[pk] for pk in sources], "restart")
+                _set_batch_status(sources, ServiceStatus.RESTARTING)
+            status, error = ServiceStatus.RUNNING, ""
+            if sources:
+                try:
+                    with operations_heartbeat(*operations), operation_slot(batch[next(iter(sources))]):
+                        controller_class.restart_releases(namespace, [str(batch[pk].pid) for pk in sources])
+                except Exception as e:
+                    status, error = ServiceStatus.RESTARTING_FAILED, str(e)
+                _set_batch_status(dict.fromkeys(sources, ServiceStatus.RESTARTING), status)
+                finish_operations(operations, OperationStatus.FAILED if error else OperationStatus.SUCCEEDED, error)
+            for pk in batch:
+                result = results[pk]
+                if pk in sources:
+                    result.outcome = "failed" if error else "ok"
+                    result.status = status
+                    result.error = error
+                    result.duration = time.monotonic() - started
+                done += 1
+                if progress:
+                    progress(done, len(results), result)
+    return list(results.values())
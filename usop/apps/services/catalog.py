@@ -0,0 +1,121 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+PREFIX = "usop:catalog"
+
+TEMPLATES_SCOPE = "templates"
+""" Bumped on any template write, every entry embeds templates """
+
+
+def skus_scope(org_id, region_id) -> str:
+    return f"skus:{org_id}:{region_id}"
+
+
+def versions_scope(template_id) -> str:
+    return f"versions:{template_id}"
+
+
+class CatalogCache:
+    """
+        Read-through cache of the template catalog. Entries are stored in the Django cache under keys that embed
+        the version of every scope they depend on, so a write only bumps the versions of its scopes and the stale
+        entries are never read again. A process local tier keeps the entries, and the versions for a few seconds,
+        in front of the shared cache, so steady state reads make no query and no cache round trip.
+        Bumps reach other processes through the Django cache only, so CACHE_URL must point every web and worker
+        process at the same cache, with the local memory default a process never sees the writes of the others.
+    """
+
+    def __init__(self, timeout: float = 3600, local_ttl: float = 5, local_size: int = 1024):
+        self.timeout = timeout
+        self.local_ttl = local_ttl
+        self.local_size = local_size
+        self._versions = {}
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def version(self, scope: str) -> int:
+        key = f"{PREFIX}:version:{scope}"
+        with self._lock:
+            cached = self._versions.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+        value = cache.get(key)
+        if value is None:
+            cache.add(key, 1, timeout=None)
+            value = cache.get(key, 1)
+        with self._lock:
+            self._versions[key] = (time.monotonic() + self.local_ttl, value)
+        return value
+
+    def bump(self, scopes: Iterable[str]):
+        """
+            Invalidate the entries of the scopes, other processes see it after at most local_ttl seconds.
+            Called once the write commits, so no process can load the old rows under the new version.
+        """
+        for scope in set(scopes):
+            key = f"{PREFIX}:version:{scope}"
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.add(key, 2, timeout=None)
+            with self._lock:
+                self._versions.pop(key, None)
+
+    def get_or_load(self, name: str, scopes: List[str], loader: Callable):
+        """ Cached result of loader, a copy so callers can't change the shared entry """
+        key = f"{PREFIX}:{name}:" + ":".join(f"{scope}@{self.version(scope)}" for scope in scopes)
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return copy.deepcopy(self._values[key])
+        value = cache.get(key)
+        if value is None:
+            value = loader()
+            cache.set(key, value, timeout=self.timeout)
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.local_size:
+                self._values.popitem(last=False)
+        return copy.deepcopy(value)
+
+    def clear_local(self):
+        with self._lock:
+            self._versions.clear()
+            self._values.clear()
+
+    def skus_for(self, org_id, region_id) -> List:
+        """ SKUs an org can deploy in a region, with their template """
+        from .models import TemplateSKU
+
+        def load():
+            return list(TemplateSKU.objects.select_related("template").filter(org_id=org_id, region_id=region_id))
+
+        return self.get_or_load(
+            f"skus:{org_id}:{region_id}", [skus_scope(org_id, region_id), TEMPLATES_SCOPE], load)
+
+    def latest_version(self, template_id) -> Optional[object]:
+        """ Most recently added version of a template """
+        from .models import TemplateVersion
+
+        def load():
+            # Stored as a list, so a template without versions is cached too
+            return list(TemplateVersion.objects.select_related("template").filter(template_id=template_id).order_by("-pk")[:1])
+
+        versions = self.get_or_load(
+            f"latest:{template_id}", [versions_scope(template_id), TEMPLATES_SCOPE], load)
+        return versions[0] if versions else None
+
+
+catalog_cache = CatalogCache(
+    timeout=settings.CATALOG_CACHE_TIMEOUT,
+    local_ttl=settings.CATALOG_LOCAL_TTL,
+    local_size=settings.CATALOG_LOCAL_SIZE,
+)
+""" Process wide catalog cache """
@@ -0,0 +1,181 @@
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class HelmHomeClaim:
+    """ A helm home held by a thread, the lock is released when the thread exits and drops the claim """
+
+    def __init__(self, path: str, lock):
+        self.path = path
+        self.lock = lock
+        self.pid = os.getpid()
+
+    def __del__(self):
+        self.lock.close()
+
+
+class HelmHomes:
+    """
+        Cache and config homes of the helm commands, one per thread running helm at the same time on the host, so
+        parallel workers don't wait on the lock helm takes on the shared repository index. A thread claims the first
+        home that no other thread holds, with a file lock kept until the thread exits or its process dies, and the
+        next workers reuse the homes instead of creating new ones.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._local = threading.local()
+
+    def current(self) -> str:
+        claim = getattr(self._local, "claim", None)
+        # A forked process inherits the claim of the thread that forked, along with its lock
+        if claim is None or claim.pid != os.getpid():
+            claim = self._local.claim = self._claim()
+        return claim.path
+
+    def _claim(self) -> HelmHomeClaim:
+        os.makedirs(self.root, exist_ok=True)
+        slot = 0
+        while True:
+            lock = open(os.path.join(self.root, f"slot-{slot}.lock"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                slot += 1
+                continue
+            return HelmHomeClaim(os.path.join(self.root, f"slot-{slot}"), lock)
+
+
+helm_homes = HelmHomes(settings.HELM_HOME_DIR or os.path.join(tempfile.gettempdir(), "usop-helm"))
+""" Process wide helm homes """
+
+
+def helm_env() -> Dict[str, str]:
+    """ Environment of the helm commands, with the cache and config homes of the thread. Registry logins stay shared """
+    home = helm_homes.current()
+    config_home = os.environ.get("HELM_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config", "helm")
+    return dict(
+        os.environ,
+        HELM_CACHE_HOME=os.path.join(home, "cache"),
+        HELM_CONFIG_HOME=os.path.join(home, "config"),
+        HELM_REGISTRY_CONFIG=os.environ.get(
+            "HELM_REGISTRY_CONFIG", os.path.join(config_home, "registry", "config.json")),
+    )
+
+
+def chart_reference(version) -> Dict[str, str]:
+    return {"chart": version.template.chart_id, "repo": version.helm_repo, "version": version.version_name}
+
+
+class ChartCache:
+    """
+        Local cache of the chart tarballs of the template versions. Tarballs are stored once under the sha256 of
+        their content, and every chart reference points to the digest it was pulled as. A reference is pulled once
+        per cache directory, a file lock keeps concurrent processes from pulling the same chart twice.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def reference_key(self, version) -> str:
+        encoded = json.dumps(chart_reference(version), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, "blobs", f"{digest}.tgz")
+
+    def _ref_path(self, key: str) -> str:
+        return os.path.join(self.root, "refs", key)
+
+    def path_for(self, version) -> Optional[str]:
+        """ Local tarball of the chart of the version, None when it was not pulled yet """
+        try:
+            with open(self._ref_path(self.reference_key(version))) as ref:
+                path = self.blob_path(ref.read().strip())
+        except FileNotFoundError:
+            return None
+        return path if os.path.exists(path) else None
+
+    @contextmanager
+    def _locked(self, key: str):
+        os.makedirs(os.path.join(self.root, "refs"), exist_ok=True)
+        with open(self._ref_path(key) + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def pull(self, version) -> str:
+        """ Local tarball of the chart of the version, pulled from its repository the first time """
+        path = self.path_for(version)
+        if path:
+            return path
+        key = self.reference_key(version)
+        with self._locked(key):
+            path = self.path_for(version)
+            if path:
+                # Pulled by another process while waiting for the lock
+                return path
+            os.makedirs(os.path.join(self.root, "blobs"), exist_ok=True)
+            with tempfile.TemporaryDirectory(dir=self.root) as destination:
+                reference = chart_reference(version)
+                helm_command = settings.HELM_COMMAND + [
+                    "pull", reference["chart"], "--repo", reference["repo"], "--version", reference["version"],
+                    "--destination", destination]
+                subprocess.run(
+                    helm_command, check=True, capture_output=True, text=True, env=helm_env(),
+                    timeout=settings.HELM_CHART_PULL_TIMEOUT)
+                tarballs = glob.glob(os.path.join(destination, "*.tgz"))
+                if len(tarballs) != 1:
+                    raise Exception(f"Helm pull of {reference['chart']} returned {len(tarballs)} charts")
+                digest = self.file_digest(tarballs[0])
+                path = self.blob_path(digest)
+                if not os.path.exists(path):
+                    shutil.move(tarballs[0], path)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "refs"), suffix=".tmp")
+            with os.fdopen(fd, "w") as ref:
+                ref.write(digest)
+            os.replace(tmp_path, self._ref_path(key))
+            logger.info("Cached chart %s %s as %s", reference["chart"], reference["version"], digest)
+        return path
+
+    def warm(self, versions: Iterable) -> Dict[int, Optional[str]]:
+        """ Pull the charts of the versions, returns the error of every version that could not be pulled """
+        errors = {}
+        for version in versions:
+            try:
+                self.pull(version)
+                errors[version.pk] = None
+            except Exception as e:
+                logger.warning("Could not cache the chart of template version %s: %s", version.pk, e)
+                errors[version.pk] = str(e)
+        return errors
+
+    @staticmethod
+    def file_digest(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+chart_cache = ChartCache(settings.HELM_CHART_CACHE_DIR or os.path.join(tempfile.gettempdir(), "usop-charts"))
+""" Process wide chart cache """
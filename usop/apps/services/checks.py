@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+
+LOCAL_CACHE_BACKENDS = [
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+]
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """ The catalog cache invalidates the entries of other processes through the default cache """
+    if settings.CACHES["default"]["BACKEND"] in LOCAL_CACHE_BACKENDS:
+        return [Warning(
+            "The default cache is local to each process, template catalog writes are not seen by other processes.",
+            hint="Set CACHE_URL to a cache shared by the web and worker processes, ex: rediscache://redis:6379/1",
+            id="services.W001",
+        )]
+    return []
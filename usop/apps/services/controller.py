@@ -1,17 +1,304 @@
 from django.conf import settings
+from django.utils import timezone
 from viewflow.fsm import State
 from django.utils.translation import gettext_lazy as _
 
-from .interfaces import IBillingController, IServiceController
-from .models import Service
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .allocation import CPU_UNITS, MEMORY_UNITS, PlacementPolicy, parse_quantity
+from .charts import chart_cache, helm_env
+from .events import emit_transition, pipeline
+from .fingerprint import desired_fingerprint, is_up_to_date
+from .backup import RESTORE_MARKER, backup_service, restore_service
+from .billing import CachedBillingController
+from .interfaces import (BillingState, ClusterEvent, IServiceController, LogLine, MetricSample, ReleaseState,
+                         ServiceVolume)
+from .models import Service, ServiceOperation
+from .pubsub import publish_operation
+from .kube import KubeClient, get_kube_client
+from .reconcile import resolve_status
+from .values import values_resolver
 from usop.apps.services.status import ServiceStatus
+from usop.lib.ProcessUtil import ProcessOutput, ProcessUtil
+import base64
+import gzip
+import heapq
+import json
+import logging
+import os
+import queue
 import subprocess
+import tempfile
+import threading
+import time
+import yaml
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+RELEASE_LABEL = "app.kubernetes.io/instance"
+""" Label set by charts on the resources of a release, with the release name as value """
+
+RESTARTED_AT_ANNOTATION = "kubectl.kubernetes.io/restartedAt"
+""" Pod template annotation changed to trigger a rolling restart, the same one kubectl rollout restart sets """
+
 
+KEEP_POLICY_ANNOTATION = "helm.sh/resource-policy"
+""" Resources annotated with the keep policy are left in the cluster when the release is uninstalled, as helm does """
 
-class DefaultBillingController(IBillingController): 
-    """ Reimplement this class to allow billing for services """   
-    def can_deploy(self, service):
+
+def releases_selector(release_names: List[str]) -> str:
+    """ Label selector matching the resources of any of the given releases """
+    return f"{RELEASE_LABEL} in ({','.join(release_names)})"
+
+
+def pod_ready(pod) -> bool:
+    """ Wether a pod is running with all its containers ready, or finished successfully """
+    status = pod.get("status", {})
+    if status.get("phase") == "Succeeded":
         return True
+    if status.get("phase") != "Running":
+        return False
+    return all(container.get("ready") for container in status.get("containerStatuses", []))
+
+
+def stream_command(command, name, output: ProcessOutput = None, on_line=None):
+    """ Run a helm or kubectl command streaming its output, failures raise with the last lines of the output """
+    output = output or ProcessOutput(settings.OPERATION_OUTPUT_LINES)
+    returncode = ProcessUtil.run(
+        command, output, timeout=settings.OPERATION_TIMEOUT, on_line=on_line, env=helm_env())
+    if returncode != 0:
+        last_lines = "\n".join(list(output.lines)[-20:])
+        raise Exception(f"{name} command failed with return code {returncode}: {last_lines}")
+
+
+def decode_release(secret) -> Dict:
+    """ Release record stored by helm in a release secret, base64 encoded twice and gzipped """
+    return json.loads(gzip.decompress(base64.b64decode(base64.b64decode(secret["data"]["release"]))))
+
+
+def release_objects(release) -> List[Dict]:
+    """ Objects of a release record, the ones of the manifest and of the hooks, without the kept ones """
+    manifests = [release.get("manifest", "")] + [hook.get("manifest", "") for hook in release.get("hooks") or []]
+    objects = []
+    for manifest in manifests:
+        for document in yaml.safe_load_all(manifest):
+            if not document or "kind" not in document:
+                continue
+            annotations = document.get("metadata", {}).get("annotations") or {}
+            if document["kind"] == "PersistentVolumeClaim" or annotations.get(KEEP_POLICY_ANNOTATION) == "keep":
+                continue
+            objects.append(document)
+    return objects
+
+
+def release_volumes(pods) -> List[ServiceVolume]:
+    """ Persistent volume claims mounted by the running pods, each one once, from a ready pod when possible """
+    volumes = {}
+    for pod in sorted(pods, key=lambda pod: not pod_ready(pod)):
+        if pod.get("status", {}).get("phase") != "Running":
+            continue
+        claims = {
+            volume["name"]: volume["persistentVolumeClaim"]["claimName"]
+            for volume in pod["spec"].get("volumes", [])
+            if "persistentVolumeClaim" in volume
+        }
+        for container in pod["spec"]["containers"]:
+            for mount in container.get("volumeMounts", []):
+                claim = claims.get(mount["name"])
+                if claim and claim not in volumes and not mount.get("subPath"):
+                    volumes[claim] = ServiceVolume(
+                        claim=claim, pod=pod["metadata"]["name"], container=container["name"], path=mount["mountPath"])
+    return list(volumes.values())
+
+
+RESTORE_STAGING_DIR = ".usop-restore"
+""" Directory of a volume the restores extract into, left out of the backups """
+
+RESTORE_SCRIPT = """
+set -e
+stage="$0/$1"
+rm -rf "$stage"
+mkdir "$stage"
+tar xf - -C "$stage" && [ -f "$stage/$2" ] || {
+    rm -rf "$stage"
+    echo "Incomplete archive, the volume was left unchanged" >&2
+    exit 1
+}
+rm "$stage/$2"
+find "$0" -mindepth 1 -maxdepth 1 ! -name "$1" -exec rm -rf {} +
+find "$stage" -mindepth 1 -maxdepth 1 -exec mv {} "$0" \\;
+rmdir "$stage"
+"""
+""" Extract a tar stream in the staging directory of a volume, then replace the content of the volume with it """
+
+
+@contextmanager
+def exec_stream(command, stdin=False, timeout=None, accepted_codes=(0,)):
+    """
+        Run a kubectl exec command, yielding its binary stdout, or stdin when asked for, as a stream.
+        Raises with the error output of the command when it exits with a code not accepted or runs longer
+        than timeout seconds.
+    """
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(
+            command, stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL if stdin else subprocess.PIPE, stderr=errors)
+        watchdog = threading.Timer(timeout, process.kill) if timeout else None
+        if watchdog:
+            watchdog.daemon = True
+            watchdog.start()
+
+        def failure():
+            if process.returncode in accepted_codes:
+                return None
+            errors.seek(0)
+            output = errors.read()[-2000:].decode(errors="replace")
+            return Exception(f"Kubectl exec failed with return code {process.returncode}: {output}")
+
+        try:
+            try:
+                yield process.stdin if stdin else process.stdout
+            except Exception as e:
+                if stdin:
+                    raise
+                # A stream cut short by the command reads as a broken archive, report why the command failed
+                try:
+                    process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                error = failure()
+                if error is None:
+                    raise
+                raise error from e
+            if stdin:
+                process.stdin.close()
+            else:
+                # Drain what the reader left, ex: the padding after the end of a tar archive
+                while process.stdout.read(1024 * 1024):
+                    pass
+            process.wait()
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        error = failure()
+        if error is not None:
+            raise error
+
+
+def mark_unready_releases(releases: Dict[str, ReleaseState], pods):
+    """ Flag the releases that own a pod that is not ready """
+    for pod in pods:
+        name = pod.get("metadata", {}).get("labels", {}).get(RELEASE_LABEL)
+        if name in releases and not pod_ready(pod):
+            releases[name].ready = False
+
+
+def parse_log_line(line, pod=None, container=None) -> Optional[LogLine]:
+    """ Parse a line read with timestamps, prefixed with [pod/<pod>/<container>] when pod is not given """
+    if pod is None:
+        prefix, sep, line = line.partition("] ")
+        parts = prefix.lstrip("[").split("/")
+        if not sep or len(parts) != 3:
+            return None
+        pod, container = parts[1], parts[2]
+    timestamp, sep, message = line.partition(" ")
+    return LogLine(cursor=timestamp, pod=pod, container=container, message=message, time=timestamp)
+
+
+def log_timestamp(timestamp: str) -> str:
+    """ RFC3339 timestamp with the fraction padded to nanoseconds, so timestamps compare as strings """
+    base, dot, fraction = timestamp.rstrip("Z").partition(".")
+    return f"{base}.{fraction.ljust(9, '0')}Z"
+
+
+def log_cursor_key(cursor: str) -> Tuple:
+    """
+        Sort key of a log cursor. A bare timestamp sorts after every line of that timestamp.
+        Raises ValueError when the cursor is malformed.
+    """
+    timestamp, *position = cursor.split("|")
+    if not timestamp.endswith("Z") or "T" not in timestamp:
+        raise ValueError(f"Invalid log cursor: {cursor}")
+    if not position:
+        return (log_timestamp(timestamp), chr(0x10FFFF))
+    if len(position) != 3:
+        raise ValueError(f"Invalid log cursor: {cursor}")
+    pod, container, rank = position
+    return (log_timestamp(timestamp), pod, container, int(rank))
+
+
+def log_since_time(cursor: str) -> str:
+    """ Start of the second of a cursor, to ask the cluster for the lines from there, the rest is filtered here """
+    return log_cursor_key(cursor)[0][:19] + "Z"
+
+
+def cursor_logs(lines: Iterable[Optional[LogLine]]) -> Iterator[LogLine]:
+    """ Give every line its cursor, ranking the lines a container printed with the same timestamp """
+    last = {}
+    for line in lines:
+        if line is None:
+            continue
+        stream = (line.pod, line.container)
+        timestamp, rank = last.get(stream, (None, -1))
+        rank = rank + 1 if timestamp == line.time else 0
+        last[stream] = (line.time, rank)
+        line.cursor = f"{line.time}|{line.pod}|{line.container}|{rank}"
+        yield line
+
+
+def merge_logs(streams: List[Iterable[LogLine]]) -> Iterator[LogLine]:
+    """ Merge the lines of many time ordered streams into a single time ordered one """
+    return heapq.merge(*streams, key=lambda line: log_cursor_key(line.cursor))
+
+
+def filter_logs(lines: Iterable[LogLine], since=None, contains=None) -> Iterator[LogLine]:
+    """ Drop the lines up to the since cursor and the ones not containing the given text """
+    since_key = log_cursor_key(since) if since else None
+    for line in lines:
+        if (since_key and log_cursor_key(line.cursor) <= since_key) or (contains and contains not in line.message):
+            continue
+        yield line
+
+
+def release_events(items, release_name, since=None) -> List[ClusterEvent]:
+    """ Events of the objects of a release, charts name their objects after the release """
+    events = []
+    for item in items:
+        involved = item.get("involvedObject", {})
+        if release_name not in involved.get("name", ""):
+            continue
+        cursor = item.get("lastTimestamp") or item.get("eventTime") or item["metadata"].get("creationTimestamp", "")
+        if since and cursor <= since:
+            continue
+        events.append(ClusterEvent(
+            cursor=cursor, type=item.get("type", ""), reason=item.get("reason", ""),
+            object=f"{involved.get('kind')}/{involved.get('name')}", message=item.get("message", ""),
+            count=item.get("count") or 1))
+    return sorted(events, key=lambda event: event.cursor)
+
+
+def metric_samples(items) -> Iterator[MetricSample]:
+    """ Samples of every container of the pod metrics returned by the metrics API """
+    for pod in items:
+        for container in pod.get("containers", []):
+            usage = container.get("usage", {})
+            yield MetricSample(
+                cursor=pod.get("timestamp", ""), pod=pod["metadata"]["name"], container=container["name"],
+                cpu=parse_quantity(usage.get("cpu", "0"), CPU_UNITS),
+                memory=parse_quantity(usage.get("memory", "0"), MEMORY_UNITS))
+
+
+class DefaultBillingController(CachedBillingController):
+    """ Reimplement this class to allow billing for services """
+    def load_states(self, org_ids):
+        return {org_id: BillingState() for org_id in org_ids}
     
 
 class ServiceController(IServiceController):
@@ -20,91 +307,265 @@ class ServiceController(IServiceController):
     
     def __init__(self, service):
         self.service = service
+        self.operation_record: ServiceOperation = None
+        """ Operation being run, receives the tail of the output of the commands """
+        self.output: ProcessOutput = None
 
     @state.setter()
     def _set_state(self, value):
-        self.report.service = value
+        self.service.status = value
 
     @state.getter()
     def _get_state(self):
         return self.service.status
     
     @state.on_success()
-    def _on_transition_success(self, descriptor, source, target):
+    def _on_transition_success(self, descriptor, source, target, *args, **kwargs):
         """ Save the service after a successful transition """
-        self.service.save()
+        with pipeline.suppress():
+            self.service.save()
+        emit_transition(self.service, source, target, descriptor.label.lower())
         
     def get_status(self):
-        """ Get the current status of the service """
-        return self.service.status
+        """ Get the status of the service as observed in the cluster """
+        releases = self.list_releases(self.service.namespace)
+        return resolve_status(self.service.status, releases.get(str(self.service.pid)))
+
+    def monitor(self):
+        """ Update the stored status of the service if it drifted from the cluster """
+        status = self.get_status()
+        if status != self.service.status:
+            self.service.status = status
+            self.service.save(update_fields=["status"])
+        return status
+
+    def run_command(self, command, name):
+        """ Run a command of the current operation, streaming its output to the log and the operation record """
+        if self.output is None:
+            spill_path = None
+            if settings.OPERATION_OUTPUT_DIR and self.operation_record is not None:
+                os.makedirs(settings.OPERATION_OUTPUT_DIR, exist_ok=True)
+                spill_path = os.path.join(settings.OPERATION_OUTPUT_DIR, f"{self.operation_record.task_id}.log")
+            self.output = ProcessOutput(settings.OPERATION_OUTPUT_LINES, spill_path)
+        flushed = time.monotonic()
+
+        def on_line(line):
+            nonlocal flushed
+            logger.debug("%s: %s", self.service.pid, line)
+            if time.monotonic() - flushed >= settings.OPERATION_OUTPUT_FLUSH_INTERVAL:
+                flushed = time.monotonic()
+                self.save_output()
+
+        try:
+            stream_command(command, name, self.output, on_line)
+        finally:
+            self.output.close()
+            self.save_output()
+
+    def save_output(self):
+        """ Store the tail of the output on the operation record, so operators can follow a running operation """
+        if self.operation_record is not None and self.output is not None:
+            ServiceOperation.objects.filter(pk=self.operation_record.pk).update(output=self.output.tail)
+            publish_operation(self.operation_record, "\n".join(list(self.output.lines)[-20:]))
+
+    def needs_node(self) -> bool:
+        """ Wether the region of the service has a placement policy and no node was allocated to the service yet """
+        return self.service.region.placement_policy != PlacementPolicy.NONE and self.service.node_id is None
 
-    @state.transition(source=ServiceStatus.NEW, target=ServiceStatus.RUNNING)
-    def deploy(self):
-        """ Deploy the service in the target region """
-        billing_ok = self.service.get_billing_controller().can_deploy(self.service)
-        if not billing_ok:
+    def node_args(self, allocate=True):
+        """ Pin the service to a node when its region has a placement policy, allocating one unless told not to """
+        if self.service.region.placement_policy == PlacementPolicy.NONE:
+            return []
+        if self.needs_node():
+            if not allocate:
+                return []
+            self.service.region.get_node_allocator().allocate(self.service)
+        return ["--set-string", f"nodeSelector.kubernetes\\.io/hostname={self.service.node.name}"]
+
+    def helm_chart_args(self):
+        """ Chart of the service template version for helm install and upgrade, the cached tarball when possible """
+        version = self.service.template_version
+        try:
+            return [chart_cache.pull(version)]
+        except Exception:
+            logger.warning("Could not cache the chart of %s, using the remote chart", version, exc_info=True)
+        return [version.template.chart_id, "--repo", version.helm_repo, "--version", version.version_name]
+
+    @classmethod
+    def list_releases(cls, namespace) -> Dict[str, ReleaseState]:
+        """ List the releases of a namespace with one helm call and one kubectl call """
+        helm_command = settings.HELM_COMMAND + ["list", "--all", "--max", "0", "--output", "json", "--namespace", namespace]
+        result = subprocess.run(
+            helm_command, check=True, capture_output=True, text=True, timeout=settings.KUBERNETES_TIMEOUT)
+        releases = {
+            release["name"]: ReleaseState(name=release["name"], status=release["status"])
+            for release in json.loads(result.stdout or "[]")
+        }
+        kubectl_command = settings.KUBECTL_COMMAND + [
+            "get", "pods", "--namespace", namespace, "--selector", RELEASE_LABEL, "--output", "json"]
+        result = subprocess.run(
+            kubectl_command, check=True, capture_output=True, text=True, timeout=settings.KUBERNETES_TIMEOUT)
+        mark_unready_releases(releases, json.loads(result.stdout or "{}").get("items", []))
+        return releases
+
+    def get_logs(self, since=None, tail=None, contains=None, container=None, follow=False) -> Iterator[LogLine]:
+        """
+            Stream the log lines of the pods of the service. Followed logs come from one kubectl call, interleaving
+            the containers as kubectl reads them. Pages read every container with its own kubectl call and merge
+            them by time, so a page reads about as many lines as it returns instead of the whole log.
+        """
+        namespace = self.service.namespace
+        selector = f"{RELEASE_LABEL}={self.service.pid}"
+        log_args = ["--timestamps"]
+        if since:
+            log_args += ["--since-time", log_since_time(since)]
+        if tail:
+            log_args += ["--tail", str(tail)]
+        if follow:
+            kubectl_command = settings.KUBECTL_COMMAND + [
+                "logs", "--namespace", namespace, "--selector", selector, "--prefix", *log_args, "--follow",
+                "--max-log-requests", str(settings.SERVICE_LOG_MAX_STREAMS)]
+            kubectl_command += ["--container", container] if container else ["--all-containers"]
+            lines = cursor_logs(map(parse_log_line, ProcessUtil.stream(kubectl_command)))
+            yield from filter_logs(lines, since, contains)
+            return
+
+        result = subprocess.run(
+            settings.KUBECTL_COMMAND + ["get", "pods", "--namespace", namespace, "--selector", selector, "--output", "json"],
+            check=True, capture_output=True, text=True, timeout=settings.KUBERNETES_TIMEOUT)
+        streams = [
+            (pod["metadata"]["name"], name)
+            for pod in json.loads(result.stdout or "{}").get("items", [])
+            for name in ([container] if container else [c["name"] for c in pod["spec"]["containers"]])
+        ][:settings.SERVICE_LOG_MAX_STREAMS]
+        outputs = [
+            ProcessUtil.stream(
+                settings.KUBECTL_COMMAND + ["logs", "--namespace", namespace, pod, "--container", name, *log_args],
+                timeout=settings.KUBERNETES_TIMEOUT)
+            for pod, name in streams
+        ]
+
+        def read(pod, name, output):
+            yield from cursor_logs(parse_log_line(line, pod, name) for line in output)
+
+        try:
+            lines = merge_logs([read(pod, name, output) for (pod, name), output in zip(streams, outputs)])
+            yield from filter_logs(lines, since, contains)
+        finally:
+            # Stops the kubectl calls of the containers that were not read to the end
+            for output in outputs:
+                output.close()
+
+    def get_events(self, since=None, event_type=None) -> Iterator[ClusterEvent]:
+        kubectl_command = settings.KUBECTL_COMMAND + [
+            "get", "events", "--namespace", self.service.namespace, "--output", "json"]
+        if event_type:
+            kubectl_command += ["--field-selector", f"type={event_type}"]
+        result = subprocess.run(
+            kubectl_command, check=True, capture_output=True, text=True, timeout=settings.KUBERNETES_TIMEOUT)
+        yield from release_events(json.loads(result.stdout or "{}").get("items", []), str(self.service.pid), since)
+
+    def get_metrics(self) -> Iterator[MetricSample]:
+        path = (f"/apis/metrics.k8s.io/v1beta1/namespaces/{self.service.namespace}/pods"
+                f"?labelSelector={RELEASE_LABEL}%3D{self.service.pid}")
+        result = subprocess.run(
+            settings.KUBECTL_COMMAND + ["get", "--raw", path], check=True, capture_output=True, text=True,
+            timeout=settings.KUBERNETES_TIMEOUT)
+        yield from metric_samples(json.loads(result.stdout or "{}").get("items", []))
+
+    @state.transition(
+        source=[ServiceStatus.NEW, ServiceStatus.DEPLOYING, ServiceStatus.DEPLOYING_FAILED],
+        target=ServiceStatus.RUNNING)
+    def deploy(self, billing_checked=False):
+        """ Deploy the service in the target region, checking billing unless the caller did it for a whole batch """
+        if not billing_checked and not self.service.get_billing_controller().can_deploy(self.service):
             raise Exception(_("Billing failed"))
-        helm_command = [
-            "helm", "upgrade", "--install", "--atomic",]
+        helm_command = settings.HELM_COMMAND + ["upgrade", "--install", "--atomic"]
         if settings.DEBUG:
             helm_command += ["--debug"]
         if settings.DRY_RUN:
             helm_command += ["--dry-run"]
-        helm_command += [
-            str(self.service.pid),
-            self.service.template,
-            "--namespace", self.service.namespace
-        ]
-        result = subprocess.run(helm_command, check=True, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Helm command failed with return code {result.returncode}: {result.stderr}")
+        helm_command += self.helm_release_args()
+        self.run_command(helm_command, "Helm")
+        self.mark_applied()
         
-    @state.transition(source=ServiceStatus.UPGRADING, target=ServiceStatus.RUNNING)
-    def upgrade(self):
-        """ Upgrade the service to the latest version of the chart """        
-        billing_ok = self.service.get_billing_controller().can_deploy(self.service)
-        if not billing_ok:
+    @state.transition(
+        source=[ServiceStatus.RUNNING, ServiceStatus.DEGRADED, ServiceStatus.TO_UPGRADE, ServiceStatus.UPGRADING, ServiceStatus.UPGRADING_FAILED],
+        target=ServiceStatus.RUNNING)
+    def upgrade(self, force=False, billing_checked=False):
+        """ Upgrade the service to the latest version of the chart, skipped when its desired state was already applied unless forced """
+        if not billing_checked and not self.service.get_billing_controller().can_deploy(self.service):
             raise Exception(_("Billing failed"))
-        helm_command = [
-            "helm", "upgrade", "--install", "--reuse-values", "--atomic"]
+        if not force and not self.needs_node() and is_up_to_date(self.service):
+            logger.info("Service %s is up to date, skipping helm upgrade", self.service.pid)
+            return
+        helm_command = settings.HELM_COMMAND + ["upgrade", "--install", "--reuse-values", "--atomic"]
         if settings.DEBUG:
             helm_command += ["--debug"]
         if settings.DRY_RUN:
             helm_command += ["--dry-run"]
-        helm_command += [
+        helm_command += self.helm_release_args()
+        self.run_command(helm_command, "Helm")
+        self.mark_applied()
+
+    def helm_release_args(self, allocate=True):
+        """ Release name, chart, values, node and namespace arguments of helm upgrade and helm template """
+        return [
             str(self.service.pid),
-            self.service.template,
+            *self.helm_chart_args(),
+            "--values", values_resolver.values_file(self.service),
+            *self.node_args(allocate),
             "--namespace", self.service.namespace
         ]
-        result = subprocess.run(helm_command, check=True, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Helm command failed with return code {result.returncode}: {result.stderr}")
+
+    def mark_applied(self):
+        """ Remember the desired state helm just applied, saved with the service when the transition succeeds """
+        if not settings.DRY_RUN:
+            self.service.applied_fingerprint = desired_fingerprint(self.service)
+
+    def render_manifest(self) -> str:
+        """ Manifest helm would apply for the desired state of the service, without touching the cluster """
+        helm_command = settings.HELM_COMMAND + ["template", *self.helm_release_args(allocate=False)]
+        return subprocess.run(
+            helm_command, check=True, capture_output=True, text=True, env=helm_env(),
+            timeout=settings.OPERATION_TIMEOUT).stdout
+
+    def applied_manifest(self) -> str:
+        """ Manifest of the deployed release of the service """
+        helm_command = settings.HELM_COMMAND + [
+            "get", "manifest", str(self.service.pid), "--namespace", self.service.namespace]
+        return subprocess.run(
+            helm_command, check=True, capture_output=True, text=True, timeout=settings.KUBERNETES_TIMEOUT).stdout
         
-    @state.transition(source=ServiceStatus.RUNNING, target=ServiceStatus.STOPPED)
+    @state.transition(
+        source=[ServiceStatus.RUNNING, ServiceStatus.DEGRADED, ServiceStatus.STOPPING, ServiceStatus.STOPPING_FAILED],
+        target=ServiceStatus.STOPPED)
     def stop(self):
         """ Stop the service by deleting the running pod """
-        helm_command = [
-            "helm", "delete"]
-        helm_command += [
-            str(self.service.pid),
-            "--namespace", self.service.namespace,
-            "--wait"
-        ]
-        if settings.DEBUG:
-            helm_command += ["--debug"]
-        if settings.DRY_RUN:
-            helm_command += ["--dry-run"]
-        result = subprocess.run(helm_command, check=True, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Kubectl command failed with return code {result.returncode}: {result.stderr}")
+        self.uninstall_release(self.service.namespace, wait=True)
+        self.service.region.get_node_allocator().release(self.service)
+        self.service.applied_fingerprint = None
     
-    @state.transition(source=ServiceStatus.RUNNING, target=ServiceStatus.RUNNING)
+    @state.transition(
+        source=[ServiceStatus.RUNNING, ServiceStatus.DEGRADED, ServiceStatus.RESTARTING, ServiceStatus.RESTARTING_FAILED],
+        target=ServiceStatus.RUNNING)
     def restart(self):
-        """ Restart the service """
-        self.stop()
-        self.deploy()
+        """ Restart the pods of the service one by one, keeping the release and its resources in place """
+        self.restart_releases(self.service.namespace, [str(self.service.pid)], run_command=self.run_command)
+
+    @classmethod
+    def restart_releases(cls, namespace, release_names: List[str], run_command=stream_command):
+        """ Rolling restart of the workloads of many releases of a namespace with one kubectl call """
+        kubectl_command = settings.KUBECTL_COMMAND + [
+            "rollout", "restart", "deployments,statefulsets,daemonsets",
+            "--namespace", namespace, "--selector", releases_selector(release_names)]
+        if settings.DRY_RUN:
+            kubectl_command += ["--dry-run=server"]
+        run_command(kubectl_command, "Kubectl rollout")
         
-    @state.transition(source=ServiceStatus.RUNNING, target=ServiceStatus.ROLLING_BACK)
+    @state.transition(
+        source=[ServiceStatus.RUNNING, ServiceStatus.DEGRADED, ServiceStatus.UPGRADING_FAILED, ServiceStatus.ROLLING_BACK, ServiceStatus.ROLLING_BACK_FAILED],
+        target=ServiceStatus.RUNNING)
     def rollback(self):
         """ Rollback the service to the previous version """
         helm_command = settings.HELM_COMMAND + ["rollback", "0", str(self.service.pid)]
@@ -112,24 +573,266 @@ class ServiceController(IServiceController):
             helm_command += ["--debug"]
         if settings.DRY_RUN:
             helm_command += ["--dry-run"]
-        helm_command += ["--namespace", self.service.org.namespace]
-        result = subprocess.run(helm_command, check=True, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Helm rollback command failed with return code {result.returncode}: {result.stderr}")
+        helm_command += ["--namespace", self.service.namespace]
+        self.run_command(helm_command, "Helm rollback")
+        # The previous revision has values of its own, the next upgrade must apply the desired state again
+        self.service.applied_fingerprint = None
         
-    @state.transition(target=ServiceStatus.DESTROYED)
+    @state.transition(
+        source=[ServiceStatus.RUNNING, ServiceStatus.DEGRADED, ServiceStatus.BACKING_UP, ServiceStatus.BACKING_UP_FAILED],
+        target=ServiceStatus.RUNNING)
+    def backup(self):
+        """ Snapshot the volumes of the service into the backup store, the service keeps running """
+        backup_service(self)
+
+    @state.transition(
+        source=[ServiceStatus.RUNNING, ServiceStatus.DEGRADED, ServiceStatus.BACKING_UP_FAILED, ServiceStatus.RESTORING, ServiceStatus.RESTORING_FAILED],
+        target=ServiceStatus.RUNNING)
+    def restore(self, backup=None):
+        """ Replace the content of the volumes of the service with a backup, the latest successful one by default """
+        restore_service(self, backup)
+
+    def list_volumes(self) -> List[ServiceVolume]:
+        kubectl_command = settings.KUBECTL_COMMAND + [
+            "get", "pods", "--namespace", self.service.namespace,
+            "--selector", f"{RELEASE_LABEL}={self.service.pid}", "--output", "json"]
+        result = subprocess.run(
+            kubectl_command, check=True, capture_output=True, text=True, timeout=settings.KUBERNETES_TIMEOUT)
+        return release_volumes(json.loads(result.stdout or "{}").get("items", []))
+
+    def volume_exec(self, volume: ServiceVolume, *args):
+        return settings.KUBECTL_COMMAND + [
+            "exec", "--namespace", self.service.namespace, volume.pod, "--container", volume.container, *args]
+
+    @contextmanager
+    def read_volume(self, volume: ServiceVolume):
+        """ Tar stream of the content of a volume, read from the pod mounting it """
+        command = self.volume_exec(
+            volume, "--", "tar", "cf", "-", "-C", volume.path, f"--exclude=./{RESTORE_STAGING_DIR}", ".")
+        # GNU tar exits with 1 when files changed while they were read, expected on a running service
+        with exec_stream(command, timeout=settings.BACKUP_VOLUME_TIMEOUT, accepted_codes=(0, 1)) as stream:
+            yield stream
+
+    @contextmanager
+    def write_volume(self, volume: ServiceVolume):
+        """
+            Writable tar stream replacing the content of a volume, only verified against the store in dry run.
+            The archive is extracted in a staging directory of the volume, and the content of the volume is only
+            swapped for it once the archive arrived whole, so a failed restore leaves the volume as it was.
+            The volume needs room for both copies, and files the service writes during the swap are lost.
+        """
+        if settings.DRY_RUN:
+            with open(os.devnull, "wb") as stream:
+                yield stream
+            return
+        command = self.volume_exec(
+            volume, "--stdin", "--", "sh", "-c", RESTORE_SCRIPT, volume.path, RESTORE_STAGING_DIR, RESTORE_MARKER)
+        with exec_stream(command, stdin=True, timeout=settings.BACKUP_VOLUME_TIMEOUT) as stream:
+            yield stream
+
+    @state.transition(source=State.ANY, target=ServiceStatus.DESTROYED)
     def destroy(self):
         """ Destroy the service and all its resources from the cluster """
-        helm_command = settings.HELM_COMMAND + ["delete", str(self.service.pid)]
+        self.uninstall_release(self.service.namespace)
+        self.service.region.get_node_allocator().release(self.service)
+        self.service.applied_fingerprint = None
+
+    def uninstall_release(self, namespace, wait=False):
+        """ Delete the helm release of the service and the resources it owns """
+        helm_command = settings.HELM_COMMAND + ["delete", str(self.service.pid), "--namespace", namespace]
+        if wait:
+            helm_command += ["--wait"]
         if settings.DEBUG:
             helm_command += ["--debug"]
         if settings.DRY_RUN:
             helm_command += ["--dry-run"]
-        helm_command += ["--namespace", self.service.org.namespace]
-        result = subprocess.run(helm_command, check=True, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Helm delete command failed with return code {result.returncode}: {result.stderr}")
-        
+        self.run_command(helm_command, "Helm delete")
 
-    
-    
\ No newline at end of file
+
+class KubernetesServiceController(ServiceController):
+    """
+        Service controller that talks to the Kubernetes API over the pooled client of kube.py
+        for the operations that do not need the chart. Installing, upgrading and rolling back
+        a release still needs helm to render the chart, so those fall back to the helm command.
+    """
+
+    FALLBACK_RELEASE_RESOURCES = [
+        "/apis/apps/v1/namespaces/{namespace}/deployments",
+        "/apis/apps/v1/namespaces/{namespace}/statefulsets",
+        "/apis/apps/v1/namespaces/{namespace}/daemonsets",
+        "/apis/batch/v1/namespaces/{namespace}/cronjobs",
+        "/apis/batch/v1/namespaces/{namespace}/jobs",
+        "/apis/networking.k8s.io/v1/namespaces/{namespace}/ingresses",
+        "/api/v1/namespaces/{namespace}/services",
+        "/api/v1/namespaces/{namespace}/configmaps",
+        "/api/v1/namespaces/{namespace}/secrets",
+        "/api/v1/namespaces/{namespace}/serviceaccounts",
+    ]
+    """ Collections deleted by label when the release record is gone, persistent volume claims are kept """
+
+    RESTARTED_WORKLOADS = [
+        "/apis/apps/v1/namespaces/{namespace}/deployments",
+        "/apis/apps/v1/namespaces/{namespace}/statefulsets",
+        "/apis/apps/v1/namespaces/{namespace}/daemonsets",
+    ]
+    """ Collections whose pods are replaced by a restart """
+
+    @property
+    def kube(self) -> KubeClient:
+        return get_kube_client()
+
+    @property
+    def release_selector(self) -> str:
+        return f"{RELEASE_LABEL}={self.service.pid}"
+
+    @classmethod
+    def list_releases(cls, namespace) -> Dict[str, ReleaseState]:
+        """ List the releases of a namespace from the helm release secrets and the pods of the namespace """
+        kube = get_kube_client()
+        releases = {}
+        revisions = {}
+        for secret in kube.list(f"/api/v1/namespaces/{namespace}/secrets", labelSelector="owner=helm"):
+            labels = secret["metadata"].get("labels", {})
+            name, revision = labels.get("name"), int(labels.get("version", 0))
+            if name and revision >= revisions.get(name, 0):
+                revisions[name] = revision
+                releases[name] = ReleaseState(name=name, status=labels.get("status", "unknown"))
+        mark_unready_releases(releases, kube.list(f"/api/v1/namespaces/{namespace}/pods", labelSelector=RELEASE_LABEL))
+        return releases
+
+    def get_logs(self, since=None, tail=None, contains=None, container=None, follow=False) -> Iterator[LogLine]:
+        """
+            Stream the log of every container of the service. Pages merge the containers by time,
+            followed logs are interleaved as they arrive and the streams stay open while idle.
+        """
+        namespace = self.service.namespace
+        params = {"timestamps": "true"}
+        if since:
+            params["sinceTime"] = log_since_time(since)
+        if tail:
+            params["tailLines"] = tail
+        if follow:
+            params["follow"] = "true"
+        streams = [
+            (pod["metadata"]["name"], name)
+            for pod in self.kube.list(f"/api/v1/namespaces/{namespace}/pods", labelSelector=self.release_selector)
+            for name in ([container] if container else [c["name"] for c in pod["spec"]["containers"]])
+        ][:settings.SERVICE_LOG_MAX_STREAMS]
+        responses = []
+
+        def read(pod, name):
+            response = self.kube.request(
+                "GET", f"/api/v1/namespaces/{namespace}/pods/{pod}/log",
+                params={**params, "container": name}, stream=True,
+                timeout=(settings.KUBERNETES_TIMEOUT, None) if follow else None)
+            responses.append(response)
+            yield from cursor_logs(
+                parse_log_line(line, pod, name) for line in response.iter_lines(decode_unicode=True))
+
+        try:
+            if follow:
+                lines = self._interleave([read(pod, name) for pod, name in streams])
+            else:
+                lines = merge_logs([read(pod, name) for pod, name in streams])
+            yield from filter_logs(lines, since, contains)
+        finally:
+            for response in responses:
+                response.close()
+
+    @staticmethod
+    def _interleave(iterators) -> Iterator:
+        """
+            Yield the items of many blocking iterators as they arrive, reading each one from its own thread.
+            The first error of an iterator is raised, so the client reconnects instead of missing a stream.
+        """
+        items = queue.Queue(maxsize=1000)
+        done = object()
+
+        def pump(iterator):
+            try:
+                for item in iterator:
+                    items.put(item)
+            except Exception as e:
+                items.put(e)
+            finally:
+                items.put(done)
+
+        for iterator in iterators:
+            threading.Thread(target=pump, args=(iterator,), daemon=True).start()
+        remaining = len(iterators)
+        while remaining:
+            item = items.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+
+    def get_events(self, since=None, event_type=None) -> Iterator[ClusterEvent]:
+        params = {"fieldSelector": f"type={event_type}"} if event_type else {}
+        items = self.kube.list(f"/api/v1/namespaces/{self.service.namespace}/events", **params)
+        yield from release_events(items, str(self.service.pid), since)
+
+    def get_metrics(self) -> Iterator[MetricSample]:
+        items = self.kube.list(
+            f"/apis/metrics.k8s.io/v1beta1/namespaces/{self.service.namespace}/pods",
+            labelSelector=self.release_selector)
+        yield from metric_samples(items)
+
+    @classmethod
+    def restart_releases(cls, namespace, release_names: List[str], run_command=stream_command):
+        """ Rolling restart by patching the restart annotation of the pod template of every workload """
+        kube = get_kube_client()
+        patch = {"spec": {"template": {"metadata": {"annotations": {
+            RESTARTED_AT_ANNOTATION: timezone.now().isoformat()}}}}}
+        params = {"dryRun": "All"} if settings.DRY_RUN else {}
+        for path in cls.RESTARTED_WORKLOADS:
+            path = path.format(namespace=namespace)
+            for workload in kube.list(path, labelSelector=releases_selector(release_names)):
+                kube.patch(f"{path}/{workload['metadata']['name']}", patch, **params)
+
+    def release_record(self, namespace) -> Optional[Dict]:
+        """ Latest release record of the service, None when helm has no record of it """
+        secrets = self.kube.list(
+            f"/api/v1/namespaces/{namespace}/secrets", labelSelector=f"owner=helm,name={self.service.pid}")
+        latest = max(secrets, key=lambda secret: int(secret["metadata"]["labels"].get("version", 0)), default=None)
+        return decode_release(latest) if latest else None
+
+    def uninstall_release(self, namespace, wait=False):
+        """
+            Delete the objects of the release, as listed by the manifest and hooks of its latest release record,
+            in reverse order of installation, then the release records. Without a record the objects are deleted
+            by label from the usual collections.
+        """
+        params = {"dryRun": "All"} if settings.DRY_RUN else {}
+        release = self.release_record(namespace)
+        if release is not None:
+            for obj in reversed(release_objects(release)):
+                metadata = obj.get("metadata", {})
+                path = self.kube.resource_path(
+                    obj["apiVersion"], obj["kind"], metadata.get("namespace") or namespace, metadata["name"])
+                if path is None:
+                    logger.warning("Kind %s/%s of release %s is not served by the cluster",
+                                   obj["apiVersion"], obj["kind"], self.service.pid)
+                    continue
+                self.kube.delete(path, **params)
+        else:
+            for path in self.FALLBACK_RELEASE_RESOURCES:
+                self.kube.delete_collection(
+                    path.format(namespace=namespace), labelSelector=self.release_selector, **params)
+        self.kube.delete_collection(
+            f"/api/v1/namespaces/{namespace}/secrets",
+            labelSelector=f"owner=helm,name={self.service.pid}", **params)
+        if wait and not settings.DRY_RUN:
+            self._wait_for_pods_deleted(namespace)
+
+    def _wait_for_pods_deleted(self, namespace):
+        deadline = time.monotonic() + settings.KUBERNETES_TIMEOUT
+        while time.monotonic() < deadline:
+            pods = self.kube.get(
+                f"/api/v1/namespaces/{namespace}/pods", labelSelector=self.release_selector, limit=1)
+            if not pods.get("items"):
+                return
+            time.sleep(1)
+        raise Exception(_("Timed out waiting for the pods of the service to be deleted"))
@@ -0,0 +1,231 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from usop.lib.CachedClassUtil import CachedClassUtil
+
+
+logger = logging.getLogger(__name__)
+
+
+CREATED = "created"
+UPDATED = "updated"
+TRANSITION = "transition"
+
+
+@dataclass(frozen=True)
+class Event:
+    """ A lifecycle event of a platform object """
+
+    event_type: str
+    """ One of created, updated or transition """
+
+    model: str
+    """ Name of the model of the object """
+
+    object_id: Optional[int]
+    """ Primary key of the object, None for events about many objects """
+
+    label: str = ""
+    """ User facing label of the object """
+
+    source: Optional[str] = None
+    """ Status before a transition """
+
+    target: Optional[str] = None
+    """ Status after a transition """
+
+    operation: Optional[str] = None
+    """ Name of the operation that caused the transition """
+
+    count: int = 1
+    """ Number of objects affected, for bulk writes """
+
+    org_id: Optional[int] = None
+    """ Org owning the object, when there is one """
+
+    objects: Tuple[Tuple[int, Optional[int]], ...] = ()
+    """ Primary key and org of every object of an event about many objects """
+
+    created: datetime = field(default_factory=timezone.now)
+
+
+class EventSink:
+    """ Destination of batches of lifecycle events """
+
+    def write(self, events: List[Event]):
+        raise NotImplementedError
+
+
+class LoggingEventSink(EventSink):
+    """ Writes every event as a structured log record """
+
+    logger = logging.getLogger("usop.lifecycle")
+
+    def write(self, events: List[Event]):
+        for event in events:
+            self.logger.info(
+                "%s %s %s %s", event.model, event.object_id, event.event_type,
+                f"{event.source}->{event.target}" if event.event_type == TRANSITION else "",
+                extra={"event": asdict(event)})
+
+
+class DatabaseEventSink(EventSink):
+    """ Stores the events with one bulk insert per batch """
+
+    def write(self, events: List[Event]):
+        from .models import LifecycleEvent
+        LifecycleEvent.objects.bulk_create([
+            LifecycleEvent(
+                event_type=event.event_type,
+                model=event.model,
+                object_id=event.object_id,
+                label=event.label[:256],
+                source=event.source,
+                target=event.target,
+                operation=event.operation,
+                count=event.count,
+                org_id=event.org_id,
+                created=event.created,
+            )
+            for event in events
+        ])
+
+
+class PubSubEventSink(EventSink):
+    """ Publishes service transitions to the status channels read by the status streams """
+
+    def write(self, events: List[Event]):
+        from .pubsub import publish_transition
+        for event in events:
+            if event.event_type != TRANSITION or event.model != "Service":
+                continue
+            if event.object_id is not None:
+                publish_transition(event, event.object_id, event.org_id, event.label)
+            for object_id, org_id in event.objects:
+                publish_transition(event, object_id, org_id)
+
+
+class EventPipeline:
+    """
+        Buffers lifecycle events in memory and writes them to the configured sinks in batches,
+        from a background thread. Emitting never blocks, events are dropped when the buffer is full.
+        Events emitted inside a transaction are buffered once it commits, and never if it rolls back.
+    """
+
+    def __init__(self, sink_paths: List[str], batch_size: int = 200, flush_interval: float = 2.0,
+                 max_queue: int = 10000):
+        self.sink_paths = sink_paths
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue: "queue.Queue[Event]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+
+    def emit(self, event: Event):
+        if getattr(self._local, "suppressed", 0):
+            return
+        transaction.on_commit(lambda: self._put(event))
+
+    def _put(self, event: Event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self._ensure_thread()
+
+    @contextmanager
+    def suppress(self):
+        """ Do not emit events from the current thread, ex: while saving rows in a loop """
+        self._local.suppressed = getattr(self._local, "suppressed", 0) + 1
+        try:
+            yield
+        finally:
+            self._local.suppressed -= 1
+
+    def _ensure_thread(self):
+        # Started on first use, so every forked worker process gets its own thread
+        if self._thread is None or not self._thread.is_alive():
+            with self._thread_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="usop-events", daemon=True)
+                    self._thread.start()
+
+    def _drain(self) -> List[Event]:
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List[Event]):
+        if not batch:
+            return
+        with self._write_lock:
+            for sink_path in self.sink_paths:
+                try:
+                    CachedClassUtil.get_instance(sink_path).write(batch)
+                except Exception:
+                    logger.exception("Lifecycle event sink %s failed to write %d events", sink_path, len(batch))
+
+    def _run(self):
+        while True:
+            # Wait for the first event, then for a full batch or the flush interval
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def flush(self):
+        """ Write all the buffered events from the calling thread """
+        while not self._queue.empty():
+            self._write(self._drain())
+
+
+pipeline = EventPipeline(
+    settings.LIFECYCLE_EVENT_SINKS,
+    batch_size=settings.LIFECYCLE_EVENT_BATCH_SIZE,
+    flush_interval=settings.LIFECYCLE_EVENT_FLUSH_INTERVAL,
+    max_queue=settings.LIFECYCLE_EVENT_QUEUE_SIZE,
+)
+""" Process wide event pipeline """
+
+atexit.register(pipeline.flush)
+
+
+def emit_transition(service, source: str, target: str, operation: Optional[str] = None):
+    """ Emit a status transition of a service """
+    pipeline.emit(Event(
+        event_type=TRANSITION, model="Service", object_id=service.pk, label=str(service),
+        source=source, target=target, operation=operation, org_id=service.org_id))
+
+
+def emit_bulk_transition(source: str, target: str, services: List[Tuple[int, Optional[int]]],
+                         operation: Optional[str] = None):
+    """ Emit a single event for a status transition applied to many services, by primary key and org, with one write """
+    pipeline.emit(Event(
+        event_type=TRANSITION, model="Service", object_id=None, label=f"{len(services)} services",
+        source=source, target=target, operation=operation, count=len(services), objects=tuple(services)))
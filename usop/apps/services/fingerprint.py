@@ -0,0 +1,96 @@
+import difflib
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import QuerySet
+
+from .values import values_resolver
+
+
+def desired_fingerprint(service) -> Optional[str]:
+    """
+        Digest of everything helm receives for the service: the chart reference, the effective values,
+        the namespace and the node it is pinned to. None when the service has no template version to deploy.
+    """
+    version = service.template_version
+    if version is None:
+        return None
+    state = {
+        "chart": version.template.chart_id,
+        "repo": version.helm_repo,
+        "version": version.version_name,
+        "values": values_resolver.digest(service),
+        "namespace": service.namespace,
+        "node": service.node_id,
+    }
+    encoded = json.dumps(state, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def is_up_to_date(service) -> bool:
+    """ Wether the desired state of the service is the one last applied, so an upgrade would change nothing """
+    return service.applied_fingerprint is not None and service.applied_fingerprint == desired_fingerprint(service)
+
+
+@dataclass
+class UpgradePlan:
+    """ What an upgrade would change on a single service """
+
+    service_id: int
+    name: str
+    region: str
+    changed: bool
+    reason: str
+    diff: List[str] = field(default_factory=list)
+    """ Unified diff of the deployed and rendered manifests, only in render mode """
+
+
+def plan_service(service, render: bool = False) -> UpgradePlan:
+    plan = UpgradePlan(
+        service_id=service.pk, name=service.name, region=service.region.name, changed=True, reason="")
+    if not render:
+        if service.applied_fingerprint is None:
+            plan.reason = "Never applied"
+        elif is_up_to_date(service):
+            plan.changed, plan.reason = False, "Unchanged"
+        else:
+            plan.reason = "Chart or values changed"
+        return plan
+    try:
+        controller = service.get_service_controller()
+        deployed = controller.applied_manifest().splitlines(keepends=True)
+        rendered = controller.render_manifest().splitlines(keepends=True)
+    except Exception as e:
+        plan.reason = f"Could not render: {e}"
+        return plan
+    plan.diff = list(difflib.unified_diff(deployed, rendered, "deployed", "rendered"))
+    plan.changed = bool(plan.diff)
+    plan.reason = "Manifests differ" if plan.changed else "Unchanged"
+    return plan
+
+
+def plan_upgrades(queryset: QuerySet, render: bool = False, concurrency: Optional[int] = None) -> List[UpgradePlan]:
+    """
+        Report the services of the queryset an upgrade would change. By default the fingerprints are compared,
+        which needs no helm call. In render mode every chart is rendered with helm template and diffed
+        against the manifest of the deployed release, which also catches changes made outside USOP.
+    """
+    services = list(queryset.with_deployment_context().select_related("node"))
+    if not render:
+        return [plan_service(service) for service in services]
+
+    def run(service):
+        close_old_connections()
+        try:
+            return plan_service(service, render=True)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=concurrency or settings.BULK_CONCURRENCY,
+                            thread_name_prefix="usop-plan") as pool:
+        return list(pool.map(run, services))
@@ -1,4 +1,98 @@
-from typing import List
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+
+
+@dataclass
+class ReleaseState:
+    """Observed state of the release of a service in the cluster"""
+
+    name: str
+    """ Release name, the pid of the service """
+
+    status: str
+    """ Helm release status, ex: deployed, failed, pending-upgrade """
+
+    ready: bool = True
+    """ Wether all the pods of the release are running and ready """
+
+
+@dataclass
+class LogLine:
+    """A line printed by a container of a service"""
+
+    cursor: str
+    """ Position of the line: timestamp|pod|container|rank among the lines of that timestamp, pass it as since to read the lines after it """
+
+    pod: str
+    container: str
+    message: str
+    time: str = ""
+    """ Timestamp printed by the container runtime """
+
+
+@dataclass
+class ClusterEvent:
+    """A kubernetes event about one of the objects of a service"""
+
+    cursor: str
+    """ Time of the last occurrence of the event, pass it as since to read the events after it """
+
+    type: str
+    """ Normal or Warning """
+
+    reason: str
+    object: str
+    """ Kind and name of the object, ex: Pod/web-0 """
+
+    message: str
+    count: int = 1
+
+
+@dataclass
+class MetricSample:
+    """Resource usage of a container of a service, from the metrics API"""
+
+    cursor: str
+    """ Time the sample was taken """
+
+    pod: str
+    container: str
+    cpu: int
+    """ CPU millicores """
+
+    memory: int
+    """ Memory bytes """
+
+
+@dataclass
+class ServiceVolume:
+    """A persistent volume claim mounted by a pod of a service"""
+
+    claim: str
+    """ Name of the persistent volume claim, stable across releases of the service """
+
+    pod: str
+    container: str
+    path: str
+    """ Mount path of the claim in the container """
+
+
+class IObjectStore:
+    """Interfaces for an object store receiving the chunks and manifests of the backups"""
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def put(self, key: str, data: bytes):
+        """Store the object, replacing any object with the same key"""
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        """Content of the object, raises KeyError when it doesn't exist"""
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
 
 
 class IServiceController:
@@ -10,10 +104,11 @@ class IServiceController:
 
     # State transitions
 
-    def deploy(self):
+    def deploy(self, billing_checked: bool = False):
+        """ billing_checked is set when the caller already checked billing for a whole batch """
         raise NotImplementedError
 
-    def upgrade(self):
+    def upgrade(self, force: bool = False, billing_checked: bool = False):
         raise NotImplementedError
 
     def stop(self):
@@ -32,9 +127,15 @@ class IServiceController:
         raise NotImplementedError
 
     def backup(self):
+        """Snapshot the volumes of the service while it keeps running"""
         raise NotImplementedError
 
-    def restore(self):
+    def restore(self, backup=None):
+        """Replace the content of the volumes of the service with a backup, the latest one by default"""
+        raise NotImplementedError
+
+    def list_volumes(self) -> List[ServiceVolume]:
+        """Persistent volume claims mounted by the pods of the service"""
         raise NotImplementedError
 
     # Settings interaction
@@ -59,13 +160,20 @@ class IServiceController:
 
     # Retriving data
 
-    def get_logs(self) -> List[str]:
+    def get_logs(self, since: Optional[str] = None, tail: Optional[int] = None, contains: Optional[str] = None,
+                 container: Optional[str] = None, follow: bool = False) -> Iterator[LogLine]:
+        """
+            Lines of the containers of the service after the since cursor, oldest first unless followed,
+            optionally only the last tail ones. since is the cursor of a line or a bare timestamp.
+        """
         raise NotImplementedError
 
-    def get_metrics(self) -> List[str]:
+    def get_metrics(self) -> Iterator[MetricSample]:
+        """Current resource usage of every container of the service"""
         raise NotImplementedError
 
-    def get_events(self) -> List[str]:
+    def get_events(self, since: Optional[str] = None, event_type: Optional[str] = None) -> Iterator[ClusterEvent]:
+        """Events of the objects of the service after the since cursor, oldest first"""
         raise NotImplementedError
 
     def get_resources(self):
@@ -74,6 +182,11 @@ class IServiceController:
     def monitor(self):
         raise NotImplementedError
 
+    @classmethod
+    def list_releases(cls, namespace) -> Dict[str, ReleaseState]:
+        """List the state of all the releases of a namespace with as few cluster calls as possible"""
+        raise NotImplementedError
+
     # Store log
 
     def alert(self, message):
@@ -86,8 +199,26 @@ class IServiceController:
         raise NotImplementedError
 
 
+@dataclass
+class BillingState:
+    """Billing and quota state of an org, as reported by the billing backend"""
+
+    allowed: bool = True
+    """ Wether the org can run services, ex: its subscription is paid """
+
+    reason: str = ""
+    """ Why the org can't run services """
+
+    max_services: Optional[int] = None
+    """ Number of services the org can have deployed, None for no limit """
+
+
 class IBillingController:
     """Interface for a controller that manages the billing of a service"""
 
-    def can_deploy(self, service):
+    def can_deploy(self, service) -> bool:
+        raise NotImplementedError
+
+    def can_deploy_many(self, services) -> Dict[int, bool]:
+        """ Wether each service, by primary key, can be deployed, looking up the billing state of every org once """
         raise NotImplementedError
\ No newline at end of file
@@ -0,0 +1,167 @@
+import os
+import threading
+from typing import Dict, Iterator, Optional, Tuple
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+SERVICE_ACCOUNT_DIR = "/var/run/secrets/kubernetes.io/serviceaccount"
+
+
+class KubeApiError(Exception):
+    """ Raised when the Kubernetes API answers with an error status """
+
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        super().__init__(f"Kubernetes API error {status_code}: {message}")
+
+
+class KubeClient:
+    """
+        Small Kubernetes API client that keeps a pool of persistent HTTP connections.
+        A single instance is shared by all the controllers of a process, see get_kube_client.
+    """
+
+    def __init__(self, server: str, token: Optional[str] = None, ca_file: Optional[str] = None,
+                 verify: bool = True, pool_size: int = 10, timeout: float = 30):
+        self.server = server.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=None),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+        self.session.verify = ca_file if (verify and ca_file) else verify
+        self._discovery: Dict[str, Dict[str, Tuple[str, bool]]] = {}
+        self._discovery_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "KubeClient":
+        """ Build a client from the KUBERNETES_* settings, defaulting to the in-cluster service account """
+        server = settings.KUBERNETES_API_URL
+        if not server:
+            host = os.environ.get("KUBERNETES_SERVICE_HOST")
+            port = os.environ.get("KUBERNETES_SERVICE_PORT", "443")
+            if not host:
+                raise KubeApiError(0, "KUBERNETES_API_URL is not set and not running inside a cluster")
+            server = f"https://{host}:{port}"
+
+        token = settings.KUBERNETES_TOKEN
+        token_file = os.path.join(SERVICE_ACCOUNT_DIR, "token")
+        if not token and os.path.exists(token_file):
+            with open(token_file) as f:
+                token = f.read().strip()
+
+        ca_file = settings.KUBERNETES_CA_FILE
+        if not ca_file and os.path.exists(os.path.join(SERVICE_ACCOUNT_DIR, "ca.crt")):
+            ca_file = os.path.join(SERVICE_ACCOUNT_DIR, "ca.crt")
+
+        return cls(
+            server,
+            token=token,
+            ca_file=ca_file,
+            verify=settings.KUBERNETES_VERIFY_SSL,
+            pool_size=settings.KUBERNETES_POOL_SIZE,
+            timeout=settings.KUBERNETES_TIMEOUT,
+        )
+
+    def request(self, method: str, path: str, params: Optional[Dict] = None, json=None,
+                content_type: Optional[str] = None, stream: bool = False, timeout=None) -> requests.Response:
+        """ Send a request, timeout overrides the one of the client, ex: (connect, None) for long lived watches """
+        headers = {"Content-Type": content_type} if content_type else None
+        response = self.session.request(
+            method, self.server + path, params=params, json=json, headers=headers,
+            stream=stream, timeout=timeout or self.timeout)
+        if response.status_code >= 400:
+            raise KubeApiError(response.status_code, response.text)
+        return response
+
+    def get(self, path: str, **params) -> Dict:
+        return self.request("GET", path, params=params).json()
+
+    def list(self, path: str, **params) -> Iterator[Dict]:
+        """ Iterate over all the items of a list call, following the continue token of each page """
+        params.setdefault("limit", 500)
+        while True:
+            page = self.get(path, **params)
+            yield from page.get("items", [])
+            token = page.get("metadata", {}).get("continue")
+            if not token:
+                return
+            params["continue"] = token
+
+    def patch(self, path: str, body: Dict, **params) -> Dict:
+        return self.request(
+            "PATCH", path, params=params, json=body, content_type="application/merge-patch+json").json()
+
+    def delete(self, path: str, **params) -> None:
+        """ Delete a single object, objects already gone are ignored """
+        params.setdefault("propagationPolicy", "Foreground")
+        try:
+            self.request("DELETE", path, params=params)
+        except KubeApiError as e:
+            if e.status_code != 404:
+                raise
+
+    def resource_path(self, api_version: str, kind: str, namespace: Optional[str], name: str) -> Optional[str]:
+        """
+            Path of an object from its apiVersion and kind, resolved with the discovery API of its group version.
+            None when the cluster does not serve the kind, ex: the CRD of a chart was removed.
+        """
+        resources = self._discover(api_version)
+        if kind not in resources:
+            return None
+        plural, namespaced = resources[kind]
+        base = f"/api/{api_version}" if "/" not in api_version else f"/apis/{api_version}"
+        if namespaced:
+            base += f"/namespaces/{namespace}"
+        return f"{base}/{plural}/{name}"
+
+    def _discover(self, api_version: str) -> Dict[str, Tuple[str, bool]]:
+        """ Plural name and scope of every kind of a group version, cached for the life of the client """
+        with self._discovery_lock:
+            if api_version not in self._discovery:
+                path = f"/api/{api_version}" if "/" not in api_version else f"/apis/{api_version}"
+                try:
+                    resources = self.get(path).get("resources", [])
+                except KubeApiError as e:
+                    if e.status_code != 404:
+                        raise
+                    resources = []
+                self._discovery[api_version] = {
+                    resource["kind"]: (resource["name"], resource["namespaced"])
+                    for resource in resources
+                    # Subresources like deployments/scale share the kind of their parent
+                    if "/" not in resource["name"]
+                }
+            return self._discovery[api_version]
+
+    def delete_collection(self, path: str, **params) -> None:
+        params.setdefault("propagationPolicy", "Foreground")
+        try:
+            self.request("DELETE", path, params=params)
+        except KubeApiError as e:
+            if e.status_code != 404:
+                raise
+
+
+_client: Optional[KubeClient] = None
+_client_lock = threading.Lock()
+
+
+def get_kube_client() -> KubeClient:
+    """ Get the process wide Kubernetes client, creating it on first use """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = KubeClient.from_settings()
+    return _client
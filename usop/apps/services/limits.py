@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+
+
+logger = logging.getLogger(__name__)
+
+
+class OperationLimitTimeout(Exception):
+    """ Raised when a slot for a lifecycle operation could not be acquired in time """
+
+
+# KEYS semaphore keys. ARGV: token, now, lease expiry, then the limit of every key
+ACQUIRE_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', ARGV[2])
+    if redis.call('ZCARD', key) >= tonumber(ARGV[3 + i]) then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, ARGV[3], ARGV[1])
+    redis.call('EXPIRE', key, math.ceil(ARGV[3] - ARGV[2]) + 60)
+end
+return 1
+"""
+
+# KEYS semaphore keys. ARGV: token, now, lease expiry. Returns the number of keys still held
+RENEW_SCRIPT = """
+local held = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('ZSCORE', key, ARGV[1]) then
+        redis.call('ZADD', key, ARGV[3], ARGV[1])
+        redis.call('EXPIRE', key, math.ceil(ARGV[3] - ARGV[2]) + 60)
+        held = held + 1
+    end
+end
+return held
+"""
+
+# KEYS[1] bucket key. ARGV: capacity, refill per second, now
+TOKEN_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return allowed
+"""
+
+
+class RedisLimiter:
+    """
+        Distributed semaphores and token buckets stored in Redis, shared by all the web and Celery processes.
+        Semaphore holders are kept in a sorted set scored by the expiry of their lease, so slots of crashed
+        workers are freed when the lease ends. The slots of an operation are acquired all at once or not at all.
+    """
+
+    def __init__(self, url: str):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self._acquire = self.redis.register_script(ACQUIRE_SCRIPT)
+        self._renew = self.redis.register_script(RENEW_SCRIPT)
+        self._take = self.redis.register_script(TOKEN_SCRIPT)
+
+    def try_acquire(self, limits: List[Tuple[str, int]], token: str) -> bool:
+        now = time.time()
+        return bool(self._acquire(
+            keys=[key for key, limit in limits],
+            args=[token, now, now + settings.LIMITER_LEASE_SECONDS, *[limit for key, limit in limits]]))
+
+    def renew(self, keys: List[str], token: str) -> bool:
+        """ Extend the lease of the slots, False when some of them were lost """
+        now = time.time()
+        return self._renew(keys=keys, args=[token, now, now + settings.LIMITER_LEASE_SECONDS]) == len(keys)
+
+    def release(self, keys: List[str], token: str):
+        with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.zrem(key, token)
+            pipe.execute()
+
+    def try_take(self, key: str, per_minute: int) -> bool:
+        return bool(self._take(keys=[key], args=[per_minute, per_minute / 60, time.time()]))
+
+
+class LocalLimiter:
+    """ Process local fallback of RedisLimiter, used when the broker is not Redis """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._holders: Dict[str, set] = {}
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    def try_acquire(self, limits: List[Tuple[str, int]], token: str) -> bool:
+        with self._lock:
+            if any(len(self._holders.get(key, ())) >= limit for key, limit in limits):
+                return False
+            for key, limit in limits:
+                self._holders.setdefault(key, set()).add(token)
+            return True
+
+    def renew(self, keys: List[str], token: str) -> bool:
+        # Slots of a process can't outlive it, there is no lease to extend
+        return True
+
+    def release(self, keys: List[str], token: str):
+        with self._lock:
+            for key in keys:
+                self._holders.get(key, set()).discard(token)
+
+    def try_take(self, key: str, per_minute: int) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            tokens, ts = self._buckets.get(key, (per_minute, now))
+            tokens = min(per_minute, tokens + (now - ts) * per_minute / 60)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            return allowed
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    """ Process wide limiter, on the Redis instance of the Celery broker when there is one """
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                url = settings.LIMITER_REDIS_URL or settings.CELERY_BROKER_URL
+                if url and url.startswith(("redis://", "rediss://", "unix://")):
+                    _limiter = RedisLimiter(url)
+                else:
+                    logger.warning("Operation limits are local to the process, set LIMITER_REDIS_URL to share them")
+                    _limiter = LocalLimiter()
+    return _limiter
+
+
+def service_limits(service) -> List[Tuple[str, int]]:
+    """ Semaphore keys and sizes that apply to the operations of a service """
+    region = service.region
+    return [
+        (f"usop:limit:region:{region.pk}",
+         region.max_operations or settings.LIMITER_REGION_CONCURRENCY),
+        (f"usop:limit:namespace:{region.pk}:{service.namespace}",
+         region.max_namespace_operations or settings.LIMITER_NAMESPACE_CONCURRENCY),
+        (f"usop:limit:org:{service.org.namespace}",
+         settings.LIMITER_ORG_CONCURRENCY),
+    ]
+
+
+@contextmanager
+def operation_slot(service, timeout: Optional[float] = None):
+    """
+        Hold a slot in the region, namespace and org namespace of the service for the duration of an operation,
+        after taking a token from the rate bucket of the region. Waits up to timeout seconds, forever if None.
+        The three slots are taken together, so an operation waiting on a full org holds no region or namespace
+        slot meanwhile, and their lease is renewed in the background for as long as the operation runs.
+    """
+    limiter = get_limiter()
+    token = str(uuid.uuid4())
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def wait(check, description):
+        while not check():
+            if deadline is not None and time.monotonic() >= deadline:
+                raise OperationLimitTimeout(
+                    _("No slot available for service %(service)s: %(limit)s") % {
+                        "service": service, "limit": description})
+            time.sleep(settings.LIMITER_POLL_INTERVAL)
+
+    region = service.region
+    per_minute = region.operations_per_minute or settings.LIMITER_REGION_OPERATIONS_PER_MINUTE
+    if per_minute:
+        wait(lambda: limiter.try_take(f"usop:rate:region:{region.pk}", per_minute), "region rate")
+
+    limits = service_limits(service)
+    keys = [key for key, limit in limits]
+    wait(lambda: limiter.try_acquire(limits, token), ", ".join(keys))
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(settings.LIMITER_LEASE_SECONDS / 3):
+            try:
+                if not limiter.renew(keys, token):
+                    logger.warning("Lost the operation slots of service %s, the limits may be exceeded", service)
+            except Exception:
+                logger.exception("Could not renew the operation slots of service %s", service)
+
+    renewer = threading.Thread(target=renew, name="usop-limit-renew", daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        renewer.join()
+        limiter.release(keys, token)
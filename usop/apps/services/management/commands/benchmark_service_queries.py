@@ -0,0 +1,75 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from usop.apps.services.models import Region, Service, Template, TemplateSKU, TemplateVersion
+from usop.apps.services.reconcile import RECONCILED_STATUSES
+from usop.apps.services.status import ServiceStatus
+from usop.apps.users.models import Org, User
+
+
+class Command(BaseCommand):
+    help = "Show the query plan and timing of the hot service lookups"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=0,
+                            help="Insert this many synthetic services first, they are rolled back at the end")
+        parser.add_argument("--repeat", type=int, default=20, help="Times each query is run to measure it")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options["rows"]:
+                self.seed(options["rows"])
+            service = Service.objects.order_by("?").first()
+            if service is None:
+                raise CommandError("There are no services, use --rows to insert synthetic ones")
+
+            queries = {
+                "org dashboard": Service.objects.filter(org_id=service.org_id, status=ServiceStatus.RUNNING),
+                "region reconciliation": Service.objects.filter(
+                    region_id=service.region_id, status__in=RECONCILED_STATUSES),
+                "template version rollout": Service.objects.filter(
+                    template_version_id=service.template_version_id, status=ServiceStatus.RUNNING),
+                "upgrade queue": Service.objects.filter(status=ServiceStatus.TO_UPGRADE),
+            }
+            for label, queryset in queries.items():
+                queryset = queryset.order_by()
+                started = time.perf_counter()
+                for _ in range(options["repeat"]):
+                    list(queryset.values_list("id", flat=True))
+                elapsed = (time.perf_counter() - started) / options["repeat"] * 1000
+                self.stdout.write(self.style.MIGRATE_HEADING(f"{label}: {elapsed:.2f} ms"))
+                self.stdout.write(queryset.explain())
+                self.stdout.write("")
+
+            transaction.set_rollback(True)
+
+    def seed(self, rows):
+        user = User.objects.create_user(email="benchmark@usop.local", username="usop-benchmark")
+        orgs = [Org.objects.create(name=f"benchmark {i}", admin_user=user) for i in range(max(rows // 100, 1))]
+        regions = [Region.objects.create(name=f"benchmark {i}", disabled=False) for i in range(5)]
+        template = Template.objects.create(name="benchmark", chart_id="benchmark/chart")
+        versions = [
+            TemplateVersion.objects.create(template=template, version_name=f"1.{i}", helm_repo="https://example.com")
+            for i in range(10)
+        ]
+        sku = TemplateSKU.objects.create(template=template, name="benchmark", region=regions[0], org=orgs[0])
+        # Most of a real fleet is running, with a small share in every other status
+        statuses = [ServiceStatus.RUNNING] * 80 + [ServiceStatus.STOPPED] * 10 + list(ServiceStatus.values)
+        Service.objects.bulk_create(
+            [
+                Service(
+                    name=f"benchmark {i}",
+                    org=random.choice(orgs),
+                    region=random.choice(regions),
+                    template_sku=sku,
+                    template_version=random.choice(versions),
+                    status=random.choice(statuses),
+                )
+                for i in range(rows)
+            ],
+            batch_size=1000,
+        )
+        self.stdout.write(f"Inserted {rows} services")
@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from usop.apps.services.bulk import BulkOperation, restart_in_batches
+from usop.apps.services.fingerprint import plan_upgrades
+from usop.apps.services.models import Service
+from usop.apps.services.status import ServiceStatus
+from usop.apps.services.tasks import TRANSITION_STATES
+
+
+class Command(BaseCommand):
+    help = "Run a lifecycle operation over many services in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument("operation", choices=sorted(TRANSITION_STATES))
+        parser.add_argument("--status", choices=ServiceStatus.values, help="Only services in this status")
+        parser.add_argument("--template-version", type=int, help="Only services on this template version id")
+        parser.add_argument("--region", help="Only services in this region name")
+        parser.add_argument("--org", help="Only services owned by this org ext id")
+        parser.add_argument("--concurrency", type=int, help="Maximum number of parallel operations")
+        parser.add_argument("--per-region", type=int, help="Maximum number of parallel operations per region")
+        parser.add_argument("--per-namespace", type=int, help="Maximum number of parallel operations per namespace")
+        parser.add_argument("--batch", action="store_true",
+                            help="Restart the services of each namespace with one rollout call per batch")
+        parser.add_argument("--batch-size", type=int, help="Maximum number of services restarted by one call")
+        parser.add_argument("--dry-run", action="store_true", help="Only list the matching services")
+        parser.add_argument("--plan", action="store_true",
+                            help="Only report the services an upgrade would change, comparing their fingerprints")
+        parser.add_argument("--render", action="store_true",
+                            help="With --plan, render the charts and diff them against the deployed manifests")
+        parser.add_argument("--force", action="store_true", help="Upgrade even the services that look unchanged")
+
+    def handle(self, *args, **options):
+        queryset = Service.objects.all()
+        if options["status"]:
+            queryset = queryset.filter(status=options["status"])
+        if options["template_version"]:
+            queryset = queryset.filter(template_version_id=options["template_version"])
+        if options["region"]:
+            queryset = queryset.filter(region__name=options["region"])
+        if options["org"]:
+            queryset = queryset.filter(org__extid=options["org"])
+
+        if options["dry_run"]:
+            for service in queryset.select_related("region"):
+                self.stdout.write(f"{service.pid}\t{service.name}\t{service.region}\t{service.status}")
+            self.stdout.write(f"{queryset.count()} services match")
+            return
+
+        if options["plan"]:
+            if options["operation"] != "upgrade":
+                raise CommandError("Only the upgrade operation supports --plan")
+            plans = plan_upgrades(queryset, render=options["render"], concurrency=options["concurrency"])
+            for plan in sorted(plans, key=lambda p: (not p.changed, p.region, p.name)):
+                style = self.style.WARNING if plan.changed else self.style.SUCCESS
+                self.stdout.write(style(f"{'changed' if plan.changed else 'unchanged'}\t{plan.name}\t{plan.region}\t{plan.reason}"))
+                for line in plan.diff:
+                    self.stdout.write(line.rstrip("\n"))
+            self.stdout.write(f"{sum(p.changed for p in plans)} of {len(plans)} services would change")
+            return
+
+        if options["batch"]:
+            if options["operation"] != "restart":
+                raise CommandError("Only the restart operation supports --batch")
+            results = restart_in_batches(queryset, options["batch_size"], progress=self.report_progress)
+        else:
+            operation = BulkOperation(
+                queryset,
+                options["operation"],
+                concurrency=options["concurrency"],
+                per_region=options["per_region"],
+                per_namespace=options["per_namespace"],
+                progress=self.report_progress,
+                force=options["force"],
+            )
+            results = operation.run()
+
+        summary = BulkOperation.summarize(results)
+        self.stdout.write("")
+        for result in sorted(results, key=lambda r: (r.outcome, r.region, r.name)):
+            if result.outcome not in ("ok", "unchanged"):
+                self.stdout.write(f"{result.outcome}\t{result.name}\t{result.region}\t{result.error}")
+        self.stdout.write(", ".join(f"{outcome}: {count}" for outcome, count in sorted(summary.items())))
+        if summary.get("failed"):
+            raise CommandError(f"{summary['failed']} services failed to {options['operation']}")
+
+    def report_progress(self, done, total, result):
+        style = self.style.SUCCESS if result.outcome == "ok" else self.style.WARNING
+        self.stdout.write(style(
+            f"[{done}/{total}] {result.name} ({result.region}/{result.namespace}) "
+            f"{result.outcome} -> {result.status} in {result.duration:.1f}s"))
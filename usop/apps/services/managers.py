@@ -0,0 +1,22 @@
+from django.db import models
+
+
+class ServiceQuerySet(models.QuerySet):
+    """Custom queryset for the Service model."""
+
+    DEPLOYMENT_CONTEXT = [
+        "region",
+        "org",
+        "template_sku",
+        "template_sku__template",
+        "template_version",
+        "template_version__template",
+    ]
+    """ Relations read by the controllers and the namespace of a service """
+
+    def with_deployment_context(self):
+        """
+        Load the relations needed to deploy or list services in the same query,
+        so looping over the services doesn't issue queries per row.
+        """
+        return self.select_related(*self.DEPLOYMENT_CONTEXT)
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0002_region_namespace_service_app_name_service_settings_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='service',
+            name='status',
+            field=models.CharField(choices=[('NEW', 'New'), ('DEPLOYING', 'Deploying'), ('DEPLOYING_FAILED', 'Deploying failed'), ('RUNNING', 'Running'), ('STOPPING', 'Stopping'), ('STOPPED', 'Stopped'), ('TO_UPGRADE', 'To upgrade'), ('UPGRADING', 'Upgrading'), ('UPGRADING_FAILED', 'Upgrading failed'), ('STOPPING_FAILED', 'Stopping failed'), ('ROLLING_BACK', 'Rolling back'), ('ROLLING_BACK_FAILED', 'Rolling back failed'), ('RESUMMING', 'Resumming'), ('CLEARING', 'Clearing'), ('CLEARING_FAILED', 'Clearing failed'), ('DESTROYED', 'Destroyed'), ('BACKING_UP', 'Backing up')], default='NEW', max_length=150),
+        ),
+    ]
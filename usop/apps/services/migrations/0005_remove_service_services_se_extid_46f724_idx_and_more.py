@@ -0,0 +1,62 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0004_alter_service_status'),
+        ('users', '0009_remove_membershipinvitation_users_membe_extid_ffc220_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='service',
+            name='services_se_extid_46f724_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='service',
+            name='services_se_pid_ef14a7_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='template',
+            name='services_te_extid_edb1a7_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='template',
+            name='services_te_pid_88ed63_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='templatesku',
+            name='services_te_extid_3f5b99_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='templatesku',
+            name='services_te_pid_8d82f2_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='templateversion',
+            name='services_te_extid_fad309_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='templateversion',
+            name='services_te_pid_e66db2_idx',
+        ),
+        migrations.AddIndex(
+            model_name='service',
+            index=models.Index(fields=['org', 'status'], name='service_org_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='service',
+            index=models.Index(fields=['region', 'status'], name='service_region_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='service',
+            index=models.Index(fields=['template_version', 'status'], name='service_version_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='service',
+            index=models.Index(condition=models.Q(('status__in', ['NEW', 'DEPLOYING', 'DEPLOYING_FAILED', 'DEGRADED', 'STOPPING', 'TO_UPGRADE', 'UPGRADING', 'UPGRADING_FAILED', 'STOPPING_FAILED', 'ROLLING_BACK', 'ROLLING_BACK_FAILED', 'RESUMMING', 'CLEARING', 'CLEARING_FAILED', 'BACKING_UP'])), fields=['status'], name='service_status_queue_idx'),
+        ),
+    ]
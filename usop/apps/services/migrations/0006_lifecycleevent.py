@@ -0,0 +1,37 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0005_remove_service_services_se_extid_46f724_idx_and_more'),
+        ('users', '0009_remove_membershipinvitation_users_membe_extid_ffc220_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LifecycleEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_type', models.CharField(max_length=32)),
+                ('model', models.CharField(max_length=64)),
+                ('object_id', models.BigIntegerField(blank=True, null=True)),
+                ('label', models.CharField(blank=True, max_length=256)),
+                ('source', models.CharField(blank=True, max_length=150, null=True)),
+                ('target', models.CharField(blank=True, max_length=150, null=True)),
+                ('operation', models.CharField(blank=True, max_length=64, null=True)),
+                ('count', models.PositiveIntegerField(default=1)),
+                ('created', models.DateTimeField(editable=False)),
+                ('org', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='lifecycle_events', to='users.org')),
+            ],
+            options={
+                'verbose_name': 'lifecycle event',
+                'verbose_name_plural': 'lifecycle events',
+                'ordering': ['-created'],
+                'indexes': [models.Index(fields=['model', 'object_id', 'created'], name='lifecycle_object_idx'), models.Index(fields=['org', 'created'], name='lifecycle_org_idx')],
+            },
+        ),
+    ]
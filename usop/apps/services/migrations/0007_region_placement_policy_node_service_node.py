@@ -0,0 +1,41 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0006_lifecycleevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='region',
+            name='placement_policy',
+            field=models.CharField(choices=[('NONE', 'None'), ('BINPACK', 'Bin packing'), ('SPREAD', 'Spread')], default='NONE', max_length=16),
+        ),
+        migrations.CreateModel(
+            name='Node',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=256)),
+                ('cpu_capacity', models.PositiveIntegerField()),
+                ('memory_capacity', models.PositiveBigIntegerField()),
+                ('disabled', models.BooleanField(default=False)),
+                ('region', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='nodes', to='services.region')),
+            ],
+            options={
+                'verbose_name': 'node',
+                'verbose_name_plural': 'nodes',
+                'ordering': ['region', 'name'],
+                'unique_together': {('region', 'name')},
+            },
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='node',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='services', to='services.node'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0007_region_placement_policy_node_service_node'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='region',
+            name='max_namespace_operations',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='region',
+            name='max_operations',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='region',
+            name='operations_per_minute',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:22
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0008_region_max_namespace_operations_and_more'),
+        ('users', '0009_remove_membershipinvitation_users_membe_extid_ffc220_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceOperation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(max_length=32)),
+                ('status', models.CharField(choices=[('QUEUED', 'Queued'), ('RUNNING', 'Running'), ('SUCCEEDED', 'Succeeded'), ('FAILED', 'Failed')], default='QUEUED', max_length=16)),
+                ('task_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('requests', models.PositiveIntegerField(default=1)),
+                ('source_status', models.CharField(blank=True, choices=[('NEW', 'New'), ('DEPLOYING', 'Deploying'), ('DEPLOYING_FAILED', 'Deploying failed'), ('RUNNING', 'Running'), ('DEGRADED', 'Degraded'), ('STOPPING', 'Stopping'), ('STOPPED', 'Stopped'), ('TO_UPGRADE', 'To upgrade'), ('UPGRADING', 'Upgrading'), ('UPGRADING_FAILED', 'Upgrading failed'), ('STOPPING_FAILED', 'Stopping failed'), ('ROLLING_BACK', 'Rolling back'), ('ROLLING_BACK_FAILED', 'Rolling back failed'), ('RESTARTING', 'Restarting'), ('RESTARTING_FAILED', 'Restarting failed'), ('RESUMMING', 'Resumming'), ('CLEARING', 'Clearing'), ('CLEARING_FAILED', 'Clearing failed'), ('DESTROYED', 'Destroyed'), ('BACKING_UP', 'Backing up')], max_length=150, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'service operation',
+                'verbose_name_plural': 'service operations',
+                'ordering': ['-created'],
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='service',
+            name='service_status_queue_idx',
+        ),
+        migrations.AlterField(
+            model_name='service',
+            name='status',
+            field=models.CharField(choices=[('NEW', 'New'), ('DEPLOYING', 'Deploying'), ('DEPLOYING_FAILED', 'Deploying failed'), ('RUNNING', 'Running'), ('DEGRADED', 'Degraded'), ('STOPPING', 'Stopping'), ('STOPPED', 'Stopped'), ('TO_UPGRADE', 'To upgrade'), ('UPGRADING', 'Upgrading'), ('UPGRADING_FAILED', 'Upgrading failed'), ('STOPPING_FAILED', 'Stopping failed'), ('ROLLING_BACK', 'Rolling back'), ('ROLLING_BACK_FAILED', 'Rolling back failed'), ('RESTARTING', 'Restarting'), ('RESTARTING_FAILED', 'Restarting failed'), ('RESUMMING', 'Resumming'), ('CLEARING', 'Clearing'), ('CLEARING_FAILED', 'Clearing failed'), ('DESTROYED', 'Destroyed'), ('BACKING_UP', 'Backing up')], default='NEW', max_length=150),
+        ),
+        migrations.AddIndex(
+            model_name='service',
+            index=models.Index(condition=models.Q(('status__in', ['NEW', 'DEPLOYING', 'DEPLOYING_FAILED', 'DEGRADED', 'STOPPING', 'TO_UPGRADE', 'UPGRADING', 'UPGRADING_FAILED', 'STOPPING_FAILED', 'ROLLING_BACK', 'ROLLING_BACK_FAILED', 'RESTARTING', 'RESTARTING_FAILED', 'RESUMMING', 'CLEARING', 'CLEARING_FAILED', 'BACKING_UP'])), fields=['status'], name='service_status_queue_idx'),
+        ),
+        migrations.AddField(
+            model_name='serviceoperation',
+            name='service',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='operations', to='services.service'),
+        ),
+        migrations.AddIndex(
+            model_name='serviceoperation',
+            index=models.Index(fields=['service', 'status'], name='operation_service_status_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='serviceoperation',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'RUNNING')), fields=('service',), name='operation_single_running'),
+        ),
+    ]
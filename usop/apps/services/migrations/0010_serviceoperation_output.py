@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0009_serviceoperation_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serviceoperation',
+            name='output',
+            field=models.TextField(blank=True),
+        ),
+    ]
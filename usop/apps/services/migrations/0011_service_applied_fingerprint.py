@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0010_serviceoperation_output'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='applied_fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:41
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0011_service_applied_fingerprint'),
+        ('users', '0009_remove_membershipinvitation_users_membe_extid_ffc220_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceBackup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('status', models.CharField(choices=[('QUEUED', 'Queued'), ('RUNNING', 'Running'), ('SUCCEEDED', 'Succeeded'), ('FAILED', 'Failed')], default='RUNNING', max_length=16)),
+                ('volumes', models.PositiveIntegerField(default=0)),
+                ('files', models.PositiveIntegerField(default=0)),
+                ('size', models.BigIntegerField(default=0)),
+                ('stored_size', models.BigIntegerField(default=0)),
+                ('chunks', models.PositiveIntegerField(default=0)),
+                ('new_chunks', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'service backup',
+                'verbose_name_plural': 'service backups',
+                'ordering': ['-created'],
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='service',
+            name='service_status_queue_idx',
+        ),
+        migrations.AlterField(
+            model_name='service',
+            name='status',
+            field=models.CharField(choices=[('NEW', 'New'), ('DEPLOYING', 'Deploying'), ('DEPLOYING_FAILED', 'Deploying failed'), ('RUNNING', 'Running'), ('DEGRADED', 'Degraded'), ('STOPPING', 'Stopping'), ('STOPPED', 'Stopped'), ('TO_UPGRADE', 'To upgrade'), ('UPGRADING', 'Upgrading'), ('UPGRADING_FAILED', 'Upgrading failed'), ('STOPPING_FAILED', 'Stopping failed'), ('ROLLING_BACK', 'Rolling back'), ('ROLLING_BACK_FAILED', 'Rolling back failed'), ('RESTARTING', 'Restarting'), ('RESTARTING_FAILED', 'Restarting failed'), ('RESUMMING', 'Resumming'), ('CLEARING', 'Clearing'), ('CLEARING_FAILED', 'Clearing failed'), ('DESTROYED', 'Destroyed'), ('BACKING_UP', 'Backing up'), ('BACKING_UP_FAILED', 'Backing up failed'), ('RESTORING', 'Restoring'), ('RESTORING_FAILED', 'Restoring failed')], default='NEW', max_length=150),
+        ),
+        migrations.AlterField(
+            model_name='serviceoperation',
+            name='source_status',
+            field=models.CharField(blank=True, choices=[('NEW', 'New'), ('DEPLOYING', 'Deploying'), ('DEPLOYING_FAILED', 'Deploying failed'), ('RUNNING', 'Running'), ('DEGRADED', 'Degraded'), ('STOPPING', 'Stopping'), ('STOPPED', 'Stopped'), ('TO_UPGRADE', 'To upgrade'), ('UPGRADING', 'Upgrading'), ('UPGRADING_FAILED', 'Upgrading failed'), ('STOPPING_FAILED', 'Stopping failed'), ('ROLLING_BACK', 'Rolling back'), ('ROLLING_BACK_FAILED', 'Rolling back failed'), ('RESTARTING', 'Restarting'), ('RESTARTING_FAILED', 'Restarting failed'), ('RESUMMING', 'Resumming'), ('CLEARING', 'Clearing'), ('CLEARING_FAILED', 'Clearing failed'), ('DESTROYED', 'Destroyed'), ('BACKING_UP', 'Backing up'), ('BACKING_UP_FAILED', 'Backing up failed'), ('RESTORING', 'Restoring'), ('RESTORING_FAILED', 'Restoring failed')], max_length=150, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='service',
+            index=models.Index(condition=models.Q(('status__in', ['NEW', 'DEPLOYING', 'DEPLOYING_FAILED', 'DEGRADED', 'STOPPING', 'TO_UPGRADE', 'UPGRADING', 'UPGRADING_FAILED', 'STOPPING_FAILED', 'ROLLING_BACK', 'ROLLING_BACK_FAILED', 'RESTARTING', 'RESTARTING_FAILED', 'RESUMMING', 'CLEARING', 'CLEARING_FAILED', 'BACKING_UP', 'BACKING_UP_FAILED', 'RESTORING', 'RESTORING_FAILED'])), fields=['status'], name='service_status_queue_idx'),
+        ),
+        migrations.AddField(
+            model_name='servicebackup',
+            name='service',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='backups', to='services.service'),
+        ),
+        migrations.AddIndex(
+            model_name='servicebackup',
+            index=models.Index(fields=['service', 'status', 'created'], name='backup_service_status_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0012_servicebackup_and_more'),
+        ('users', '0009_remove_membershipinvitation_users_membe_extid_ffc220_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='service',
+            name='service_status_queue_idx',
+        ),
+        migrations.AddIndex(
+            model_name='service',
+            index=models.Index(condition=models.Q(('status__in', ['RUNNING', 'STOPPED', 'DESTROYED']), _negated=True), fields=['status'], name='service_status_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0013_remove_service_service_status_queue_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serviceoperation',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='serviceoperation',
+            index=models.Index(condition=models.Q(('status__in', ['QUEUED', 'RUNNING'])), fields=['status', 'heartbeat'], name='operation_active_heartbeat_idx'),
+        ),
+    ]
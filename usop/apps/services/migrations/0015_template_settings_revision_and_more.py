@@ -0,0 +1,29 @@
+# Generated by Django 5.0.7 on 2026-10-18 16:19
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0014_serviceoperation_heartbeat_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='template',
+            name='settings_revision',
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+        migrations.AddField(
+            model_name='templatesku',
+            name='settings_revision',
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+        migrations.AddField(
+            model_name='templateversion',
+            name='settings_revision',
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+    ]
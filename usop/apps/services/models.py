@@ -3,11 +3,13 @@ import uuid
 from django.db import models
 from django.conf import settings
 
-from .allocation import DefaultNodeAllocator, NodeAllocator
-from .status import ServiceStatus
+from .allocation import CapacityNodeAllocator, DefaultNodeAllocator, NodeAllocator, PlacementPolicy
+from .managers import ServiceQuerySet
+from .status import OperationStatus, ServiceStatus
 from usop.apps.users.models import Org
 from .interfaces import *
 from usop.lib.CachedClassUtil import CachedClassUtil
+from .registry import controller_registry
 
 
 
@@ -27,6 +29,18 @@ class Region(models.Model):
     namespace: str = models.CharField(max_length=128, blank=True, null=True)
     """ Optional kubernetes namespace used for this region, leaving blank will use the default namespace """
 
+    placement_policy: str = models.CharField(max_length=16, choices=PlacementPolicy.choices, default=PlacementPolicy.NONE)
+    """ How services are placed on the nodes of the region, nodes are only tracked when a policy is set """
+
+    max_operations: int = models.PositiveIntegerField(blank=True, null=True)
+    """ Maximum lifecycle operations running at once in the region, blank uses LIMITER_REGION_CONCURRENCY """
+
+    max_namespace_operations: int = models.PositiveIntegerField(blank=True, null=True)
+    """ Maximum lifecycle operations running at once in a namespace of the region, blank uses LIMITER_NAMESPACE_CONCURRENCY """
+
+    operations_per_minute: int = models.PositiveIntegerField(blank=True, null=True)
+    """ Maximum lifecycle operations started per minute in the region, blank uses LIMITER_REGION_OPERATIONS_PER_MINUTE """
+
     class Meta:
         verbose_name = "region"
         verbose_name_plural = "regions"
@@ -36,10 +50,56 @@ class Region(models.Model):
         return f"{self.name}"
     
     def get_node_allocator(self) -> NodeAllocator:
-        return DefaultNodeAllocator()
+        if self.placement_policy == PlacementPolicy.NONE:
+            return DefaultNodeAllocator()
+        return CapacityNodeAllocator.for_region(self)
+
+
+class Node(models.Model):
+    """Capacity of a cluster node where the services of a region can be placed"""
+
+    region: Region = models.ForeignKey(Region, related_name="nodes", on_delete=models.CASCADE)
+    """ Region the node belongs to """
+
+    name: str = models.CharField(max_length=256)
+    """ Kubernetes name of the node """
+
+    cpu_capacity: int = models.PositiveIntegerField()
+    """ Allocatable CPU of the node in millicores """
+
+    memory_capacity: int = models.PositiveBigIntegerField()
+    """ Allocatable memory of the node in bytes """
+
+    disabled: bool = models.BooleanField(default=False)
+    """ Wether to stop placing new services in this node """
 
+    class Meta:
+        verbose_name = "node"
+        verbose_name_plural = "nodes"
+        ordering = ["region", "name"]
+        unique_together = ("region", "name")
+
+    def __str__(self):
+        return f"{self.name}"
+
+
+class SettingsRevisionModel(models.Model):
+    """ A model with helm settings, identified by a revision that changes on every save """
 
-class Template(models.Model):
+    settings_revision = models.UUIDField(default=uuid.uuid4, editable=False)
+    """ Regenerated on every save, the values resolver caches the settings of the row under it """
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, update_fields=None, **kwargs):
+        self.settings_revision = uuid.uuid4()
+        if update_fields is not None:
+            update_fields = {*update_fields, "settings_revision"}
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+
+class Template(SettingsRevisionModel):
     """ 
         A template is a base configuration for a service that can be deployed.
     """
@@ -78,24 +138,16 @@ class Template(models.Model):
         verbose_name = "template"
         verbose_name_plural = "templates"
         ordering = ["name"]
-        indexes = [
-            models.Index(fields=['extid',]),
-            models.Index(fields=['pid',]),
-        ]
 
     def __str__(self):
         return f"{self.name}"
     
     def get_controller(self) -> IServiceController:
         """ Get the controller for this template """
-        model_path = settings.SERVICE_CONTROLLER
-        module, klass = model_path.rsplit(".", 1)
-        services = __import__(module, fromlist=[klass])
-        controller = getattr(services, klass)
-        return controller(self)
+        return controller_registry.get_for_template(self)(self)
 
 
-class TemplateSKU(models.Model):
+class TemplateSKU(SettingsRevisionModel):
     """ 
         A SKU is a specific version of a template that can be deployed.
         This allows for multiple variations of templates.
@@ -144,16 +196,12 @@ class TemplateSKU(models.Model):
         verbose_name = "template sku"
         verbose_name_plural = "template skus"
         ordering = ["name"]
-        indexes = [
-            models.Index(fields=['extid',]),
-            models.Index(fields=['pid',]),
-        ]
 
     def __str__(self):
         return f"{self.name}"
 
 
-class TemplateVersion(models.Model):
+class TemplateVersion(SettingsRevisionModel):
     """A version of a template for deploying services"""
 
     version_name: str = models.CharField(max_length=128)
@@ -190,10 +238,6 @@ class TemplateVersion(models.Model):
         verbose_name = "template version"
         verbose_name_plural = "template versions"
         ordering = ["version_name"]
-        indexes = [
-            models.Index(fields=['extid',]),
-            models.Index(fields=['pid',]),
-        ]
 
     def __str__(self):
         return f"{self.version_name}"
@@ -250,32 +294,200 @@ class Service(models.Model):
     settings = models.JSONField(blank=True, null=True)
     """ Helm settings for this template version """
 
+    node: Node = models.ForeignKey(Node, related_name="services", on_delete=models.SET_NULL, blank=True, null=True)
+    """ Node where the service is placed, only set in regions with a placement policy """
+
+    applied_fingerprint: str = models.CharField(max_length=64, blank=True, null=True, editable=False)
+    """ Fingerprint of the chart and values last applied with helm, upgrades are skipped while it matches """
+
+    objects = ServiceQuerySet.as_manager()
+    """ Custom manager for the service model. """
+
     class Meta:
         verbose_name = "service"
         verbose_name_plural = "services"
         ordering = ["name"]
         indexes = [
-            models.Index(fields=['extid',]),
-            models.Index(fields=['pid',]),
+            # extid and pid are unique, so they are already indexed
+            models.Index(fields=["org", "status"], name="service_org_status_idx"),
+            models.Index(fields=["region", "status"], name="service_region_status_idx"),
+            models.Index(fields=["template_version", "status"], name="service_version_status_idx"),
+            models.Index(
+                fields=["status"],
+                name="service_status_queue_idx",
+                # Negated so new statuses don't change the index definition
+                condition=~models.Q(status__in=[ServiceStatus.RUNNING, ServiceStatus.STOPPED, ServiceStatus.DESTROYED]),
+            ),
         ]
 
     def __str__(self):
         return f"{self.name}"    
     
     def get_service_controller(self) -> IServiceController:
-        """ Get the controller for this service """
-        model_path = settings.SERVICE_CONTROLLER
-        # TODO allow apps to define their own controllers
-        _class = CachedClassUtil.get_class(model_path)
-        return _class(self)
+        """ Get the controller for this service, apps can register their own in the controller registry """
+        return controller_registry.get_for_service(self)(self)
     
     @property
     def namespace(self):
-        return self.service.region.namespace or settings.DEFAULT_NAMESPACE
+        return self.region.namespace or settings.DEFAULT_NAMESPACE
     
-    @property
     def get_billing_controller(self) -> IBillingController:
         """ Get the billing controller for this service """
         model_path = settings.BILLING_CONTROLLER
         # TODO allow apps to define their own controllers
-        return CachedClassUtil.get_instance(model_path)
\ No newline at end of file
+        return CachedClassUtil.get_instance(model_path)
+
+
+class ServiceOperation(models.Model):
+    """A lifecycle operation requested for a service, redundant requests are coalesced into one operation"""
+
+    service: Service = models.ForeignKey(Service, related_name="operations", on_delete=models.CASCADE)
+    """ Service the operation applies to """
+
+    operation: str = models.CharField(max_length=32)
+    """ Name of the controller transition to run """
+
+    status: str = models.CharField(max_length=16, choices=OperationStatus.choices, default=OperationStatus.QUEUED)
+    """ Progress of the operation """
+
+    task_id: uuid.UUID = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    """ Id of the Celery task running the operation, the handle returned to every caller """
+
+    requests: int = models.PositiveIntegerField(default=1)
+    """ Number of calls coalesced into this operation """
+
+    source_status: str = models.CharField(max_length=150, choices=ServiceStatus.choices, blank=True, null=True)
+    """ Status of the service before it was moved to the pending status of the operation, empty until then """
+
+    error: str = models.TextField(blank=True)
+    """ Reason of the failure """
+
+    output: str = models.TextField(blank=True)
+    """ Last lines printed by the helm and kubectl commands of the operation, updated while it runs """
+
+    created: datetime = models.DateTimeField(editable=False, auto_now_add=True)
+    """ The date the operation was first requested """
+
+    started: datetime = models.DateTimeField(blank=True, null=True)
+    """ The date a worker started the operation """
+
+    finished: datetime = models.DateTimeField(blank=True, null=True)
+    """ The date the operation succeeded or failed """
+
+    heartbeat: datetime = models.DateTimeField(blank=True, null=True, editable=False)
+    """ Last time the operation was sent to a worker, or was seen alive while running, see sweep_operations """
+
+    class Meta:
+        verbose_name = "service operation"
+        verbose_name_plural = "service operations"
+        ordering = ["-created"]
+        indexes = [
+            models.Index(fields=["service", "status"], name="operation_service_status_idx"),
+            models.Index(
+                fields=["status", "heartbeat"], name="operation_active_heartbeat_idx",
+                condition=models.Q(status__in=[OperationStatus.QUEUED, OperationStatus.RUNNING])),
+        ]
+        constraints = [
+            # At most one operation per service runs at a time
+            models.UniqueConstraint(
+                fields=["service"], condition=models.Q(status=OperationStatus.RUNNING),
+                name="operation_single_running"),
+        ]
+
+    def __str__(self):
+        return f"{self.operation} {self.service_id} {self.status}"
+
+
+class ServiceBackup(models.Model):
+    """A snapshot of the volumes of a service, its chunks are shared with every other snapshot in the backup store"""
+
+    service: Service = models.ForeignKey(Service, related_name="backups", on_delete=models.CASCADE)
+    """ Service whose volumes were backed up """
+
+    key: uuid.UUID = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    """ Id of the snapshot, its manifest is stored under it """
+
+    status: str = models.CharField(max_length=16, choices=OperationStatus.choices, default=OperationStatus.RUNNING)
+    """ Progress of the backup """
+
+    volumes: int = models.PositiveIntegerField(default=0)
+    files: int = models.PositiveIntegerField(default=0)
+
+    size: int = models.BigIntegerField(default=0)
+    """ Bytes of the files of the volumes """
+
+    stored_size: int = models.BigIntegerField(default=0)
+    """ Compressed bytes of the chunks this backup added to the store, the rest were already stored """
+
+    chunks: int = models.PositiveIntegerField(default=0)
+    new_chunks: int = models.PositiveIntegerField(default=0)
+
+    error: str = models.TextField(blank=True)
+    """ Reason of the failure """
+
+    created: datetime = models.DateTimeField(editable=False, auto_now_add=True)
+    """ The date the backup started """
+
+    finished: datetime = models.DateTimeField(blank=True, null=True)
+    """ The date the backup succeeded or failed """
+
+    class Meta:
+        verbose_name = "service backup"
+        verbose_name_plural = "service backups"
+        ordering = ["-created"]
+        indexes = [
+            models.Index(fields=["service", "status", "created"], name="backup_service_status_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.service_id} {self.created:%Y-%m-%d %H:%M} {self.status}"
+
+    @property
+    def manifest_key(self) -> str:
+        return f"snapshots/{self.service_id}/{self.key}.json.gz"
+
+
+class LifecycleEvent(models.Model):
+    """Lifecycle event of a platform object, written in batches by the DatabaseEventSink"""
+
+    event_type: str = models.CharField(max_length=32)
+    """ One of created, updated or transition """
+
+    model: str = models.CharField(max_length=64)
+    """ Name of the model of the object """
+
+    object_id: int = models.BigIntegerField(blank=True, null=True)
+    """ Primary key of the object, empty for events about many objects """
+
+    label: str = models.CharField(max_length=256, blank=True)
+    """ User facing label of the object when the event happened """
+
+    source: str = models.CharField(max_length=150, blank=True, null=True)
+    """ Status before a transition """
+
+    target: str = models.CharField(max_length=150, blank=True, null=True)
+    """ Status after a transition """
+
+    operation: str = models.CharField(max_length=64, blank=True, null=True)
+    """ Name of the operation that caused the transition """
+
+    count: int = models.PositiveIntegerField(default=1)
+    """ Number of objects affected, for bulk writes """
+
+    org: Org = models.ForeignKey(Org, related_name="lifecycle_events", on_delete=models.SET_NULL, blank=True, null=True)
+    """ Org owning the object """
+
+    created: datetime = models.DateTimeField(editable=False)
+    """ The date the event happened """
+
+    class Meta:
+        verbose_name = "lifecycle event"
+        verbose_name_plural = "lifecycle events"
+        ordering = ["-created"]
+        indexes = [
+            models.Index(fields=["model", "object_id", "created"], name="lifecycle_object_idx"),
+            models.Index(fields=["org", "created"], name="lifecycle_org_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.model} {self.object_id} {self.event_type}"
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+import threading
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+logger = logging.getLogger(__name__)
+
+
+def service_channel(service_id) -> str:
+    return f"usop:status:service:{service_id}"
+
+
+def org_channel(org_id) -> str:
+    return f"usop:status:org:{org_id}"
+
+
+class RedisSubscription:
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    async def get(self, timeout: float) -> Optional[Dict]:
+        """ Next message of the subscribed channels, None if nothing arrived within timeout seconds """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            # Returns None right away for subscribe confirmations, so wait again for the rest of the timeout
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message is not None:
+                return json.loads(message["data"])
+
+
+class RedisBroker:
+    """ Status channels on the Redis instance of the Celery broker, shared by the web and worker processes """
+
+    def __init__(self, url: str):
+        import redis
+        self.url = url
+        self.redis = redis.Redis.from_url(url)
+
+    def publish(self, channel: str, message: Dict):
+        self.redis.publish(channel, json.dumps(message, cls=DjangoJSONEncoder))
+
+    @asynccontextmanager
+    async def subscribe(self, channels: List[str]) -> AsyncIterator[RedisSubscription]:
+        import redis.asyncio
+        client = redis.asyncio.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(*channels)
+        try:
+            yield RedisSubscription(pubsub)
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
+
+
+class LocalSubscription:
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+
+    async def get(self, timeout: float) -> Optional[Dict]:
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LocalBroker:
+    """ Process local fallback of RedisBroker, only sees the messages published by the same process """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def publish(self, channel: str, message: Dict):
+        with self._lock:
+            subscribers = list(self._subscribers[channel])
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+    @asynccontextmanager
+    async def subscribe(self, channels: List[str]) -> AsyncIterator[LocalSubscription]:
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            for channel in channels:
+                self._subscribers[channel].add(subscriber)
+        try:
+            yield LocalSubscription(subscriber[1])
+        finally:
+            with self._lock:
+                for channel in channels:
+                    self._subscribers[channel].discard(subscriber)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """ Process wide status broker, on the Redis instance of the Celery broker when there is one """
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                url = settings.PUBSUB_REDIS_URL or settings.CELERY_BROKER_URL
+                if url and url.startswith(("redis://", "rediss://", "unix://")):
+                    _broker = RedisBroker(url)
+                else:
+                    _broker = LocalBroker()
+    return _broker
+
+
+def publish(channels: List[str], message: Dict):
+    """ Publish a status message, failures are logged so they never break the operation that publishes """
+    try:
+        broker = get_broker()
+        for channel in channels:
+            broker.publish(channel, message)
+    except Exception:
+        logger.exception("Could not publish status message to %s", channels)
+
+
+def publish_transition(event, service_id: int, org_id: Optional[int], label: str = ""):
+    """ Publish the transition of one of the services of an event to the channels of the service and its org """
+    channels = [service_channel(service_id)]
+    if org_id:
+        channels.append(org_channel(org_id))
+    publish(channels, {
+        "type": "transition",
+        "service": service_id,
+        "label": label,
+        "source": event.source,
+        "status": event.target,
+        "operation": event.operation,
+        "created": event.created,
+    })
+
+
+def operation_message(operation, output: Optional[str] = None) -> Dict:
+    message = {
+        "type": "operation",
+        "service": operation.service_id,
+        "task_id": operation.task_id,
+        "operation": operation.operation,
+        "status": operation.status,
+        "requests": operation.requests,
+        "error": operation.error,
+    }
+    if output is not None:
+        message["output"] = output
+    return message
+
+
+def publish_operation(operation, output: Optional[str] = None):
+    """ Publish the progress of an operation, with the last lines of its output when given """
+    publish(
+        [service_channel(operation.service_id), org_channel(operation.service.org_id)],
+        operation_message(operation, output))
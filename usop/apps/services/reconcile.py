@@ -0,0 +1,120 @@
+import logging
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from django.db import transaction
+from django.db.models import QuerySet
+
+from .events import emit_bulk_transition
+from .interfaces import ReleaseState
+from .registry import controller_registry
+from .status import ServiceStatus
+
+
+logger = logging.getLogger(__name__)
+
+
+RECONCILED_STATUSES = [
+    ServiceStatus.RUNNING,
+    ServiceStatus.DEGRADED,
+    ServiceStatus.TO_UPGRADE,
+    ServiceStatus.STOPPED,
+    ServiceStatus.DEPLOYING_FAILED,
+    ServiceStatus.UPGRADING_FAILED,
+    ServiceStatus.STOPPING_FAILED,
+    ServiceStatus.ROLLING_BACK_FAILED,
+    ServiceStatus.CLEARING_FAILED,
+]
+""" Settled statuses that can be corrected from the cluster. Services in an intermediate status are owned by a worker """
+
+RUNNING_STATUSES = [ServiceStatus.RUNNING, ServiceStatus.DEGRADED, ServiceStatus.TO_UPGRADE]
+
+RELEASELESS_STATUSES = [ServiceStatus.STOPPED, ServiceStatus.DESTROYED]
+""" Statuses of services without a release, moving to them forgets the applied state so the next deploy runs """
+
+UPDATE_BATCH_SIZE = 500
+
+
+def resolve_status(current: str, release: Optional[ReleaseState]) -> str:
+    """ Status a service should have given its stored status and the state of its release in the cluster """
+    if current not in RECONCILED_STATUSES:
+        return current
+
+    if release is None or release.status == "uninstalled":
+        if current == ServiceStatus.CLEARING_FAILED:
+            return ServiceStatus.DESTROYED
+        if current in RUNNING_STATUSES:
+            return ServiceStatus.STOPPED
+        return current
+
+    if release.status == "deployed":
+        if current == ServiceStatus.TO_UPGRADE:
+            return current
+        if current in (ServiceStatus.RUNNING, ServiceStatus.DEGRADED, ServiceStatus.STOPPED):
+            return ServiceStatus.RUNNING if release.ready else ServiceStatus.DEGRADED
+        return current
+
+    if release.status == "failed":
+        if current in RUNNING_STATUSES:
+            return ServiceStatus.UPGRADING_FAILED
+        if current == ServiceStatus.STOPPED:
+            return ServiceStatus.DEPLOYING_FAILED
+    return current
+
+
+def move_services(queryset: QuerySet, ids: List[int], source: str, target: str, operation: str) -> int:
+    """
+        Move the services of the ids that are still in the source status to target, with one update, and emit
+        their transition. The source status is part of the filter so services that a worker moved since they
+        were read are not overwritten.
+    """
+    changes = {"status": target}
+    if target in RELEASELESS_STATUSES:
+        changes["applied_fingerprint"] = None
+    with transaction.atomic():
+        moved = list(queryset.select_for_update().filter(pk__in=ids, status=source).values_list("pk", "org_id"))
+        if moved:
+            queryset.filter(pk__in=[pk for pk, _ in moved]).update(**changes)
+    if moved:
+        emit_bulk_transition(source, target, moved, operation)
+    return len(moved)
+
+
+def reconcile_services(queryset: QuerySet) -> Dict[str, int]:
+    """
+        Sync the status of the services with their releases in the cluster.
+        Releases are listed once per controller and namespace, and only the services
+        whose status changed are written, with one update per distinct status change.
+    """
+    groups = defaultdict(list)
+    services = (
+        queryset
+        .filter(status__in=RECONCILED_STATUSES)
+        .select_related("region", "template_version__template")
+        .only("id", "pid", "status", "app_name", "region__namespace", "template_version__template__chart_id")
+    )
+    for service in services.iterator(chunk_size=2000):
+        controller_class = controller_registry.get_for_service(service)
+        groups[(controller_class, service.namespace)].append(service)
+
+    changes = defaultdict(list)
+    for (controller_class, namespace), members in groups.items():
+        try:
+            releases = controller_class.list_releases(namespace)
+        except Exception:
+            logger.exception("Could not list the releases of namespace %s", namespace)
+            continue
+        for service in members:
+            status = resolve_status(service.status, releases.get(str(service.pid)))
+            if status != service.status:
+                changes[(service.status, status)].append(service.pk)
+
+    summary = {}
+    for (source, target), ids in changes.items():
+        updated = 0
+        for start in range(0, len(ids), UPDATE_BATCH_SIZE):
+            batch = ids[start:start + UPDATE_BATCH_SIZE]
+            updated += move_services(queryset.model.objects, batch, source, target, "reconcile")
+        summary[f"{source}->{target}"] = updated
+        logger.info("Reconciled %d services from %s to %s", updated, source, target)
+    return summary
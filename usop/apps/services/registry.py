@@ -0,0 +1,69 @@
+from typing import Dict, Optional, Type, Union
+
+from django.apps import apps
+from django.conf import settings
+
+from usop.lib.CachedClassUtil import CachedClassUtil
+from .interfaces import IServiceController
+
+
+class ControllerRegistry:
+    """
+        Maps the services of an app, or the charts of a template, to their controller class.
+        Built once in ServicesConfig.ready(), lookups are plain dict accesses.
+
+        Apps can provide a controller for their services by setting ``service_controller``
+        to the dotted path of the class on their AppConfig, or by calling
+        ``controller_registry.register()`` from their own ready().
+    """
+
+    def __init__(self):
+        self.default: Optional[Type[IServiceController]] = None
+        self._by_app: Dict[str, Type[IServiceController]] = {}
+        self._by_chart: Dict[str, Type[IServiceController]] = {}
+
+    @staticmethod
+    def _resolve(controller: Union[str, Type[IServiceController]]) -> Type[IServiceController]:
+        if isinstance(controller, str):
+            return CachedClassUtil.get_class(controller)
+        return controller
+
+    def register(self, controller: Union[str, Type[IServiceController]], app_name: Optional[str] = None,
+                 chart_id: Optional[str] = None):
+        """ Register a controller class, or its dotted path, for the services of an app or of a chart """
+        if not app_name and not chart_id:
+            raise ValueError("Either app_name or chart_id is required to register a controller")
+        controller = self._resolve(controller)
+        if app_name:
+            self._by_app[app_name] = controller
+        if chart_id:
+            self._by_chart[chart_id] = controller
+
+    def build(self):
+        """ Load the default controller and the controllers declared by the installed apps """
+        self.default = self._resolve(settings.SERVICE_CONTROLLER)
+        for app_config in apps.get_app_configs():
+            controller = getattr(app_config, "service_controller", None)
+            if controller:
+                self.register(controller, app_name=app_config.name)
+                self._by_app[app_config.label] = self._by_app[app_config.name]
+
+    def get_for_template(self, template) -> Type[IServiceController]:
+        if self.default is None:
+            self.build()
+        return self._by_chart.get(template.chart_id, self.default)
+
+    def get_for_service(self, service) -> Type[IServiceController]:
+        if self.default is None:
+            self.build()
+        if service.app_name and service.app_name in self._by_app:
+            return self._by_app[service.app_name]
+        if self._by_chart:
+            version = service.template_version
+            if version and version.template.chart_id in self._by_chart:
+                return self._by_chart[version.template.chart_id]
+        return self.default
+
+
+controller_registry = ControllerRegistry()
+""" Process wide controller registry """
@@ -1,14 +1,77 @@
-from django.db.models.signals import post_save
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
+from .catalog import TEMPLATES_SCOPE, catalog_cache, skus_scope, versions_scope
+from .events import CREATED, UPDATED, Event, pipeline
 from .models import Region, Template, TemplateSKU, TemplateVersion, Service
 
+
+logger = logging.getLogger(__name__)
+
+
 @receiver(post_save, sender=Region)
 @receiver(post_save, sender=Template)
 @receiver(post_save, sender=TemplateSKU)
 @receiver(post_save, sender=TemplateVersion)
 @receiver(post_save, sender=Service)
 def model_save_handler(sender, instance, created, **kwargs):
-    if created:
-        print(f"A new {sender.__name__} instance was created: {instance}")
-    else:
-        print(f"A {sender.__name__} instance was updated: {instance}")
\ No newline at end of file
+    """ Queue a lifecycle event, bulk_create and bulk_update don't send post_save so they emit nothing per row """
+    pipeline.emit(Event(
+        event_type=CREATED if created else UPDATED,
+        model=sender.__name__,
+        object_id=instance.pk,
+        label=str(instance),
+        org_id=getattr(instance, "org_id", None),
+    ))
+
+
+
+@receiver(pre_save, sender=TemplateSKU)
+def sku_pre_save_handler(sender, instance, **kwargs):
+    """ Remember the org and region the SKU had, a SKU moved to another region leaves the old one """
+    if instance.pk:
+        instance._catalog_scope = sender.objects.filter(pk=instance.pk).values_list("org_id", "region_id").first()
+
+
+@receiver(post_save, sender=TemplateSKU)
+@receiver(post_delete, sender=TemplateSKU)
+def sku_catalog_handler(sender, instance, **kwargs):
+    scopes = [skus_scope(instance.org_id, instance.region_id)]
+    previous = getattr(instance, "_catalog_scope", None)
+    if previous:
+        scopes.append(skus_scope(*previous))
+    transaction.on_commit(lambda: catalog_cache.bump(scopes))
+
+
+@receiver(post_save, sender=TemplateVersion)
+@receiver(post_delete, sender=TemplateVersion)
+def version_catalog_handler(sender, instance, **kwargs):
+    scope = versions_scope(instance.template_id)
+    transaction.on_commit(lambda: catalog_cache.bump([scope]))
+
+
+def prepull_chart(version_id: int):
+    """ Queue the pre-pull of a chart, failures are logged so a broker outage never breaks saving the version """
+    if not settings.CELERY_BROKER_URL:
+        return
+    from .tasks import warm_chart_cache
+    try:
+        warm_chart_cache.delay([version_id])
+    except Exception:
+        logger.exception("Could not queue the chart pre-pull of template version %s", version_id)
+
+
+@receiver(post_save, sender=TemplateVersion)
+def version_chart_handler(sender, instance, **kwargs):
+    """ Pre-pull the chart of a saved version, so the first deploy doesn't wait for the download """
+    if settings.HELM_CHART_PREPULL:
+        transaction.on_commit(lambda: prepull_chart(instance.pk))
+
+
+@receiver(post_save, sender=Template)
+@receiver(post_delete, sender=Template)
+def template_catalog_handler(sender, instance, **kwargs):
+    transaction.on_commit(lambda: catalog_cache.bump([TEMPLATES_SCOPE]))
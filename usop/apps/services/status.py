@@ -16,6 +16,9 @@ class ServiceStatus(TextChoices):
    RUNNING = 'RUNNING', _('Running')
    """ The service is currently running """
 
+   DEGRADED = 'DEGRADED', _('Degraded')
+   """ The service is deployed but some of its pods are not running or ready """
+
    STOPPING = 'STOPPING', _('Stopping')
    """ The service is being stopped """
 
@@ -31,14 +34,55 @@ class ServiceStatus(TextChoices):
    UPGRADING_FAILED = 'UPGRADING_FAILED', _('Upgrading failed')
    """ The service upgrade failed """
 
+   STOPPING_FAILED = 'STOPPING_FAILED', _('Stopping failed')
+   """ The service could not be stopped """
+
+   ROLLING_BACK = 'ROLLING_BACK', _('Rolling back')
+   """ The service is being rolled back to the previous version of the chart """
+
+   ROLLING_BACK_FAILED = 'ROLLING_BACK_FAILED', _('Rolling back failed')
+   """ The service rollback failed """
+
+   RESTARTING = 'RESTARTING', _('Restarting')
+   """ The workloads of the service are being restarted """
+
+   RESTARTING_FAILED = 'RESTARTING_FAILED', _('Restarting failed')
+   """ The service restart failed """
+
    RESUMMING = 'RESUMMING', _('Resumming')
    """ The service is being resumed from a stopped state """
 
    CLEARING = 'CLEARING', _('Clearing')
    """ The service is being cleared from the platform """
 
+   CLEARING_FAILED = 'CLEARING_FAILED', _('Clearing failed')
+   """ The service could not be cleared from the platform """
+
    DESTROYED = 'DESTROYED', _('Destroyed')
    """ The service has been cleared from the platform """
 
    BACKING_UP = 'BACKING_UP', _('Backing up')
-   """ The service storage resources are being backed up. Services are still running. """
\ No newline at end of file
+   """ The service storage resources are being backed up. Services are still running. """
+
+   BACKING_UP_FAILED = 'BACKING_UP_FAILED', _('Backing up failed')
+   """ The service backup failed, the service kept running """
+
+   RESTORING = 'RESTORING', _('Restoring')
+   """ The service storage resources are being replaced with the content of a backup """
+
+   RESTORING_FAILED = 'RESTORING_FAILED', _('Restoring failed')
+   """ The service restore failed """
+
+
+class OperationStatus(TextChoices):
+   QUEUED = 'QUEUED', _('Queued')
+   """ The operation is waiting for a worker or for the previous operation of the service """
+
+   RUNNING = 'RUNNING', _('Running')
+   """ A worker is running the operation """
+
+   SUCCEEDED = 'SUCCEEDED', _('Succeeded')
+   """ The operation finished and the service reached its target status """
+
+   FAILED = 'FAILED', _('Failed')
+   """ The operation failed or was not allowed when its turn came """
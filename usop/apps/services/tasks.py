@@ -0,0 +1,418 @@
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from celery import shared_task
+from celery.result import AsyncResult
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from viewflow.fsm import TransitionNotAllowed
+
+from usop.metrics import time_transition
+
+from .charts import chart_cache
+from .events import emit_transition, pipeline
+from .limits import OperationLimitTimeout, operation_slot
+from .models import Service, ServiceOperation, TemplateVersion
+from .pubsub import publish_operation
+from .reconcile import reconcile_services
+from .status import OperationStatus, ServiceStatus
+
+
+logger = logging.getLogger(__name__)
+
+
+TRANSITION_STATES = {
+    "deploy": (ServiceStatus.DEPLOYING, ServiceStatus.DEPLOYING_FAILED),
+    "upgrade": (ServiceStatus.UPGRADING, ServiceStatus.UPGRADING_FAILED),
+    "stop": (ServiceStatus.STOPPING, ServiceStatus.STOPPING_FAILED),
+    "restart": (ServiceStatus.RESTARTING, ServiceStatus.RESTARTING_FAILED),
+    "rollback": (ServiceStatus.ROLLING_BACK, ServiceStatus.ROLLING_BACK_FAILED),
+    "backup": (ServiceStatus.BACKING_UP, ServiceStatus.BACKING_UP_FAILED),
+    "restore": (ServiceStatus.RESTORING, ServiceStatus.RESTORING_FAILED),
+    "destroy": (ServiceStatus.CLEARING, ServiceStatus.CLEARING_FAILED),
+}
+""" Intermediate and failure status of every transition that can be dispatched to a worker """
+
+COALESCED_OPERATIONS = {
+    ("deploy", "deploy"): "deploy",
+    ("deploy", "upgrade"): "deploy",
+    ("upgrade", "upgrade"): "upgrade",
+    ("restart", "restart"): "restart",
+    ("stop", "stop"): "stop",
+    ("stop", "deploy"): "restart",
+    ("destroy", "destroy"): "destroy",
+    ("deploy", "destroy"): "destroy",
+    ("upgrade", "destroy"): "destroy",
+    ("restart", "destroy"): "destroy",
+    ("stop", "destroy"): "destroy",
+    ("rollback", "destroy"): "destroy",
+    ("backup", "backup"): "backup",
+    ("restore", "restore"): "restore",
+    ("backup", "destroy"): "destroy",
+    ("restore", "destroy"): "destroy",
+}
+""" Operation a queued operation becomes when another one is requested before it starts """
+
+ACTIVE_OPERATION_STATUSES = [OperationStatus.QUEUED, OperationStatus.RUNNING]
+
+
+def perform_transition(service: Service, operation: str, wait_timeout=None,
+                       record: Optional[ServiceOperation] = None, arguments: Optional[Dict] = None) -> str:
+    """
+        Run a controller transition in the current process, once a slot is free in the region and namespaces
+        of the service. Waits up to wait_timeout seconds for the slot, raising OperationLimitTimeout with the
+        service left untouched. The output of the commands is kept on record when given, and the transition
+        receives the arguments as keywords, ex: force for upgrade.
+        On failure the service is left in the failure status of the operation and the error is raised again.
+    """
+    if operation not in TRANSITION_STATES:
+        raise ValueError(_("Unknown service operation: %s") % operation)
+    failed_status = TRANSITION_STATES[operation][1]
+    controller = service.get_service_controller()
+    controller.operation_record = record
+    with operation_slot(service, timeout=wait_timeout):
+        try:
+            with time_transition(service, operation):
+                getattr(controller, operation)(**(arguments or {}))
+        except Exception:
+            logger.exception("Service %s failed to %s", service.pid, operation)
+            source = service.status
+            service.status = failed_status
+            with pipeline.suppress():
+                service.save(update_fields=["status"])
+            emit_transition(service, source, failed_status, operation)
+            raise
+    return service.status
+
+
+def mark_pending(service: Service, operation: str) -> str:
+    """ Check the operation is allowed and move the service to its intermediate status, returns the previous status """
+    if operation not in TRANSITION_STATES:
+        raise ValueError(_("Unknown service operation: %s") % operation)
+    controller = service.get_service_controller()
+    if not getattr(controller, operation).can_proceed():
+        raise TransitionNotAllowed(
+            _("Cannot %(operation)s service in status %(status)s") % {"operation": operation, "status": service.status})
+    source = service.status
+    service.status = TRANSITION_STATES[operation][0]
+    with pipeline.suppress():
+        service.save(update_fields=["status"])
+    emit_transition(service, source, service.status, operation)
+    return source
+
+
+def _dispatch(operation: ServiceOperation):
+    # Sent once the current transaction commits, so workers never read a stale status.
+    # A message lost after the heartbeat is written is sent again by sweep_operations.
+    ServiceOperation.objects.filter(pk=operation.pk).update(heartbeat=timezone.now())
+    transaction.on_commit(
+        lambda: run_operation.apply_async(args=(operation.pk,), task_id=str(operation.task_id)))
+
+
+def _dispatch_next(service_id: int):
+    operation = (
+        ServiceOperation.objects
+        .filter(service_id=service_id, status=OperationStatus.QUEUED)
+        .order_by("created", "pk")
+        .first()
+    )
+    if operation is not None:
+        _dispatch(operation)
+
+
+def _retarget(service: Service, operation: ServiceOperation, target: str) -> bool:
+    """ Turn a queued operation into another one, moving the service to the new pending status if needed """
+    if operation.source_status is not None:
+        pending = service.status
+        service.status = operation.source_status
+        try:
+            mark_pending(service, target)
+        except TransitionNotAllowed:
+            service.status = pending
+            return False
+    operation.operation = target
+    return True
+
+
+def enqueue_operation(service: Service, operation: str, dispatch: bool = True) -> ServiceOperation:
+    """
+        Queue an operation for a service and return its record, whose task_id is the handle of the operation.
+        While holding a lock on the service row, a request that repeats the running operation returns it,
+        one that coalesces with the last queued operation is merged into it and anything else queues behind.
+        The first operation of an idle service moves it to the pending status right away, so requests that
+        are not allowed fail here with TransitionNotAllowed.
+    """
+    if operation not in TRANSITION_STATES:
+        raise ValueError(_("Unknown service operation: %s") % operation)
+    with transaction.atomic():
+        service.status = Service.objects.select_for_update().values_list("status", flat=True).get(pk=service.pk)
+        last = (
+            ServiceOperation.objects
+            .filter(service=service, status__in=ACTIVE_OPERATION_STATUSES)
+            .order_by("created", "pk")
+            .last()
+        )
+        if last is not None:
+            if last.status == OperationStatus.RUNNING:
+                merged = last.operation == operation
+            else:
+                target = COALESCED_OPERATIONS.get((last.operation, operation))
+                merged = target is not None and _retarget(service, last, target)
+            if merged:
+                last.requests += 1
+                last.save(update_fields=["operation", "requests"])
+                last.service = service
+                transaction.on_commit(lambda: publish_operation(last))
+                return last
+
+        queued = ServiceOperation(service=service, operation=operation)
+        if last is None:
+            queued.source_status = mark_pending(service, operation)
+        queued.save()
+        transaction.on_commit(lambda: publish_operation(queued))
+        if dispatch and last is None:
+            _dispatch(queued)
+    return queued
+
+
+def dispatch_transition(service: Service, operation: str) -> AsyncResult:
+    """ Queue the operation on a worker and return its handle, shared with duplicate requests """
+    return AsyncResult(str(enqueue_operation(service, operation).task_id))
+
+
+def claim_operation(operation_id: int) -> Optional[ServiceOperation]:
+    """
+        Mark an operation as running if it is the next one of its service, returns None when it is not,
+        or when it was already run by someone else. Operations that are no longer allowed by the status
+        the service reached are failed here and the next one is dispatched.
+    """
+    with transaction.atomic():
+        service_id = ServiceOperation.objects.filter(pk=operation_id).values_list("service_id", flat=True).get()
+        service = Service.objects.with_deployment_context().select_for_update(of=("self",)).get(pk=service_id)
+        operation = ServiceOperation.objects.select_for_update().get(pk=operation_id)
+        operation.service = service
+        head = (
+            ServiceOperation.objects
+            .filter(service=service, status__in=ACTIVE_OPERATION_STATUSES)
+            .order_by("created", "pk")
+            .first()
+        )
+        if operation.status != OperationStatus.QUEUED or head.pk != operation.pk:
+            return None
+        if operation.source_status is None:
+            try:
+                operation.source_status = mark_pending(service, operation.operation)
+            except TransitionNotAllowed as e:
+                _finish_operation(operation, OperationStatus.FAILED, str(e))
+                return None
+        operation.status = OperationStatus.RUNNING
+        operation.started = operation.heartbeat = timezone.now()
+        operation.save(update_fields=["status", "source_status", "started", "heartbeat"])
+    publish_operation(operation)
+    return operation
+
+
+def _finish_operation(operation: ServiceOperation, status: str, error: str = ""):
+    operation.status = status
+    operation.error = error
+    operation.finished = timezone.now()
+    operation.save(update_fields=["status", "error", "finished"])
+    transaction.on_commit(lambda: publish_operation(operation))
+    _dispatch_next(operation.service_id)
+
+
+def start_operations(services: List[Service], operation: str) -> List[ServiceOperation]:
+    """
+        Record an operation that the caller runs itself for many services at once, ex: a batch restart.
+        The caller holds the lock on the service rows and already moved them to the pending status, keeping
+        their previous status on the service instances. Requests for these services queue behind meanwhile.
+    """
+    now = timezone.now()
+    operations = ServiceOperation.objects.bulk_create([
+        ServiceOperation(
+            service=service, operation=operation, status=OperationStatus.RUNNING, source_status=service.status,
+            started=now, heartbeat=now)
+        for service in services
+    ])
+    for record in operations:
+        transaction.on_commit(lambda record=record: publish_operation(record))
+    return operations
+
+
+def finish_operations(operations: List[ServiceOperation], status: str, error: str = ""):
+    """ Record the outcome of operations started with start_operations and dispatch the next operation of their services """
+    finished = timezone.now()
+    with transaction.atomic():
+        ServiceOperation.objects.filter(pk__in=[operation.pk for operation in operations]).update(
+            status=status, error=error, finished=finished)
+        for operation in operations:
+            operation.status, operation.error, operation.finished = status, error, finished
+            transaction.on_commit(lambda operation=operation: publish_operation(operation))
+            _dispatch_next(operation.service_id)
+
+
+@contextmanager
+def operations_heartbeat(*operations: ServiceOperation):
+    """ Refresh the heartbeat of running operations from a thread, so sweep_operations knows their worker is alive """
+    stop = threading.Event()
+    ids = [operation.pk for operation in operations]
+
+    def beat():
+        try:
+            while not stop.wait(settings.OPERATION_HEARTBEAT_INTERVAL):
+                ServiceOperation.objects.filter(
+                    pk__in=ids, status=OperationStatus.RUNNING).update(heartbeat=timezone.now())
+        except Exception:
+            logger.exception("Could not refresh the heartbeat of operations %s",
+                             ", ".join(str(operation.task_id) for operation in operations))
+        finally:
+            connection.close()
+
+    beater = threading.Thread(target=beat, name="usop-operation-heartbeat", daemon=True)
+    beater.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        beater.join()
+
+
+def execute_operation(operation: ServiceOperation, wait_timeout=None, arguments: Optional[Dict] = None) -> str:
+    """ Run a claimed operation, record its outcome and dispatch the next operation of the service """
+    service = operation.service
+    try:
+        with operations_heartbeat(operation):
+            perform_transition(
+                service, operation.operation, wait_timeout=wait_timeout, record=operation, arguments=arguments)
+    except OperationLimitTimeout:
+        # Not started, so it goes back to the queue keeping the pending status, the task retries it
+        operation.status = OperationStatus.QUEUED
+        operation.started = None
+        operation.heartbeat = timezone.now()
+        operation.save(update_fields=["status", "started", "heartbeat"])
+        publish_operation(operation)
+        raise
+    except Exception as e:
+        _finish_operation(operation, OperationStatus.FAILED, str(e))
+        raise
+    _finish_operation(operation, OperationStatus.SUCCEEDED)
+    return service.status
+
+
+@shared_task(bind=True)
+def run_operation(self, operation_id):
+    """ Worker side of enqueue_operation, returns the final status of the service """
+    operation = claim_operation(operation_id)
+    if operation is None:
+        return None
+    try:
+        return execute_operation(operation, wait_timeout=settings.LIMITER_WAIT_TIMEOUT)
+    except OperationLimitTimeout as e:
+        # Give the worker back instead of blocking it, the service stays in its pending status meanwhile
+        raise self.retry(exc=e, countdown=settings.LIMITER_RETRY_DELAY, max_retries=None)
+
+
+def _fail_lost_operation(operation: ServiceOperation):
+    """ Fail a running operation whose worker is gone, leaving its service in the failure status of the operation """
+    pending_status, failed_status = TRANSITION_STATES[operation.operation]
+    service = operation.service
+    if service.status == pending_status:
+        service.status = failed_status
+        with pipeline.suppress():
+            service.save(update_fields=["status"])
+        emit_transition(service, pending_status, failed_status, operation.operation)
+    _finish_operation(operation, OperationStatus.FAILED, str(_("The worker running the operation was lost")))
+
+
+def sweep_operations() -> Dict[str, int]:
+    """
+        Recover the operations that would otherwise block their service forever. Running operations whose
+        heartbeat stopped for OPERATION_TIMEOUT seconds lost their worker, they are failed. The next queued
+        operation of a service with nothing running is sent again when it was dispatched more than
+        OPERATION_DISPATCH_TIMEOUT seconds ago, as its message was lost or never sent.
+    """
+    now = timezone.now()
+    failed = 0
+    lost = ServiceOperation.objects.filter(
+        status=OperationStatus.RUNNING, heartbeat__lt=now - timedelta(seconds=settings.OPERATION_TIMEOUT))
+    for operation_id in lost.values_list("pk", flat=True):
+        with transaction.atomic():
+            operation = (
+                ServiceOperation.objects.select_for_update(skip_locked=True)
+                .filter(pk=operation_id, status=OperationStatus.RUNNING,
+                        heartbeat__lt=now - timedelta(seconds=settings.OPERATION_TIMEOUT))
+                .first()
+            )
+            if operation is None:
+                continue
+            operation.service = Service.objects.select_for_update().get(pk=operation.service_id)
+            logger.warning("Failing operation %s, its worker stopped sending heartbeats", operation.task_id)
+            _fail_lost_operation(operation)
+            failed += 1
+
+    dispatched = 0
+    stale = now - timedelta(seconds=settings.OPERATION_DISPATCH_TIMEOUT)
+    service_ids = (
+        ServiceOperation.objects
+        .filter(status=OperationStatus.QUEUED)
+        .exclude(heartbeat__gte=stale)
+        .exclude(service__operations__status=OperationStatus.RUNNING)
+        .values_list("service_id", flat=True)
+        .distinct()
+    )
+    for service_id in service_ids:
+        with transaction.atomic():
+            head = (
+                ServiceOperation.objects.select_for_update()
+                .filter(service_id=service_id, status__in=ACTIVE_OPERATION_STATUSES)
+                .order_by("created", "pk")
+                .first()
+            )
+            if head is None or head.status != OperationStatus.QUEUED or (head.heartbeat and head.heartbeat >= stale):
+                continue
+            logger.warning("Sending operation %s again, it was not picked by a worker", head.task_id)
+            _dispatch(head)
+            dispatched += 1
+    return {"failed": failed, "dispatched": dispatched}
+
+
+@shared_task
+def sweep_service_operations():
+    """ Periodic task that recovers operations stuck in the queue or lost with their worker """
+    return sweep_operations()
+
+
+@shared_task
+def reconcile_service_statuses():
+    """ Periodic task that syncs the status of all the services with the cluster """
+    return reconcile_services(Service.objects.all())
+
+
+@shared_task
+def warm_chart_cache(version_ids=None):
+    """ Pull the charts of the given template versions, or of every version in use, into the local chart cache """
+    versions = TemplateVersion.objects.select_related("template")
+    if version_ids is not None:
+        versions = versions.filter(pk__in=version_ids)
+    else:
+        versions = versions.filter(services__isnull=False).exclude(services__status=ServiceStatus.DESTROYED).distinct()
+    return chart_cache.warm(versions)
+
+
+@shared_task
+def backup_services():
+    """ Periodic task that queues a backup of every running service, the limiter bounds how many run per region """
+    services = Service.objects.filter(status__in=[ServiceStatus.RUNNING, ServiceStatus.DEGRADED])
+    queued = 0
+    for service in services.iterator():
+        try:
+            enqueue_operation(service, "backup")
+            queued += 1
+        except TransitionNotAllowed:
+            pass
+    return queued
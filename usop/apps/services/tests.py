@@ -1,3 +1,1433 @@
-from django.test import TestCase
+import base64
+import gzip
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from io import StringIO
+from types import SimpleNamespace
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import islice
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import transaction
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+
+from usop.apps.users.models import Org, User
+from usop.lib.CachedClassUtil import CachedClassUtil
+from usop.lib.ProcessUtil import ProcessOutput
+from usop.lib.QueryCountUtil import QueryCountUtil
+
+from .allocation import (CPU_UNITS, MEMORY_UNITS, CapacityNodeAllocator, PlacementIndex, PlacementPolicy,
+                         SortedBuckets, parse_quantity)
+from .bulk import BulkOperation, BulkResult, restart_in_batches
+from .backup import LocalObjectStore, backup_service, chunk_key, restore_service
+from .catalog import catalog_cache
+from .charts import HelmHomes
+from .controller import (RESTORE_STAGING_DIR, DefaultBillingController, KubernetesServiceController, ServiceController,
+                         cursor_logs, exec_stream, filter_logs)
+from .events import TRANSITION, Event, EventPipeline, EventSink, PubSubEventSink, pipeline
+from .fingerprint import desired_fingerprint
+from .interfaces import BillingState, LogLine, ReleaseState, ServiceVolume
+from .kube import KubeClient
+from .limits import LocalLimiter, OperationLimitTimeout, operation_slot
+from .models import Node, Region, Service, ServiceOperation, Template, TemplateSKU, TemplateVersion
+from .pubsub import org_channel, service_channel
+from .registry import ControllerRegistry
+from .reconcile import reconcile_services, resolve_status
+from .status import OperationStatus, ServiceStatus
+from .tasks import (claim_operation, enqueue_operation, perform_transition, run_operation, sweep_operations,
+                    warm_chart_cache)
+from .values import ValuesResolver, deep_merge, layer_digest
+from .views import catalog_items
+
+
+def create_services(count=1, org=None, region=None):
+    """ Services of a single template, with the org, region and catalog rows they need """
+    user = User.objects.first() or User.objects.create_user(email="admin@example.com", username="admin", password="x")
+    org = org or Org.objects.first() or Org.objects.create(name="org", admin_user=user)
+    region = region or Region.objects.first() or Region.objects.create(name="region", disabled=False, namespace="ns1")
+    template = Template.objects.first() or Template.objects.create(
+        name="template", chart_id="repo/chart", template_settings={"a": 1})
+    version = TemplateVersion.objects.first() or TemplateVersion.objects.create(
+        template=template, version_name="1.0", helm_repo="https://charts.example.com", version_settings={})
+    sku = TemplateSKU.objects.filter(region=region, org=org).first() or TemplateSKU.objects.create(
+        template=template, name="sku", region=region, org=org, sku_settings={})
+    return [
+        Service.objects.create(
+            name=f"service{index}", region=region, org=org, template_sku=sku, template_version=version)
+        for index in range(count)
+    ]
+
+
+class FakeKubeApi:
+    """
+        Local HTTP server answering Kubernetes API calls from canned responses, or from functions of the query,
+        and recording every request
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _answer(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                api.requests.append((self.command, url.path, query))
+                body = api.responses.get((self.command, url.path))
+                if callable(body):
+                    body = body(query)
+                if body is None and self.command == "DELETE":
+                    body = {"kind": "Status", "status": "Success"}
+                if body is None:
+                    self.send_response(404)
+                    body = {"kind": "Status", "status": "Failure", "code": 404}
+                else:
+                    self.send_response(200)
+                # Text bodies are sent as they are, like the log endpoint does
+                data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+                self.send_header("Content-Type", "text/plain" if isinstance(body, str) else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_DELETE = do_PATCH = _answer
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def deleted(self):
+        return [path for method, path, query in self.requests if method == "DELETE"]
+
+
+def release_secret(name, version, manifest, hooks=()):
+    """ Release secret as stored by helm, with the record gzipped and base64 encoded twice """
+    record = {"name": name, "version": version, "manifest": manifest, "hooks": [{"manifest": hook} for hook in hooks]}
+    encoded = base64.b64encode(base64.b64encode(gzip.compress(json.dumps(record).encode()))).decode()
+    return {
+        "metadata": {"name": f"sh.helm.release.v1.{name}.v{version}",
+                     "labels": {"owner": "helm", "name": name, "version": str(version)}},
+        "data": {"release": encoded},
+    }
+
+
+def discovery(*resources):
+    return {"resources": [
+        {"name": name, "kind": kind, "namespaced": namespaced} for name, kind, namespaced in resources]}
+
+
+DISCOVERY = {
+    ("GET", "/api/v1"): discovery(
+        ("services", "Service", True), ("configmaps", "ConfigMap", True), ("secrets", "Secret", True),
+        ("persistentvolumeclaims", "PersistentVolumeClaim", True)),
+    ("GET", "/apis/apps/v1"): discovery(("deployments", "Deployment", True), ("deployments/scale", "Scale", True)),
+    ("GET", "/apis/batch/v1"): discovery(("jobs", "Job", True)),
+    ("GET", "/apis/policy/v1"): discovery(("poddisruptionbudgets", "PodDisruptionBudget", True)),
+    ("GET", "/apis/autoscaling/v2"): discovery(("horizontalpodautoscalers", "HorizontalPodAutoscaler", True)),
+    ("GET", "/apis/rbac.authorization.k8s.io/v1"): discovery(
+        ("roles", "Role", True), ("clusterroles", "ClusterRole", False)),
+}
+
+
+def manifest(*objects):
+    return "\n---\n".join(
+        f"apiVersion: {api_version}\nkind: {kind}\nmetadata:\n  name: {name}\n" + (
+            f"  annotations:\n    {annotation}\n" if annotation else "")
+        for api_version, kind, name, annotation in objects)
+
+
+class KubernetesUninstallTests(TestCase):
+
+    def setUp(self):
+        self.service = create_services()[0]
+        self.namespace = self.service.namespace
+        self.secrets_path = f"/api/v1/namespaces/{self.namespace}/secrets"
+
+    def uninstall(self, responses):
+        with FakeKubeApi(responses) as api:
+            with mock.patch("usop.apps.services.controller.get_kube_client", return_value=KubeClient(api.url)):
+                KubernetesServiceController(self.service).uninstall_release(self.namespace)
+        return api
+
+    def test_deletes_the_objects_of_the_release_manifest(self):
+        name = str(self.service.pid)
+        release = release_secret(name, 2, manifest(
+            ("v1", "ConfigMap", "config", None),
+            ("v1", "Service", "web", None),
+            ("apps/v1", "Deployment", "web", None),
+            ("policy/v1", "PodDisruptionBudget", "web", None),
+            ("autoscaling/v2", "HorizontalPodAutoscaler", "web", None),
+            ("rbac.authorization.k8s.io/v1", "Role", "web", None),
+            ("rbac.authorization.k8s.io/v1", "ClusterRole", "web-cluster", None),
+            ("v1", "PersistentVolumeClaim", "data", None),
+            ("v1", "Secret", "kept", "helm.sh/resource-policy: keep"),
+        ), hooks=[manifest(("batch/v1", "Job", "migrate", None))])
+        old_release = release_secret(name, 1, manifest(("v1", "ConfigMap", "old", None)))
+        api = self.uninstall({**DISCOVERY, ("GET", self.secrets_path): {"items": [release, old_release]}})
+        ns = f"namespaces/{self.namespace}"
+        self.assertEqual(api.deleted(), [
+            f"/apis/batch/v1/{ns}/jobs/migrate",
+            "/apis/rbac.authorization.k8s.io/v1/clusterroles/web-cluster",
+            f"/apis/rbac.authorization.k8s.io/v1/{ns}/roles/web",
+            f"/apis/autoscaling/v2/{ns}/horizontalpodautoscalers/web",
+            f"/apis/policy/v1/{ns}/poddisruptionbudgets/web",
+            f"/apis/apps/v1/{ns}/deployments/web",
+            f"/api/v1/{ns}/services/web",
+            f"/api/v1/{ns}/configmaps/config",
+            self.secrets_path,
+        ])
+
+    def test_skips_kinds_the_cluster_does_not_serve(self):
+        release = release_secret(str(self.service.pid), 1, manifest(
+            ("example.com/v1", "Widget", "widget", None), ("v1", "ConfigMap", "config", None)))
+        with self.assertLogs("usop.apps.services.controller", "WARNING"):
+            api = self.uninstall({**DISCOVERY, ("GET", self.secrets_path): {"items": [release]}})
+        self.assertEqual(api.deleted(), [f"/api/v1/namespaces/{self.namespace}/configmaps/config", self.secrets_path])
+
+    def test_deletes_by_label_without_a_release_record(self):
+        api = self.uninstall({("GET", self.secrets_path): {"items": []}})
+        deleted = api.deleted()
+        self.assertEqual(len(deleted), len(KubernetesServiceController.FALLBACK_RELEASE_RESOURCES) + 1)
+        self.assertIn(f"/apis/apps/v1/namespaces/{self.namespace}/deployments", deleted)
+        selectors = {query["labelSelector"][0] for method, path, query in api.requests if method == "DELETE"}
+        self.assertEqual(selectors, {
+            f"app.kubernetes.io/instance={self.service.pid}", f"owner=helm,name={self.service.pid}"})
+
+
+@override_settings(DRY_RUN=False)
+class HelmNamespaceTests(TestCase):
+
+    def setUp(self):
+        self.service = create_services()[0]
+        self.service.org.namespace = "org-namespace"
+        self.service.status = ServiceStatus.RUNNING
+        self.commands = []
+        self.controller = ServiceController(self.service)
+        self.controller.run_command = lambda command, name: self.commands.append(command)
+
+    def namespace_of(self, command):
+        return command[command.index("--namespace") + 1]
+
+    def test_rollback_uses_the_namespace_of_the_service(self):
+        self.controller.rollback()
+        self.assertEqual(self.namespace_of(self.commands[0]), self.service.namespace)
+
+    def test_destroy_uses_the_namespace_of_the_service(self):
+        self.controller.destroy()
+        self.assertEqual(self.namespace_of(self.commands[0]), self.service.namespace)
+        self.assertEqual(self.service.status, ServiceStatus.DESTROYED)
+
+    def test_up_to_date_upgrade_prepares_no_release(self):
+        self.controller.mark_applied()
+        with mock.patch.object(ServiceController, "helm_release_args") as helm_release_args:
+            self.controller.upgrade()
+        helm_release_args.assert_not_called()
+        self.assertEqual(self.commands, [])
+
+
+class QueryCountTests(TestCase):
+
+    def add_services(self, count, status=ServiceStatus.RUNNING):
+        for service in create_services(count):
+            Service.objects.filter(pk=service.pk).update(status=status)
+
+    def test_listing_services_with_their_deployment_context(self):
+        def list_services():
+            for service in Service.objects.with_deployment_context():
+                (service.namespace, service.org.name, service.template_sku.template.name,
+                 service.template_version.template.chart_id)
+
+        QueryCountUtil.assert_constant_queries(list_services, self.add_services)
+
+    def test_admin_changelist(self):
+        user = User.objects.create_superuser(email="root@example.com", username="root", password="x")
+        self.client.force_login(user)
+
+        def changelist():
+            self.assertEqual(self.client.get("/admin/services/service/").status_code, 200)
+
+        QueryCountUtil.assert_constant_queries(changelist, self.add_services)
+
+    def test_reconcile(self):
+        def reconcile():
+            reconcile_services(Service.objects.all())
+            # Put the services back in the reconciled status for the next measure
+            Service.objects.update(status=ServiceStatus.RUNNING)
+
+        with mock.patch.object(ServiceController, "list_releases", return_value={}):
+            QueryCountUtil.assert_constant_queries(reconcile, self.add_services)
+
+
+class CachedClassUtilTests(TestCase):
+
+    def setUp(self):
+        CachedClassUtil.clear()
+        self.addCleanup(CachedClassUtil.clear)
+
+    def test_concurrent_callers_build_once(self):
+        calls = []
+        started = threading.Event()
+
+        def factory(class_):
+            calls.append(class_)
+            started.set()
+            time.sleep(0.1)
+            return class_()
+
+        with ThreadPoolExecutor(4) as executor:
+            first = executor.submit(CachedClassUtil.get_instance, "collections.Counter", factory)
+            started.wait(1)
+            others = [executor.submit(CachedClassUtil.get_instance, "collections.Counter", factory) for _ in range(3)]
+            instances = [first.result()] + [future.result() for future in others]
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(instance is instances[0] for instance in instances))
+        self.assertEqual(CachedClassUtil.stats()["instance"], {"hits": 3, "misses": 1, "size": 1})
+
+    def test_failed_build_is_retried(self):
+        with self.assertRaises(AttributeError):
+            CachedClassUtil.get_class("collections.Missing")
+        self.assertEqual(CachedClassUtil._building, {})
+        factory = mock.Mock(side_effect=[ValueError("boom"), "built"])
+        with self.assertRaises(ValueError):
+            CachedClassUtil.get_instance("collections.Counter", factory)
+        self.assertEqual(CachedClassUtil.get_instance("collections.Counter", factory), "built")
+        self.assertEqual(CachedClassUtil._building, {})
+
+    def test_least_recently_used_entries_are_evicted(self):
+        with mock.patch.object(CachedClassUtil, "max_size", 2):
+            CachedClassUtil.get_class("collections.Counter")
+            CachedClassUtil.get_class("collections.OrderedDict")
+            CachedClassUtil.get_class("collections.Counter")
+            CachedClassUtil.get_class("collections.deque")
+        self.assertEqual(list(CachedClassUtil._class_cache), ["collections.Counter", "collections.deque"])
+        self.assertEqual(CachedClassUtil.stats()["class"], {"hits": 1, "misses": 3, "size": 2})
+
+    def test_invalidate_and_clear(self):
+        first = CachedClassUtil.get_instance("collections.Counter")
+        CachedClassUtil.get_class("collections.deque")
+        CachedClassUtil.invalidate("collections.Counter")
+        self.assertIsNot(CachedClassUtil.get_instance("collections.Counter"), first)
+        self.assertEqual(CachedClassUtil.stats()["class"]["size"], 2)
+        CachedClassUtil.clear()
+        self.assertEqual(CachedClassUtil.stats(), {
+            "class": {"hits": 0, "misses": 0, "size": 0},
+            "instance": {"hits": 0, "misses": 0, "size": 0},
+        })
+
+
+class ControllerRegistryTests(TestCase):
+
+    def setUp(self):
+        self.service, = create_services()
+        self.registry = ControllerRegistry()
+
+    def test_lookup_falls_back_to_the_default(self):
+        self.assertIs(self.registry.get_for_service(self.service), ServiceController)
+        self.assertIs(self.registry.get_for_template(self.service.template_version.template), ServiceController)
+
+    def test_app_takes_precedence_over_chart(self):
+        template = self.service.template_version.template
+        self.registry.register(KubernetesServiceController, chart_id=template.chart_id)
+        self.assertIs(self.registry.get_for_service(self.service), KubernetesServiceController)
+        self.assertIs(self.registry.get_for_template(template), KubernetesServiceController)
+        self.registry.register("usop.apps.services.controller.ServiceController", app_name="shop")
+        self.service.app_name = "shop"
+        self.assertIs(self.registry.get_for_service(self.service), ServiceController)
+        self.service.app_name = "other"
+        self.assertIs(self.registry.get_for_service(self.service), KubernetesServiceController)
+
+    def test_register_needs_a_target(self):
+        with self.assertRaises(ValueError):
+            self.registry.register(ServiceController)
+
+    def test_build_registers_app_config_controllers(self):
+        app_configs = [
+            SimpleNamespace(name="usop.apps.shop", label="shop",
+                            service_controller="usop.apps.services.controller.KubernetesServiceController"),
+            SimpleNamespace(name="usop.apps.users", label="users"),
+        ]
+        with mock.patch("usop.apps.services.registry.apps.get_app_configs", return_value=app_configs), \
+                override_settings(SERVICE_CONTROLLER="usop.apps.services.controller.ServiceController"):
+            self.registry.build()
+        self.assertIs(self.registry.default, ServiceController)
+        self.assertEqual(self.registry._by_app, {
+            "usop.apps.shop": KubernetesServiceController, "shop": KubernetesServiceController})
+        self.service.app_name = "shop"
+        self.assertIs(self.registry.get_for_service(self.service), KubernetesServiceController)
+
+
+class ValuesResolverTests(TestCase):
+
+    def setUp(self):
+        self.first, self.second = create_services(2)
+        template = self.first.template_version.template
+        template.template_settings = {"image": {"tag": "1", "pull": "Always"}, "ports": [80], "replicas": 1}
+        template.save()
+        self.first.template_version.version_settings = {"image": {"tag": "2"}}
+        self.first.template_version.save()
+        self.first.template_sku.sku_settings = {"ports": [443], "replicas": 2}
+        self.first.template_sku.save()
+        self.first.settings = {"replicas": 3, "env": {"A": "1"}}
+        self.first.save()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def services(self):
+        return {service.pk: service for service in Service.objects.with_deployment_context()}
+
+    def test_deep_merge_overrides_leaves_and_replaces_lists(self):
+        base = {"image": {"tag": "1", "pull": "Always"}, "ports": [80, 8080]}
+        override = {"image": {"tag": "2"}, "ports": [443]}
+        self.assertEqual(deep_merge(base, override), {"image": {"tag": "2", "pull": "Always"}, "ports": [443]})
+        self.assertEqual(base, {"image": {"tag": "1", "pull": "Always"}, "ports": [80, 8080]})
+        self.assertEqual(deep_merge(None, None), {})
+
+    def test_layers_merge_from_template_to_service(self):
+        services = self.services()
+        resolver = ValuesResolver()
+        self.assertEqual(resolver.resolve(services[self.first.pk]), {
+            "image": {"tag": "2", "pull": "Always"}, "ports": [443], "replicas": 3, "env": {"A": "1"}})
+        self.assertEqual(resolver.resolve(services[self.second.pk])["replicas"], 2)
+
+    def test_shared_layers_are_merged_and_hashed_once(self):
+        resolver = ValuesResolver()
+        with mock.patch("usop.apps.services.values.layer_digest", wraps=layer_digest) as digest:
+            for service in self.services().values():
+                resolver.digest(service)
+            # The merged base once, then the settings and the values of the first service
+            self.assertEqual(digest.call_count, 3)
+            for service in self.services().values():
+                resolver.digest(service)
+            self.assertEqual(digest.call_count, 4)
+
+    def test_saving_a_layer_invalidates_its_merges(self):
+        resolver = ValuesResolver()
+        before = resolver.digest(self.services()[self.second.pk])
+        sku = self.second.template_sku
+        sku.sku_settings = {"replicas": 5}
+        sku.save(update_fields=["sku_settings"])
+        service = self.services()[self.second.pk]
+        self.assertNotEqual(resolver.digest(service), before)
+        self.assertEqual(resolver.resolve(service)["replicas"], 5)
+
+    def test_values_file_is_shared_by_services_with_the_same_values(self):
+        resolver = ValuesResolver()
+        services = self.services()
+        self.second.settings = {"replicas": 3, "env": {"A": "1"}}
+        with override_settings(HELM_VALUES_DIR=self.directory.name):
+            path = resolver.values_file(services[self.first.pk])
+            self.assertEqual(resolver.values_file(self.second), path)
+            self.assertNotEqual(resolver.values_file(services[self.second.pk]), path)
+        with open(path) as f:
+            self.assertEqual(json.load(f), resolver.resolve(services[self.first.pk]))
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+
+
+class RecordingSink(EventSink):
+    """ Keeps the batches written by the pipeline in memory """
+
+    batches = []
+
+    def write(self, events):
+        self.batches.append(list(events))
+
+
+class FailingSink(EventSink):
+
+    def write(self, events):
+        raise RuntimeError("sink down")
+
+
+SINK = "usop.apps.services.tests.RecordingSink"
+
+
+class EventPipelineTests(TestCase):
+
+    def setUp(self):
+        RecordingSink.batches = []
+        self.events = [Event(event_type=TRANSITION, model="Service", object_id=pk) for pk in range(5)]
+
+    def test_flush_writes_in_batches(self):
+        events = EventPipeline([SINK], batch_size=2)
+        with mock.patch.object(events, "_ensure_thread"), self.captureOnCommitCallbacks(execute=True):
+            for event in self.events:
+                events.emit(event)
+        events.flush()
+        self.assertEqual([len(batch) for batch in RecordingSink.batches], [2, 2, 1])
+        self.assertEqual([event for batch in RecordingSink.batches for event in batch], self.events)
+
+    def test_background_thread_writes_after_the_flush_interval(self):
+        events = EventPipeline([SINK], batch_size=10, flush_interval=0.05)
+        with self.captureOnCommitCallbacks(execute=True):
+            for event in self.events:
+                events.emit(event)
+        deadline = time.monotonic() + 2
+        while not RecordingSink.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(RecordingSink.batches, [self.events])
+
+    def test_every_sink_gets_the_batch_even_when_one_fails(self):
+        events = EventPipeline(["usop.apps.services.tests.FailingSink", SINK, SINK])
+        with mock.patch("usop.apps.services.events.logger") as logger:
+            events._write(self.events)
+        logger.exception.assert_called_once()
+        self.assertEqual(RecordingSink.batches, [self.events, self.events])
+
+    def test_rolled_back_suppressed_and_overflowing_events_are_not_written(self):
+        events = EventPipeline([SINK], max_queue=2)
+        with mock.patch.object(events, "_ensure_thread"):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks, events.suppress():
+                events.emit(self.events[0])
+            self.assertEqual(callbacks, [])
+            with self.captureOnCommitCallbacks(execute=True):
+                for event in self.events:
+                    events.emit(event)
+        events.flush()
+        self.assertEqual(RecordingSink.batches, [self.events[:2]])
+        self.assertEqual(events.dropped, 3)
+
+    def test_bulk_paths_emit_one_event(self):
+        services = create_services(3)
+        Service.objects.update(status=ServiceStatus.RUNNING)
+        with mock.patch.object(pipeline, "emit") as emit:
+            for service in services:
+                service.name = "renamed"
+            Service.objects.bulk_update(services, ["name"])
+            emit.assert_not_called()
+            with mock.patch.object(ServiceController, "list_releases", return_value={}):
+                reconcile_services(Service.objects.all())
+        emit.assert_called_once()
+        event = emit.call_args.args[0]
+        self.assertEqual((event.object_id, event.count, event.source, event.target),
+                         (None, 3, ServiceStatus.RUNNING, ServiceStatus.STOPPED))
+        self.assertEqual(sorted(pk for pk, _ in event.objects), sorted(service.pk for service in services))
+
+
+class AllocationTests(TestCase):
+
+    def setUp(self):
+        CapacityNodeAllocator._allocators.clear()
+        self.region = Region.objects.create(
+            name="placed", disabled=False, namespace="ns3", placement_policy=PlacementPolicy.BINPACK)
+        self.nodes = {
+            name: Node.objects.create(region=self.region, name=name, cpu_capacity=cpu, memory_capacity=memory)
+            for name, cpu, memory in [("small", 1000, 2 ** 30), ("large", 4000, 2 ** 30)]
+        }
+
+    def services(self, *cpus):
+        services = create_services(len(cpus), region=self.region)
+        for service, cpu in zip(services, cpus):
+            service.settings = {"resources": {"requests": {"cpu": cpu, "memory": "64Mi"}}}
+            service.save()
+        return list(Service.objects.with_deployment_context().select_related("node").filter(region=self.region).order_by("pk"))
+
+    def test_parse_quantity(self):
+        cases = [
+            ("500m", CPU_UNITS, 500), ("2", CPU_UNITS, 2000), ("0.5", CPU_UNITS, 500), ("250000u", CPU_UNITS, 250),
+            ("128Mi", MEMORY_UNITS, 128 * 2 ** 20), ("1G", MEMORY_UNITS, 10 ** 9), (1024, MEMORY_UNITS, 1024),
+        ]
+        for value, units, expected in cases:
+            with self.subTest(value=value):
+                self.assertEqual(parse_quantity(value, units), expected)
+        for value in ["", "1Mi", "-1", "abc"]:
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_quantity(value, CPU_UNITS)
+
+    def test_sorted_buckets_stay_sorted(self):
+        with mock.patch.object(SortedBuckets, "load", 2):
+            items = SortedBuckets([5, 1, 9, 3])
+            expected = [1, 3, 5, 9]
+            for value in [4, 0, 10, 6, 7, 8, 2, 2]:
+                items.add(value)
+                expected.append(value)
+            for value in [9, 0, 2, 10]:
+                items.remove(value)
+                expected.remove(value)
+            expected.sort()
+            self.assertEqual(list(items), expected)
+            self.assertEqual(list(reversed(items)), expected[::-1])
+            self.assertEqual(len(items), len(expected))
+            self.assertEqual(list(items.from_item(5)), [value for value in expected if value >= 5])
+            self.assertEqual(list(items.from_item(11)), [])
+
+    def test_placement_policies(self):
+        capacity = {"a": (1000, 2 ** 30), "b": (2000, 2 ** 30), "c": (4000, 2 ** 20)}
+        binpack = PlacementIndex(capacity, PlacementPolicy.BINPACK)
+        spread = PlacementIndex(capacity, PlacementPolicy.SPREAD)
+        # The fullest node that fits, and the emptiest one with enough memory
+        self.assertEqual(binpack.find(500, 2 ** 20), "a")
+        self.assertEqual(spread.find(500, 2 ** 20), "c")
+        self.assertEqual(spread.find(500, 2 ** 21), "b")
+        self.assertEqual(binpack.find(1500, 2 ** 21), "b")
+        self.assertIsNone(binpack.find(5000, 1))
+
+    def test_index_tracks_commits_and_releases(self):
+        index = PlacementIndex({"a": (1000, 2 ** 30), "b": (2000, 2 ** 30)}, PlacementPolicy.BINPACK)
+        index.commit("b", 1500, 2 ** 20)
+        self.assertEqual(index.free("b"), (500, 2 ** 30 - 2 ** 20))
+        self.assertEqual(index.find(600, 1), "a")
+        self.assertEqual(index.find(200, 1), "b")
+        index.release("b", 1500, 2 ** 20)
+        self.assertEqual(index.find(1500, 1), "b")
+        index.commit("unknown", 1, 1)
+        self.assertIsNone(index.free("unknown"))
+
+    def test_allocate_many_places_the_largest_first_with_one_update_per_node(self):
+        services = self.services("600m", "3", "500m")
+        allocator = self.region.get_node_allocator()
+        with self.assertNumQueries(7):
+            # Savepoint, lock, nodes, placed services, one update per node and the release
+            placements = allocator.allocate_many(services)
+        # Once the largest is placed both nodes have 1000m free, ties go to the node sorted first
+        self.assertEqual(placements, {services[0].pk: "large", services[1].pk: "large", services[2].pk: "small"})
+        self.assertEqual(
+            dict(Service.objects.filter(region=self.region).values_list("pk", "node__name")), placements)
+
+    def test_allocate_many_skips_services_placed_elsewhere_and_those_that_do_not_fit(self):
+        placed, too_large, fits = self.services("500m", "8", "500m")
+        Service.objects.filter(pk=placed.pk).update(node=self.nodes["large"])
+        placements = self.region.get_node_allocator().allocate_many([placed, too_large, fits])
+        self.assertEqual(placements, {fits.pk: "small"})
+        self.assertEqual(
+            dict(Service.objects.filter(region=self.region).values_list("pk", "node__name")),
+            {placed.pk: "large", too_large.pk: None, fits.pk: "small"})
+
+    def test_allocate_keeps_the_node_of_a_concurrent_placement(self):
+        service, = self.services("500m")
+        allocator = self.region.get_node_allocator()
+        allocator._get_index()
+        Service.objects.filter(pk=service.pk).update(node=self.nodes["large"])
+        self.assertEqual(allocator.allocate(service), "large")
+        self.assertEqual(service.node, self.nodes["large"])
+        self.assertEqual(allocator._index.free("small"), (1000, 2 ** 30))
+        self.assertEqual(allocator._index.free("large"), (3500, 2 ** 30 - 64 * 2 ** 20))
+
+    def test_bulk_deploy_allocates_once_per_region(self):
+        services = self.services("500m", "500m")
+        unplaced, = create_services(region=Region.objects.create(name="plain", disabled=False, namespace="ns4"))
+        bulk = BulkOperation(Service.objects.all(), "deploy", concurrency=1)
+        result = lambda service: BulkResult(service.pk, service.name, "", "", "ok", service.status)
+        with mock.patch.object(CapacityNodeAllocator, "allocate_many", autospec=True,
+                               side_effect=CapacityNodeAllocator.allocate_many) as allocate_many, \
+                mock.patch.object(bulk, "_run_one", side_effect=result):
+            bulk.run()
+        allocate_many.assert_called_once()
+        self.assertEqual(
+            dict(Service.objects.values_list("pk", "node__name")),
+            {services[0].pk: "small", services[1].pk: "small", unplaced.pk: None})
+
+
+class ReconcileTests(TestCase):
+
+    def test_resolve_status(self):
+        deployed, failed = ReleaseState("r", "deployed"), ReleaseState("r", "failed")
+        unready, uninstalled = ReleaseState("r", "deployed", ready=False), ReleaseState("r", "uninstalled")
+        cases = [
+            (ServiceStatus.RUNNING, None, ServiceStatus.STOPPED),
+            (ServiceStatus.DEGRADED, uninstalled, ServiceStatus.STOPPED),
+            (ServiceStatus.CLEARING_FAILED, None, ServiceStatus.DESTROYED),
+            (ServiceStatus.DEPLOYING_FAILED, None, ServiceStatus.DEPLOYING_FAILED),
+            (ServiceStatus.RUNNING, unready, ServiceStatus.DEGRADED),
+            (ServiceStatus.DEGRADED, deployed, ServiceStatus.RUNNING),
+            (ServiceStatus.STOPPED, deployed, ServiceStatus.RUNNING),
+            (ServiceStatus.TO_UPGRADE, deployed, ServiceStatus.TO_UPGRADE),
+            (ServiceStatus.UPGRADING_FAILED, deployed, ServiceStatus.UPGRADING_FAILED),
+            (ServiceStatus.RUNNING, failed, ServiceStatus.UPGRADING_FAILED),
+            (ServiceStatus.STOPPED, failed, ServiceStatus.DEPLOYING_FAILED),
+            (ServiceStatus.RUNNING, ReleaseState("r", "pending-upgrade"), ServiceStatus.RUNNING),
+            # Intermediate statuses belong to the worker running the operation
+            (ServiceStatus.UPGRADING, None, ServiceStatus.UPGRADING),
+            (ServiceStatus.NEW, deployed, ServiceStatus.NEW),
+        ]
+        for current, release, expected in cases:
+            with self.subTest(current=current, release=release and release.status):
+                self.assertEqual(resolve_status(current, release), expected)
+
+    def test_services_without_release_are_stopped_and_forget_their_applied_state(self):
+        gone, deployed = create_services(2)
+        Service.objects.update(status=ServiceStatus.RUNNING, applied_fingerprint="applied")
+        releases = {str(deployed.pid): ReleaseState(str(deployed.pid), "deployed")}
+        with mock.patch.object(ServiceController, "list_releases", return_value=releases) as list_releases:
+            self.assertEqual(reconcile_services(Service.objects.all()), {f"{ServiceStatus.RUNNING}->{ServiceStatus.STOPPED}": 1})
+        list_releases.assert_called_once_with(gone.namespace)
+        gone.refresh_from_db()
+        deployed.refresh_from_db()
+        self.assertEqual((gone.status, gone.applied_fingerprint), (ServiceStatus.STOPPED, None))
+        self.assertEqual((deployed.status, deployed.applied_fingerprint), (ServiceStatus.RUNNING, "applied"))
+
+
+@override_settings(DRY_RUN=False, HELM_COMMAND=[sys.executable, "-c", "print('Error: chart not found'); exit(1)"])
+class PerformTransitionTests(TestCase):
+
+    def setUp(self):
+        for name in ("tasks", "controller"):
+            patcher = mock.patch(f"usop.apps.services.{name}.logger")
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_failed_transition_leaves_the_failure_status_and_records_the_output(self):
+        service = create_services()[0]
+        record = ServiceOperation.objects.create(service=service, operation="deploy")
+        with self.assertRaisesRegex(Exception, "Helm command failed with return code 1"):
+            perform_transition(service, "deploy", record=record)
+        service.refresh_from_db()
+        record.refresh_from_db()
+        self.assertEqual(service.status, ServiceStatus.DEPLOYING_FAILED)
+        self.assertIn("Error: chart not found", record.output)
+
+
+@override_settings(LIMITER_ORG_CONCURRENCY=1, LIMITER_NAMESPACE_CONCURRENCY=2, LIMITER_POLL_INTERVAL=0.01)
+class OperationSlotTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("usop.apps.services.limits.get_limiter", return_value=LocalLimiter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = create_services()[0]
+        user = self.service.org.admin_user
+        self.other_service = create_services(org=Org.objects.create(name="other", admin_user=user))[0]
+
+    def test_waiting_on_the_org_limit_holds_no_other_slot(self):
+        errors = []
+
+        def wait_on_org():
+            try:
+                with operation_slot(self.service, timeout=0.5):
+                    pass
+            except OperationLimitTimeout as e:
+                errors.append(e)
+
+        with operation_slot(self.service):
+            waiting = threading.Thread(target=wait_on_org)
+            waiting.start()
+            time.sleep(0.05)
+            # The namespace has room for one more operation, the one waiting on its org does not take it
+            with operation_slot(self.other_service, timeout=0.2):
+                pass
+            waiting.join()
+        self.assertEqual(len(errors), 1)
+
+    def test_namespace_limit_applies_across_orgs(self):
+        third_service = create_services(org=Org.objects.create(name="third", admin_user=self.service.org.admin_user))[0]
+        with operation_slot(self.service), operation_slot(self.other_service):
+            with self.assertRaises(OperationLimitTimeout):
+                with operation_slot(third_service, timeout=0.05):
+                    pass
+
+    @override_settings(LIMITER_LEASE_SECONDS=0.03)
+    def test_lease_is_renewed_while_the_operation_runs(self):
+        limiter = mock.Mock(wraps=LocalLimiter())
+        with mock.patch("usop.apps.services.limits.get_limiter", return_value=limiter):
+            with operation_slot(self.service):
+                threading.Event().wait(0.1)
+        self.assertGreaterEqual(limiter.renew.call_count, 2)
+        limiter.release.assert_called_once()
+
+
+@override_settings(OPERATION_TIMEOUT=900, OPERATION_DISPATCH_TIMEOUT=300)
+class SweepOperationsTests(TestCase):
+
+    def setUp(self):
+        self.service = create_services()[0]
+        patcher = mock.patch.object(run_operation, "apply_async")
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+        logger_patcher = mock.patch("usop.apps.services.tasks.logger")
+        logger_patcher.start()
+        self.addCleanup(logger_patcher.stop)
+
+    def age(self, operation, seconds):
+        ServiceOperation.objects.filter(pk=operation.pk).update(
+            heartbeat=timezone.now() - timedelta(seconds=seconds))
+
+    def sweep(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return sweep_operations()
+
+    def test_fails_running_operations_of_lost_workers_and_dispatches_the_next_one(self):
+        running = enqueue_operation(self.service, "deploy", dispatch=False)
+        claim_operation(running.pk)
+        queued = enqueue_operation(self.service, "destroy", dispatch=False)
+        self.age(running, 1000)
+        self.assertEqual(self.sweep(), {"failed": 1, "dispatched": 0})
+        running.refresh_from_db()
+        self.service.refresh_from_db()
+        self.assertEqual(running.status, OperationStatus.FAILED)
+        self.assertEqual(self.service.status, ServiceStatus.DEPLOYING_FAILED)
+        self.apply_async.assert_called_once_with(args=(queued.pk,), task_id=str(queued.task_id))
+
+    def test_keeps_running_operations_with_a_recent_heartbeat(self):
+        running = enqueue_operation(self.service, "deploy", dispatch=False)
+        claim_operation(running.pk)
+        self.age(running, 60)
+        self.assertEqual(self.sweep(), {"failed": 0, "dispatched": 0})
+        running.refresh_from_db()
+        self.assertEqual(running.status, OperationStatus.RUNNING)
+
+    def test_dispatches_queued_operations_again_once(self):
+        queued = enqueue_operation(self.service, "deploy", dispatch=False)
+        self.assertEqual(self.sweep(), {"failed": 0, "dispatched": 1})
+        self.assertEqual(self.sweep(), {"failed": 0, "dispatched": 0})
+        self.age(queued, 400)
+        self.assertEqual(self.sweep(), {"failed": 0, "dispatched": 1})
+        self.assertEqual(self.apply_async.call_count, 2)
+
+
+class CoalescingTests(TestCase):
+
+    def setUp(self):
+        self.service = create_services()[0]
+        Service.objects.filter(pk=self.service.pk).update(status=ServiceStatus.RUNNING)
+
+    def enqueue(self, *operations):
+        return [enqueue_operation(self.service, operation, dispatch=False) for operation in operations]
+
+    def assertOperations(self, *expected):
+        operations = ServiceOperation.objects.filter(service=self.service).order_by("created", "pk")
+        self.assertEqual([(operation.operation, operation.requests) for operation in operations], list(expected))
+
+    def test_repeated_requests_share_one_operation(self):
+        first, second, third = self.enqueue("upgrade", "upgrade", "upgrade")
+        self.assertEqual({first.pk, second.pk, third.pk}, {first.pk})
+        self.assertEqual({first.task_id, second.task_id, third.task_id}, {first.task_id})
+        self.assertOperations(("upgrade", 3))
+        self.service.refresh_from_db()
+        self.assertEqual(self.service.status, ServiceStatus.UPGRADING)
+
+    def test_stop_then_deploy_becomes_a_restart(self):
+        stop, deploy = self.enqueue("stop", "deploy")
+        self.assertEqual(deploy.pk, stop.pk)
+        self.assertOperations(("restart", 2))
+        self.service.refresh_from_db()
+        self.assertEqual(self.service.status, ServiceStatus.RESTARTING)
+
+    def test_duplicate_of_the_running_operation_returns_its_handle(self):
+        running, = self.enqueue("upgrade")
+        claim_operation(running.pk)
+        duplicate, other = self.enqueue("upgrade", "restart")
+        self.assertEqual(duplicate.task_id, running.task_id)
+        self.assertNotEqual(other.task_id, running.task_id)
+        self.assertOperations(("upgrade", 2), ("restart", 1))
+
+    def test_refused_retarget_queues_behind(self):
+        Service.objects.filter(pk=self.service.pk).update(status=ServiceStatus.STOPPING_FAILED)
+        stop, deploy = self.enqueue("stop", "deploy")
+        # A restart is not allowed from STOPPING_FAILED, so the deploy waits for the stop
+        self.assertNotEqual(deploy.pk, stop.pk)
+        self.assertEqual(deploy.status, OperationStatus.QUEUED)
+        self.assertIsNone(deploy.source_status)
+        self.assertOperations(("stop", 1), ("deploy", 1))
+        self.service.refresh_from_db()
+        self.assertEqual(self.service.status, ServiceStatus.STOPPING)
+
+
+@override_settings(HELM_CHART_PREPULL=False)
+class BulkOperationTests(TransactionTestCase):
+    """ Bulk runs through the operation queue, with the helm commands replaced by a recorder """
+
+    def setUp(self):
+        self.upgraded = []
+
+        def run_command(controller, command, name):
+            if controller.service.name == "broken":
+                raise Exception("Helm command failed with return code 1")
+            self.upgraded.append(controller.service.name)
+
+        for attribute, kwargs in [
+                ("run_command", {"autospec": True, "side_effect": run_command}),
+                ("helm_release_args", {"return_value": []})]:
+            patcher = mock.patch.object(ServiceController, attribute, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("usop.apps.services.tasks.logger")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.services = {}
+        for name, status in [("ok", ServiceStatus.RUNNING), ("unchanged", ServiceStatus.RUNNING),
+                             ("skipped", ServiceStatus.STOPPED), ("broken", ServiceStatus.RUNNING)]:
+            service = create_services()[0]
+            service.name, service.status = name, status
+            service.applied_fingerprint = desired_fingerprint(service) if name == "unchanged" else "old"
+            service.save()
+            self.services[name] = service
+        user = self.services["ok"].org.admin_user
+        denied = create_services(org=Org.objects.create(name="unpaid", admin_user=user))[0]
+        denied.name, denied.status = "denied", ServiceStatus.RUNNING
+        denied.save()
+        self.denied_org = denied.org_id
+
+    def load_states(self, org_ids):
+        return {org_id: BillingState(allowed=org_id != self.denied_org, reason="Unpaid") for org_id in org_ids}
+
+    def run_bulk(self, **kwargs):
+        with mock.patch.object(DefaultBillingController, "load_states", side_effect=self.load_states):
+            results = BulkOperation(Service.objects.all(), "upgrade", concurrency=1, **kwargs).run()
+        return {result.name: result for result in results}
+
+    def test_outcomes_of_every_service(self):
+        results = self.run_bulk()
+        self.assertEqual({name: result.outcome for name, result in results.items()}, {
+            "ok": "ok", "unchanged": "unchanged", "skipped": "skipped", "broken": "failed", "denied": "failed"})
+        self.assertEqual(results["broken"].status, ServiceStatus.UPGRADING_FAILED)
+        self.assertEqual(results["denied"].error, "Billing failed")
+        self.assertEqual(self.upgraded, ["ok"])
+        self.assertEqual(BulkOperation.summarize(results.values()), {"ok": 1, "unchanged": 1, "skipped": 1, "failed": 2})
+
+    def test_force_upgrades_unchanged_services_and_keeps_the_state_of_the_others(self):
+        results = self.run_bulk(force=True)
+        self.assertEqual(results["unchanged"].outcome, "ok", results["unchanged"].error)
+        self.assertEqual(sorted(self.upgraded), ["ok", "unchanged"])
+        skipped = Service.objects.get(pk=self.services["skipped"].pk)
+        self.assertEqual(skipped.applied_fingerprint, "old")
+
+    def test_billing_is_checked_once_for_the_whole_run(self):
+        with mock.patch.object(DefaultBillingController, "can_deploy") as can_deploy, \
+                mock.patch.object(DefaultBillingController, "deployed_counts") as deployed_counts:
+            results = self.run_bulk()
+        self.assertEqual(results["ok"].outcome, "ok")
+        can_deploy.assert_not_called()
+        deployed_counts.assert_not_called()
+
+    def test_command_reports_the_failures(self):
+        out = StringIO()
+        with mock.patch.object(DefaultBillingController, "load_states", side_effect=self.load_states):
+            with self.assertRaisesRegex(CommandError, "2 services failed to upgrade"):
+                call_command("bulk_services", "upgrade", "--concurrency", "1", stdout=out)
+        self.assertIn("failed: 2, ok: 1, skipped: 1, unchanged: 1", out.getvalue())
+        self.assertIn("failed\tdenied\tregion\tBilling failed", out.getvalue())
+
+    def test_command_dry_run_lists_the_matching_services(self):
+        out = StringIO()
+        call_command("bulk_services", "upgrade", "--dry-run", "--status", ServiceStatus.STOPPED, stdout=out)
+        self.assertIn("\tskipped\tregion\tstopped", out.getvalue().lower())
+        self.assertIn("1 services match", out.getvalue())
+        self.assertEqual(self.upgraded, [])
+
+
+class BillingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.limited, self.unlimited, self.unpaid = orgs = [
+            Org.objects.create(name=name, admin_user=User.objects.first() or User.objects.create_user(
+                email="admin@example.com", username="admin", password="x"))
+            for name in ["limited", "unlimited", "unpaid"]
+        ]
+        self.states = {
+            self.limited.pk: BillingState(max_services=2),
+            self.unlimited.pk: BillingState(),
+            self.unpaid.pk: BillingState(allowed=False, reason="Unpaid"),
+        }
+        self.services = {org.pk: create_services(3, org=org) for org in orgs}
+        self.billing = DefaultBillingController()
+
+    def load_states(self, org_ids):
+        return {org_id: self.states[org_id] for org_id in org_ids if org_id in self.states}
+
+    def test_quota_counts_deployed_services_and_the_batch(self):
+        running, destroyed, new = self.services[self.limited.pk]
+        Service.objects.filter(pk=running.pk).update(status=ServiceStatus.RUNNING)
+        Service.objects.filter(pk=destroyed.pk).update(status=ServiceStatus.DESTROYED)
+        extra = create_services(2, org=self.limited)
+        batch = [destroyed, new, *extra, *self.services[self.unlimited.pk], self.services[self.unpaid.pk][0]]
+        with mock.patch.object(DefaultBillingController, "load_states", side_effect=self.load_states) as load_states:
+            with self.assertNumQueries(1):
+                allowed = self.billing.can_deploy_many(batch)
+        load_states.assert_called_once()
+        # The running service takes one of the two slots, the first service of the batch the other one
+        self.assertEqual(allowed, {
+            destroyed.pk: True, new.pk: False, extra[0].pk: False, extra[1].pk: False,
+            **{service.pk: True for service in self.services[self.unlimited.pk]},
+            self.services[self.unpaid.pk][0].pk: False,
+        })
+
+    def test_orgs_without_a_state_are_denied(self):
+        del self.states[self.unlimited.pk]
+        service = self.services[self.unlimited.pk][0]
+        with mock.patch.object(DefaultBillingController, "load_states", side_effect=self.load_states):
+            self.assertFalse(self.billing.can_deploy(service))
+
+    def test_states_are_cached_until_invalidated(self):
+        services = [self.services[self.unlimited.pk][0], self.services[self.unpaid.pk][0]]
+        with mock.patch.object(DefaultBillingController, "load_states", side_effect=self.load_states) as load_states:
+            self.billing.can_deploy_many(services)
+            with self.assertNumQueries(0):
+                self.assertTrue(self.billing.can_deploy(services[0]))
+            self.assertEqual(load_states.call_count, 1)
+            self.states[self.unpaid.pk] = BillingState()
+            self.assertFalse(self.billing.can_deploy(services[1]))
+            self.billing.invalidate(self.unpaid.pk)
+            self.assertTrue(self.billing.can_deploy(services[1]))
+        self.assertEqual([call.args[0] for call in load_states.call_args_list][1:], [[self.unpaid.pk]])
+
+    def test_transitions_check_billing_unless_told_otherwise(self):
+        service = self.services[self.unpaid.pk][0]
+        with mock.patch.object(DefaultBillingController, "load_states", side_effect=self.load_states), \
+                mock.patch.object(ServiceController, "run_command") as run_command, \
+                mock.patch.object(ServiceController, "helm_release_args", return_value=[]):
+            with self.assertRaisesRegex(Exception, "Billing failed"):
+                ServiceController(service).deploy()
+            run_command.assert_not_called()
+            ServiceController(service).deploy(billing_checked=True)
+        run_command.assert_called_once()
+        self.assertEqual(service.status, ServiceStatus.RUNNING)
+
+
+class BulkScheduleTests(TestCase):
+
+    def setUp(self):
+        self.first = create_services(3)
+        region = Region.objects.create(name="second", disabled=False, namespace="ns2")
+        self.second = create_services(2, region=region)
+
+    def test_schedule_interleaves_the_namespaces(self):
+        services = BulkOperation(Service.objects.none(), "restart")._schedule(self.first + self.second)
+        self.assertEqual([service.namespace for service in services], ["ns1", "ns2", "ns1", "ns2", "ns1"])
+
+    def peaks(self, **limits):
+        """ Most operations running at once in each namespace and overall """
+        running, peaks, lock = defaultdict(int), defaultdict(int), threading.Lock()
+        services = {service.pk: service for service in self.first + self.second}
+
+        def execute(operation, arguments=None):
+            keys = (operation.service.namespace, "all")
+            with lock:
+                for key in keys:
+                    running[key] += 1
+                    peaks[key] = max(peaks[key], running[key])
+            time.sleep(0.05)
+            with lock:
+                for key in keys:
+                    running[key] -= 1
+
+        bulk = BulkOperation(Service.objects.none(), "restart", concurrency=4, **limits)
+        with mock.patch("usop.apps.services.bulk.enqueue_operation", side_effect=lambda service, *args, **kwargs: service), \
+                mock.patch("usop.apps.services.bulk.claim_operation",
+                           side_effect=lambda pk: SimpleNamespace(service=services[pk])), \
+                mock.patch("usop.apps.services.bulk.execute_operation", side_effect=execute), \
+                mock.patch("usop.apps.services.bulk.connection"):
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                results = list(pool.map(bulk._run_one, bulk._schedule(list(services.values()))))
+        self.assertEqual({result.outcome for result in results}, {"ok"})
+        return peaks["ns1"], peaks["ns2"], peaks["all"]
+
+    def test_namespace_limit(self):
+        self.assertEqual(self.peaks(per_region=4, per_namespace=1), (1, 1, 2))
+
+    def test_region_limit(self):
+        self.assertEqual(self.peaks(per_region=2, per_namespace=4), (2, 2, 4))
+
+
+class RestartInBatchesTests(TestCase):
+
+    def setUp(self):
+        self.running, self.degraded, self.new = create_services(3)
+        Service.objects.filter(pk=self.running.pk).update(status=ServiceStatus.RUNNING)
+        Service.objects.filter(pk=self.degraded.pk).update(status=ServiceStatus.DEGRADED)
+        patcher = mock.patch.object(run_operation, "apply_async")
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def restart(self, restart_releases):
+        with mock.patch.object(ServiceController, "restart_releases", side_effect=restart_releases), \
+                self.captureOnCommitCallbacks(execute=True):
+            return {result.service_id: result for result in restart_in_batches(Service.objects.all(), batch_size=1)}
+
+    def test_requests_made_during_a_batch_queue_behind_it(self):
+        queued = []
+
+        def restart_releases(namespace, release_names):
+            service = Service.objects.get(pid=release_names[0])
+            self.assertEqual(service.status, ServiceStatus.RESTARTING)
+            running = ServiceOperation.objects.get(service=service, status=OperationStatus.RUNNING)
+            self.assertEqual(running.operation, "restart")
+            self.assertIn(running.source_status, [ServiceStatus.RUNNING, ServiceStatus.DEGRADED])
+            self.assertEqual(enqueue_operation(service, "restart").pk, running.pk)
+            queued.append(enqueue_operation(service, "upgrade"))
+
+        results = self.restart(restart_releases)
+        self.assertEqual({pk: result.outcome for pk, result in results.items()},
+                         {self.running.pk: "ok", self.degraded.pk: "ok", self.new.pk: "skipped"})
+        restarts = ServiceOperation.objects.filter(operation="restart").order_by("service_id")
+        self.assertEqual([(operation.service_id, operation.status, operation.requests) for operation in restarts], [
+            (self.running.pk, OperationStatus.SUCCEEDED, 2), (self.degraded.pk, OperationStatus.SUCCEEDED, 2)])
+        self.assertEqual([operation.status for operation in queued], [OperationStatus.QUEUED] * 2)
+        # Dispatched once the batch finished, from the status the batch left the services in
+        self.assertEqual(
+            sorted(call.kwargs["args"][0] for call in self.apply_async.call_args_list),
+            sorted(operation.pk for operation in queued))
+        self.assertEqual(
+            set(Service.objects.filter(pk__in=[self.running.pk, self.degraded.pk]).values_list("status", flat=True)),
+            {ServiceStatus.RUNNING})
+
+    def test_failed_batch_fails_its_operations(self):
+        results = self.restart(mock.Mock(side_effect=Exception("rollout failed")))
+        self.assertEqual(results[self.running.pk].outcome, "failed")
+        self.assertEqual(
+            set(ServiceOperation.objects.values_list("status", "error")), {(OperationStatus.FAILED, "rollout failed")})
+        self.running.refresh_from_db()
+        self.assertEqual(self.running.status, ServiceStatus.RESTARTING_FAILED)
+        self.apply_async.assert_not_called()
+
+    def test_services_with_active_operations_are_skipped(self):
+        enqueue_operation(self.running, "upgrade", dispatch=False)
+        restart_releases = mock.Mock()
+        results = self.restart(restart_releases)
+        self.assertEqual(results[self.running.pk].outcome, "skipped")
+        restart_releases.assert_called_once_with(self.degraded.namespace, [str(self.degraded.pid)])
+
+
+class OperationOutputTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_spill_file_is_readable_while_writing_and_closed_between_commands(self):
+        path = os.path.join(self.directory.name, "output.log")
+        output = ProcessOutput(2, path)
+        output.write("first")
+        with open(path) as spill:
+            self.assertEqual(spill.read(), "first\n")
+        output.close()
+        output.write("second")
+        output.write("third")
+        output.close()
+        with open(path) as spill:
+            self.assertEqual(spill.read(), "first\nsecond\nthird\n")
+        self.assertEqual(output.tail, "second\nthird")
+
+    def test_run_command_leaves_no_spill_file_open(self):
+        service = create_services()[0]
+        controller = ServiceController(service)
+        controller.operation_record = ServiceOperation.objects.create(service=service, operation="deploy")
+        with override_settings(OPERATION_OUTPUT_DIR=self.directory.name):
+            controller.run_command([sys.executable, "-c", "print('hello')"], "Python")
+        self.assertIsNone(controller.output._spill)
+        with open(os.path.join(self.directory.name, f"{controller.operation_record.task_id}.log")) as spill:
+            self.assertEqual(spill.read(), "hello\n")
+
+
+class ServiceLogTests(TestCase):
+
+    def setUp(self):
+        self.service = create_services()[0]
+        namespace = self.service.namespace
+        pod = {"metadata": {"name": "web-0"}, "spec": {"containers": [{"name": "app"}, {"name": "proxy"}]}}
+        logs = {
+            "app": ["2024-01-01T00:00:01.5Z a1", "2024-01-01T00:00:03Z a2", "2024-01-01T00:00:03Z a3"],
+            "proxy": ["2024-01-01T00:00:01.25Z p1", "2024-01-01T00:00:02Z p2", "2024-01-01T00:00:03Z p3"],
+        }
+        # The fake ignores sinceTime and tailLines, the controller filters the lines it reads
+        self.responses = {
+            ("GET", f"/api/v1/namespaces/{namespace}/pods"): {"items": [pod]},
+            ("GET", f"/api/v1/namespaces/{namespace}/pods/web-0/log"):
+                lambda query: "\n".join(logs[query["container"][0]]) + "\n",
+        }
+
+    def read_pages(self, limit):
+        messages, cursors, since = [], [], None
+        with FakeKubeApi(self.responses) as api, mock.patch("usop.apps.services.controller.get_kube_client", return_value=KubeClient(api.url)):
+            controller = KubernetesServiceController(self.service)
+            while True:
+                page = list(islice(controller.get_logs(since=since), limit))
+                if not page:
+                    return messages, cursors, api
+                messages += [line.message for line in page]
+                cursors += [line.cursor for line in page]
+                since = page[-1].cursor
+
+    def test_pages_merge_the_containers_by_time_without_losing_lines(self):
+        messages, cursors, api = self.read_pages(limit=2)
+        self.assertEqual(messages, ["p1", "a1", "p2", "a2", "a3", "p3"])
+        self.assertEqual(len(set(cursors)), 6)
+        self.assertIn("2024-01-01T00:00:03Z|web-0|app|1", cursors)
+        since_times = {query.get("sinceTime", [None])[0] for method, path, query in api.requests if path.endswith("/log")}
+        self.assertEqual(since_times, {None, "2024-01-01T00:00:01Z", "2024-01-01T00:00:03Z"})
+
+    def test_bare_timestamps_skip_every_line_of_that_time(self):
+        lines = cursor_logs([
+            LogLine(cursor="", pod="p", container="c", message=message, time=time)
+            for time, message in [("2024-01-01T00:00:01Z", "a"), ("2024-01-01T00:00:01Z", "b"),
+                                  ("2024-01-01T00:00:01.000000001Z", "c")]])
+        self.assertEqual([line.message for line in filter_logs(lines, since="2024-01-01T00:00:01Z")], ["c"])
+
+    def test_invalid_parameters_are_bad_requests(self):
+        self.client.force_login(self.service.org.admin_user)
+        url = f"/services/{self.service.pid}/logs/"
+        for query in ["limit=ten", "tail=-1", "since=yesterday", "since=2024-01-01T00:00:01Z|web-0|app|x"]:
+            with self.subTest(query=query):
+                self.assertEqual(self.client.get(f"{url}?{query}").status_code, 400)
+
+
+FAKE_KUBECTL = """
+import json, sys
+args = sys.argv[1:]
+with open(CALLS, "a") as calls:
+    calls.write(json.dumps(args) + "\\n")
+if args[0] == "get":
+    containers = [{"name": "app"}, {"name": "proxy"}]
+    print(json.dumps({"items": [{"metadata": {"name": "web-0"}, "spec": {"containers": containers}}]}))
+elif args[0] == "logs":
+    container = args[args.index("--container") + 1]
+    offset = {"app": 0, "proxy": 1}[container]
+    for second in range(LINES):
+        print(f"2024-01-01T00:{second // 60:02d}:{second % 60:02d}.{offset}Z {container}{second}", flush=True)
+"""
+
+
+class KubectlLogTests(TestCase):
+
+    def setUp(self):
+        self.service = create_services()[0]
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.calls = os.path.join(directory.name, "calls")
+
+    def read(self, lines, **kwargs):
+        code = f"CALLS = {self.calls!r}\nLINES = {lines}\n" + FAKE_KUBECTL
+        with override_settings(KUBECTL_COMMAND=[sys.executable, "-c", code]):
+            return list(islice(ServiceController(self.service).get_logs(**kwargs), 4))
+
+    def kubectl_calls(self):
+        with open(self.calls) as calls:
+            return [json.loads(line) for line in calls]
+
+    def test_pages_merge_one_stream_per_container(self):
+        page = self.read(3, since="2024-01-01T00:00:00.0Z|web-0|app|0", tail=10)
+        self.assertEqual([line.message for line in page], ["proxy0", "app1", "proxy1", "app2"])
+        self.assertEqual(page[0].cursor, "2024-01-01T00:00:00.1Z|web-0|proxy|0")
+        get, *logs = self.kubectl_calls()
+        self.assertEqual(get[:2], ["get", "pods"])
+        self.assertEqual(
+            sorted(call[call.index("--container") + 1] for call in logs), ["app", "proxy"])
+        for call in logs:
+            self.assertIn("web-0", call)
+            self.assertEqual(call[call.index("--since-time") + 1], "2024-01-01T00:00:00Z")
+            self.assertEqual(call[call.index("--tail") + 1], "10")
+
+    def test_a_page_stops_reading_the_log(self):
+        started = time.monotonic()
+        page = self.read(10 ** 7)
+        self.assertEqual([line.message for line in page], ["app0", "proxy0", "app1", "proxy1"])
+        # Reading ten million lines per container would take far longer
+        self.assertLess(time.monotonic() - started, 10)
+
+
+class StatusPublishTests(TestCase):
+
+    def setUp(self):
+        self.services = create_services(3)
+        Service.objects.update(status=ServiceStatus.RUNNING)
+        publish = mock.patch("usop.apps.services.pubsub.publish")
+        self.publish = publish.start()
+        self.addCleanup(publish.stop)
+        put = mock.patch.object(pipeline, "_put", side_effect=lambda event: PubSubEventSink().write([event]))
+        put.start()
+        self.addCleanup(put.stop)
+
+    def reconcile(self):
+        with mock.patch.object(ServiceController, "list_releases", return_value={}):
+            reconcile_services(Service.objects.all())
+
+    def test_bulk_transitions_are_published_per_service_once_committed(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.reconcile()
+        self.publish.assert_not_called()
+        for callback in callbacks:
+            callback()
+        org = self.services[0].org_id
+        self.assertEqual(
+            sorted((tuple(call.args[0]), call.args[1]["service"], call.args[1]["status"])
+                   for call in self.publish.call_args_list),
+            [((service_channel(service.pk), org_channel(org)), service.pk, ServiceStatus.STOPPED)
+             for service in self.services])
+
+    def test_rolled_back_transitions_are_not_published(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.reconcile()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.publish.assert_not_called()
+
+    def test_invalid_wait_is_a_bad_request(self):
+        self.client.force_login(self.services[0].org.admin_user)
+        for wait in ["soon", "0", "nan"]:
+            with self.subTest(wait=wait):
+                response = self.client.get(f"/services/{self.services[0].pid}/status/?wait={wait}")
+                self.assertEqual(response.status_code, 400)
+
+
+class CatalogCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        catalog_cache.clear_local()
+        self.service = create_services()[0]
+        self.sku = self.service.template_sku
+
+    def test_listing_is_cached_until_a_write_commits(self):
+        self.assertEqual([item["version"]["name"] for item in catalog_items(self.sku.org_id, self.sku.region_id)], ["1.0"])
+        with self.assertNumQueries(0):
+            catalog_items(self.sku.org_id, self.sku.region_id)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            TemplateVersion.objects.create(template=self.sku.template, version_name="2.0", helm_repo="https://charts.example.com")
+        self.assertEqual(catalog_items(self.sku.org_id, self.sku.region_id)[0]["version"]["name"], "1.0")
+        for callback in callbacks:
+            callback()
+        self.assertEqual(catalog_items(self.sku.org_id, self.sku.region_id)[0]["version"]["name"], "2.0")
+
+
+@override_settings(HELM_CHART_PREPULL=True, CELERY_BROKER_URL="redis://broker:6379/0")
+class ChartPrepullTests(TestCase):
+
+    def setUp(self):
+        self.template = create_services()[0].template_version.template
+
+    def save_version(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return TemplateVersion.objects.create(
+                template=self.template, version_name="2.0", helm_repo="https://charts.example.com")
+
+    def test_saved_versions_are_pulled_after_the_commit(self):
+        with mock.patch.object(warm_chart_cache, "delay") as delay:
+            version = self.save_version()
+        delay.assert_called_once_with([version.pk])
+
+    def test_versions_are_saved_while_the_broker_is_down(self):
+        with mock.patch.object(warm_chart_cache, "delay", side_effect=OperationalError("Connection refused")), \
+                mock.patch("usop.apps.services.signals.logger") as logger:
+            version = self.save_version()
+        self.assertTrue(TemplateVersion.objects.filter(pk=version.pk).exists())
+        logger.exception.assert_called_once()
+
+    @override_settings(CELERY_BROKER_URL="")
+    def test_nothing_is_queued_without_a_broker(self):
+        with mock.patch.object(warm_chart_cache, "delay") as delay:
+            self.save_version()
+        delay.assert_not_called()
+
+
+class HelmHomesTests(TestCase):
+
+    def test_threads_running_at_once_get_their_own_home_and_later_threads_reuse_them(self):
+        homes = HelmHomes(tempfile.mkdtemp())
+        for _ in range(3):
+            barrier = threading.Barrier(3)
+            paths = []
+
+            def claim():
+                barrier.wait()
+                paths.append(homes.current())
+                barrier.wait()
+
+            threads = [threading.Thread(target=claim) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(sorted(os.path.basename(path) for path in paths), ["slot-0", "slot-1", "slot-2"])
+        self.assertEqual(len(os.listdir(homes.root)), 3)
+
+
+def read_tree(root, skip=None):
+    """ Content of every file under root, by path relative to it, except the ones of the skip directory """
+    tree = {}
+    for directory, directories, files in os.walk(root):
+        if skip in directories:
+            directories.remove(skip)
+        for name in files:
+            path = os.path.join(directory, name)
+            with open(path, "rb") as f:
+                tree[os.path.relpath(path, root)] = f.read()
+    return tree
+
+
+@override_settings(DRY_RUN=False, BACKUP_CHUNK_SIZE=1024)
+class BackupRestoreTests(TestCase):
+    """ Backups and restores through a local object store, with the volume commands run by a local shell """
+
+    def setUp(self):
+        self.service = create_services()[0]
+        self.volume = tempfile.mkdtemp()
+        self.files = {"a.txt": b"first", os.path.join("sub", "b.bin"): os.urandom(5000)}
+        for name, content in self.files.items():
+            os.makedirs(os.path.dirname(os.path.join(self.volume, name)), exist_ok=True)
+            with open(os.path.join(self.volume, name), "wb") as f:
+                f.write(content)
+        self.store = LocalObjectStore(tempfile.mkdtemp())
+        store = mock.patch("usop.apps.services.backup.get_object_store", return_value=self.store)
+        store.start()
+        self.addCleanup(store.stop)
+        self.controller = ServiceController(self.service)
+        self.controller.list_volumes = lambda: [ServiceVolume(claim="data", pod="web-0", container="app", path=self.volume)]
+        # Run the command kubectl would run in the pod
+        self.controller.volume_exec = lambda volume, *args: list(args[args.index("--") + 1:])
+
+    def change_volume(self):
+        os.remove(os.path.join(self.volume, "sub", "b.bin"))
+        with open(os.path.join(self.volume, "a.txt"), "wb") as f:
+            f.write(b"changed")
+        with open(os.path.join(self.volume, "c.txt"), "wb") as f:
+            f.write(b"new")
+
+    def test_restore_replaces_the_volume_with_the_backup(self):
+        backup = backup_service(self.controller)
+        self.assertEqual((backup.status, backup.files, backup.new_chunks), (OperationStatus.SUCCEEDED, 2, 6))
+        self.change_volume()
+        restore_service(self.controller, backup)
+        self.assertEqual(read_tree(self.volume), self.files)
+        self.assertEqual(backup_service(self.controller).new_chunks, 0)
+
+    def test_failed_restore_leaves_the_volume_unchanged(self):
+        backup = backup_service(self.controller)
+        self.change_volume()
+        changed = read_tree(self.volume)
+        digest = json.loads(gzip.decompress(self.store.get(backup.manifest_key)))["volumes"][0]["members"][-1]["chunks"][-1]
+        self.store.put(chunk_key(digest), b"corrupted")
+        with self.assertRaises(Exception):
+            restore_service(self.controller, backup)
+        # A killed restore can leave its staging directory, the next backup skips it and the next restore removes it
+        self.assertEqual(read_tree(self.volume, skip=RESTORE_STAGING_DIR), changed)
+        latest = backup_service(self.controller)
+        restore_service(self.controller, latest)
+        self.assertEqual(read_tree(self.volume), changed)
+
+    def test_only_reads_accept_the_exit_code_of_changed_files(self):
+        with exec_stream(["sh", "-c", "exit 1"], accepted_codes=(0, 1)) as stream:
+            stream.read()
+        with self.assertRaises(Exception):
+            with exec_stream(["sh", "-c", "cat > /dev/null; exit 1"], stdin=True) as stream:
+                stream.write(b"data")
@@ -1,15 +1,10 @@
 
-from django.conf import settings
+from .registry import controller_registry
 
-_default_service_controller = None
 _default_region = None
 
 def get_default_servicecontroller():
     """ Get the default service controller for the current deployment """
-    if _default_service_controller is not None:
-        return _default_service_controller    
-    model_path = settings.SERVICE_CONTROLLER
-    module, klass = model_path.rsplit(".", 1)
-    services = __import__(module, fromlist=[klass])
-    _default_service_controller = getattr(services, klass)
-    return _default_service_controller
\ No newline at end of file
+    if controller_registry.default is None:
+        controller_registry.build()
+    return controller_registry.default
@@ -0,0 +1,124 @@
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+
+
+def deep_merge(base: Optional[Dict], override: Optional[Dict]) -> Dict:
+    """
+        Merge two helm values trees without modifying them. Nested dicts are merged key by key,
+        any other value of the override, lists included, replaces the value of the base.
+    """
+    merged = copy.deepcopy(base) if base else {}
+    for key, value in (override or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def layer_digest(layer: Optional[Dict]) -> str:
+    """ Stable digest of a settings layer, used as its version """
+    encoded = json.dumps(layer or {}, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class ValuesResolver:
+    """
+        Resolves the effective helm values of a service by merging, in order of precedence,
+        the template, template version, template sku and service settings.
+        Merges are memoized on the settings revision of the template, version and sku, so services
+        sharing them only pay for hashing and merging their own settings. Rows changed with
+        QuerySet.update keep their revision, call clear after such writes.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._cache: "OrderedDict[Tuple, Tuple[Dict, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _sources(self, service):
+        """ Template, version and sku of the service, with their settings """
+        version = service.template_version
+        sku = service.template_sku
+        template = version.template if version else (sku.template if sku else None)
+        return [
+            (template, template.template_settings if template else None),
+            (version, version.version_settings if version else None),
+            (sku, sku.sku_settings if sku else None),
+        ]
+
+    def _cached(self, key, build):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        value = build()
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def _resolve(self, service) -> Tuple[Dict, str]:
+        sources = self._sources(service)
+        base_key = tuple(
+            (type(source).__name__, source.pk, source.settings_revision) if source else None
+            for source, _ in sources)
+
+        def build_base():
+            values = {}
+            for _, layer in sources:
+                values = deep_merge(values, layer)
+            return values, layer_digest(values)
+
+        base, base_digest = self._cached(base_key, build_base)
+        if not service.settings:
+            return base, base_digest
+
+        def build_service():
+            values = deep_merge(base, service.settings)
+            return values, layer_digest(values)
+
+        return self._cached(base_key + (layer_digest(service.settings),), build_service)
+
+    def resolve(self, service) -> Dict:
+        """ Effective helm values of the service, the caller is free to modify the result """
+        return copy.deepcopy(self._resolve(service)[0])
+
+    def digest(self, service) -> str:
+        """ Digest of the effective helm values of the service """
+        return self._resolve(service)[1]
+
+    def values_file(self, service) -> str:
+        """
+            Path of a file with the effective values of the service, for helm -f.
+            Files are named after the digest of the values, so they are written once and shared
+            by all the services that resolve to the same values.
+        """
+        values, digest = self._resolve(service)
+        directory = settings.HELM_VALUES_DIR or os.path.join(tempfile.gettempdir(), "usop-values")
+        path = os.path.join(directory, f"{digest}.json")
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(values, f, sort_keys=True)
+            os.replace(tmp_path, path)
+        return path
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+values_resolver = ValuesResolver(max_size=settings.HELM_VALUES_CACHE_SIZE)
+""" Process wide values resolver """
@@ -1,9 +1,24 @@
+from dataclasses import asdict
+from itertools import islice
+from typing import List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import BadRequest, PermissionDenied
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.urls import path 
 from viewflow.contrib.auth import AuthViewset 
 from viewflow.urls import Application, Site, ModelViewset
 
-from .models import Region, Service
+from .catalog import catalog_cache
+from .controller import log_cursor_key
+from .models import Region, Service, ServiceOperation
+from .pubsub import get_broker, operation_message, org_channel, service_channel
+from .tasks import ACTIVE_OPERATION_STATUSES
+from usop.apps.users.models import Org, PermissionType
+from usop.apps.users.permissions import has_perm
+from usop.lib.StreamUtil import StreamUtil
 
 
 viewsets=[
@@ -12,8 +27,218 @@ viewsets=[
         icon='world', 
         app_name='services', 
         viewsets=[
-            ModelViewset(model=Service),
+            ModelViewset(model=Service, queryset=Service.objects.with_deployment_context()),
             ModelViewset(model=Region),
         ]
     ),
-]
\ No newline at end of file
+]
+
+
+def int_param(request, name) -> Optional[int]:
+    """ Positive integer of a query parameter, None when it is missing, BadRequest when it is not one """
+    value = request.GET.get(name)
+    if not value:
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer")
+    if number < 1:
+        raise BadRequest(f"{name} must be positive")
+    return number
+
+
+async def check_org_access(request, org):
+    """ Raise PermissionDenied unless the user can read the services of the org """
+    user = await request.auser()
+    if not await sync_to_async(has_perm)(user, org, PermissionType.READ):
+        raise PermissionDenied
+
+
+async def get_readable_service(request, pid) -> Service:
+    """ Service of the url, if the user can read the services of its org """
+    try:
+        service = await Service.objects.with_deployment_context().aget(pid=pid)
+    except Service.DoesNotExist:
+        raise Http404
+    await check_org_access(request, service.org)
+    return service
+
+
+async def stream_response(request, entries, since=None):
+    """
+        Respond with the entries of a controller stream. Clients accepting text/event-stream get server-sent
+        events, follow=1 gets newline delimited JSON as entries arrive, and anything else a page of at most
+        limit entries with the cursor of the next page.
+    """
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        async def events():
+            async for entry in StreamUtil.aiterate(entries):
+                yield StreamUtil.sse(asdict(entry), event_id=entry.cursor)
+        response = StreamingHttpResponse(events(), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    if request.GET.get("follow") == "1":
+        async def lines():
+            async for entry in StreamUtil.aiterate(entries):
+                yield StreamUtil.ndjson(asdict(entry))
+        return StreamingHttpResponse(lines(), content_type="application/x-ndjson")
+
+    limit = min(int_param(request, "limit") or settings.SERVICE_STREAM_PAGE_SIZE, settings.SERVICE_STREAM_PAGE_SIZE)
+
+    def read_page():
+        try:
+            return [asdict(entry) for entry in islice(entries, limit)]
+        finally:
+            entries.close()
+
+    items = await sync_to_async(read_page, thread_sensitive=False)()
+    return JsonResponse({"items": items, "cursor": items[-1]["cursor"] if items else since})
+
+
+def stream_since(request):
+    return request.GET.get("since") or request.headers.get("Last-Event-ID")
+
+
+async def service_logs(request, pid):
+    """ Log lines of a service, filtered with since, tail, contains and container """
+    service = await get_readable_service(request, pid)
+    since = stream_since(request)
+    if since:
+        try:
+            log_cursor_key(since)
+        except ValueError as e:
+            raise BadRequest(str(e))
+    follow = request.GET.get("follow") == "1" or "text/event-stream" in request.headers.get("Accept", "")
+    entries = service.get_service_controller().get_logs(
+        since=since,
+        tail=int_param(request, "tail"),
+        contains=request.GET.get("contains"),
+        container=request.GET.get("container"),
+        follow=follow,
+    )
+    return await stream_response(request, entries, since)
+
+
+async def service_events(request, pid):
+    """ Kubernetes events of the objects of a service, filtered with since and type """
+    service = await get_readable_service(request, pid)
+    since = stream_since(request)
+    entries = service.get_service_controller().get_events(since=since, event_type=request.GET.get("type"))
+    return await stream_response(request, entries, since)
+
+
+async def service_metrics(request, pid):
+    """ Current resource usage of the containers of a service """
+    service = await get_readable_service(request, pid)
+    return await stream_response(request, service.get_service_controller().get_metrics())
+
+
+def service_snapshot(service) -> dict:
+    """ Stored status of a service and its operations in progress """
+    operations = ServiceOperation.objects.filter(service=service, status__in=ACTIVE_OPERATION_STATUSES).order_by("created")
+    return {
+        "type": "snapshot",
+        "service": service.pk,
+        "pid": service.pid,
+        "status": service.status,
+        "operations": [operation_message(operation) for operation in operations],
+    }
+
+
+def org_snapshot(org) -> dict:
+    """ Stored status of the services of an org """
+    return {
+        "type": "snapshot",
+        "org": org.pk,
+        "services": list(Service.objects.filter(org=org).order_by().values("id", "pid", "name", "status")),
+    }
+
+
+async def status_response(request, channels, snapshot, changed=None):
+    """
+        Push the messages of the status channels. Clients accepting text/event-stream get the snapshot followed
+        by every message as server-sent events. Anything else is a long poll that returns the next message,
+        or 204 after the wait seconds. The subscription starts before the snapshot is read, so no transition
+        falls in between.
+    """
+    broker = get_broker()
+
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        async def events():
+            async with broker.subscribe(channels) as subscription:
+                yield StreamUtil.sse(await sync_to_async(snapshot)(), event="snapshot")
+                while True:
+                    message = await subscription.get(settings.STATUS_STREAM_HEARTBEAT)
+                    # Comments keep proxies from closing idle connections
+                    yield ": keepalive\n\n" if message is None else StreamUtil.sse(message, event=message["type"])
+        response = StreamingHttpResponse(events(), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    try:
+        wait = float(request.GET.get("wait") or settings.STATUS_LONG_POLL_TIMEOUT)
+    except ValueError:
+        raise BadRequest("wait must be a number")
+    if not wait > 0:
+        raise BadRequest("wait must be positive")
+    wait = min(wait, settings.STATUS_LONG_POLL_TIMEOUT)
+    async with broker.subscribe(channels) as subscription:
+        if changed is not None:
+            current = await sync_to_async(snapshot)()
+            if changed(current):
+                return JsonResponse(current)
+        message = await subscription.get(wait)
+    return JsonResponse(message) if message is not None else HttpResponse(status=204)
+
+
+async def service_status(request, pid):
+    """ Status transitions and operation progress of a service, status=<known status> returns at once if it changed """
+    service = await get_readable_service(request, pid)
+    known = request.GET.get("status")
+    return await status_response(
+        request, [service_channel(service.pk)], lambda: service_snapshot(service),
+        changed=(lambda current: current["status"] != known) if known else None)
+
+
+async def org_status(request, extid):
+    """ Status transitions and operation progress of all the services of an org """
+    try:
+        org = await Org.objects.aget(extid=extid)
+    except Org.DoesNotExist:
+        raise Http404
+    await check_org_access(request, org)
+    return await status_response(request, [org_channel(org.pk)], lambda: org_snapshot(org))
+
+
+def catalog_items(org_id, region_id) -> List[dict]:
+    """ SKUs an org can deploy from the UI in a region, with the latest version of their template """
+    items = []
+    for sku in catalog_cache.skus_for(org_id, region_id):
+        if not sku.ui_enabled:
+            continue
+        version = catalog_cache.latest_version(sku.template_id)
+        items.append({
+            "sku": sku.extid,
+            "name": sku.name,
+            "description": sku.description,
+            "template": sku.template.name,
+            "version": {"extid": version.extid, "name": version.version_name} if version else None,
+        })
+    return items
+
+
+async def org_catalog(request, extid):
+    """ SKUs an org can deploy in the region of the region parameter """
+    try:
+        org = await Org.objects.aget(extid=extid)
+    except Org.DoesNotExist:
+        raise Http404
+    await check_org_access(request, org)
+    region = int_param(request, "region")
+    if region is None:
+        raise BadRequest("region is required")
+    return JsonResponse({"items": await sync_to_async(catalog_items)(org.pk, region)})
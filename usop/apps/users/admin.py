@@ -7,6 +7,7 @@ from django.utils.translation import gettext_lazy as _
 from .forms import UserAdminChangeForm
 from .forms import UserAdminCreationForm
 from .models import User, Org
+from .permissions import filter_for_user
 
 
 if settings.DJANGO_ADMIN_FORCE_ALLAUTH:
@@ -57,7 +58,4 @@ class OrgAdmin(admin.ModelAdmin):
     ordering = ["name"]
 
     def get_queryset(self, request):
-        qs = super().get_queryset(request)
-        if request.user.is_superuser:
-            return qs
-        return qs.filter(membership__user=request.user)
\ No newline at end of file
+        return filter_for_user(super().get_queryset(request), request.user, org_field="pk")
\ No newline at end of file
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'usop.apps.users'
+
+    def ready(self):
+        import usop.apps.users.signals
+        return super().ready()
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.7 on 2026-10-18 15:14
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_auto_20241218_1851'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='membershipinvitation',
+            name='users_membe_extid_ffc220_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='org',
+            name='users_org_extid_b761d6_idx',
+        ),
+    ]
@@ -53,11 +53,6 @@ class Org(models.Model):
     )
     """ Automatically genered unique id for namespace """
 
-    class Meta:
-        indexes = [
-            models.Index(fields=['extid']),
-        ]
-    
     def __str__(self) -> str:
         return self.name
 
@@ -138,9 +133,6 @@ class MembershipInvitation(models.Model):
 
     class Meta:
         unique_together = ('user', 'org')
-        indexes = [
-            models.Index(fields=['extid']),
-        ]
 
     def __str__(self) -> str:
         return f"{self.user.name} - {self.org.name} ({'accepted' if self.accepted else 'pending'})"
\ No newline at end of file
@@ -0,0 +1,104 @@
+from typing import Dict, Set
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import FilteredRelation, Q, QuerySet
+
+from .models import Org, PermissionType
+
+
+PERMISSION_LEVELS = {
+    PermissionType.READ: 1,
+    PermissionType.WRITE: 2,
+    PermissionType.DELETE: 3,
+    PermissionType.ADMIN: 4,
+}
+""" Each permission includes the ones with a lower level """
+
+
+def parse_permission(value) -> PermissionType:
+    """ Permission of a membership, stored either as the enum value or as the enum name, ex: PermissionType.READ """
+    if isinstance(value, PermissionType):
+        return value
+    value = str(value)
+    if value.startswith("PermissionType."):
+        return PermissionType[value.split(".", 1)[1]]
+    return PermissionType(value)
+
+
+def cache_key(user_id) -> str:
+    return f"usop:org-permissions:{user_id}"
+
+
+class PermissionResolver:
+    """
+        Resolves the permission of users on orgs. The memberships of a user, and the orgs it administers, are
+        loaded with one query, kept on the user object for the rest of the request and in the cache for
+        PERMISSION_CACHE_TTL seconds. Signals drop the cache entry when a membership or an org admin changes.
+    """
+
+    def permissions(self, user) -> Dict[int, PermissionType]:
+        """ Highest permission of the user on every org it belongs to """
+        cached = getattr(user, "_org_permissions", None)
+        if cached is not None:
+            return cached
+        permissions = cache.get(cache_key(user.pk))
+        if permissions is None:
+            permissions = self.load(user)
+            cache.set(cache_key(user.pk), permissions, timeout=settings.PERMISSION_CACHE_TTL)
+        user._org_permissions = permissions
+        return permissions
+
+    def load(self, user) -> Dict[int, PermissionType]:
+        rows = (
+            Org.objects
+            .annotate(own_membership=FilteredRelation("memberships", condition=Q(memberships__user=user)))
+            .filter(Q(own_membership__isnull=False) | Q(admin_user=user))
+            .values_list("pk", "admin_user_id", "own_membership__permission")
+        )
+        permissions = {}
+        for org_id, admin_user_id, value in rows:
+            permissions[org_id] = PermissionType.ADMIN if admin_user_id == user.pk else parse_permission(value)
+        return permissions
+
+    def has_perm(self, user, org, permission: PermissionType = PermissionType.READ) -> bool:
+        """ Wether the user has the permission, or a higher one, on the org """
+        if not user.is_authenticated or not user.is_active:
+            return False
+        if user.is_superuser:
+            return True
+        org_id = org.pk if isinstance(org, Org) else org
+        granted = self.permissions(user).get(org_id)
+        return granted is not None and PERMISSION_LEVELS[granted] >= PERMISSION_LEVELS[permission]
+
+    def org_ids(self, user, permission: PermissionType = PermissionType.READ) -> Set[int]:
+        """ Orgs where the user has the permission, or a higher one """
+        return {
+            org_id for org_id, granted in self.permissions(user).items()
+            if PERMISSION_LEVELS[granted] >= PERMISSION_LEVELS[permission]
+        }
+
+    def filter_queryset(self, queryset: QuerySet, user, permission: PermissionType = PermissionType.READ,
+                        org_field: str = "org") -> QuerySet:
+        """ Objects of the orgs where the user has the permission, org_field is the lookup of the org of the model """
+        if not user.is_authenticated or not user.is_active:
+            return queryset.none()
+        if user.is_superuser:
+            return queryset
+        return queryset.filter(**{f"{org_field}__in": self.org_ids(user, permission)})
+
+    def invalidate(self, user_id):
+        cache.delete(cache_key(user_id))
+
+
+permission_resolver = PermissionResolver()
+""" Process wide permission resolver """
+
+
+def has_perm(user, org, permission: PermissionType = PermissionType.READ) -> bool:
+    return permission_resolver.has_perm(user, org, permission)
+
+
+def filter_for_user(queryset: QuerySet, user, permission: PermissionType = PermissionType.READ,
+                    org_field: str = "org") -> QuerySet:
+    return permission_resolver.filter_queryset(queryset, user, permission, org_field)
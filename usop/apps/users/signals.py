@@ -0,0 +1,27 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Membership, Org
+from .permissions import permission_resolver
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def membership_permissions_handler(sender, instance, **kwargs):
+    permission_resolver.invalidate(instance.user_id)
+
+
+@receiver(pre_save, sender=Org)
+def org_pre_save_handler(sender, instance, **kwargs):
+    """ Remember the previous admin, it loses the admin permission when the org changes hands """
+    if instance.pk:
+        instance._previous_admin_id = sender.objects.filter(pk=instance.pk).values_list("admin_user_id", flat=True).first()
+
+
+@receiver(post_save, sender=Org)
+@receiver(post_delete, sender=Org)
+def org_permissions_handler(sender, instance, **kwargs):
+    permission_resolver.invalidate(instance.admin_user_id)
+    previous = getattr(instance, "_previous_admin_id", None)
+    if previous and previous != instance.admin_user_id:
+        permission_resolver.invalidate(previous)
@@ -1,3 +1,78 @@
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from django.test import TestCase
 
-# Create your tests here.
+from .models import Membership, MembershipInvitation, Org, PermissionType, User
+from .permissions import filter_for_user, has_perm, parse_permission, permission_resolver
+
+
+class PermissionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user(email="admin@example.com", username="admin", password="x")
+        self.member = User.objects.create_user(email="member@example.com", username="member", password="x")
+        self.org = Org.objects.create(name="org", admin_user=self.admin)
+        self.other = Org.objects.create(name="other", admin_user=self.admin)
+        self.membership = Membership.objects.create(user=self.member, org=self.org, permission=PermissionType.WRITE.value)
+
+    def fresh(self, user):
+        """ The user as read by a new request, without the permissions kept on the object """
+        return User.objects.get(pk=user.pk)
+
+    def test_parse_permission(self):
+        for value in [PermissionType.DELETE, "delete", "PermissionType.DELETE"]:
+            with self.subTest(value=value):
+                self.assertEqual(parse_permission(value), PermissionType.DELETE)
+
+    def test_levels_include_the_lower_ones(self):
+        granted = {permission: has_perm(self.member, self.org, permission) for permission in PermissionType}
+        self.assertEqual(granted, {
+            PermissionType.READ: True, PermissionType.WRITE: True,
+            PermissionType.DELETE: False, PermissionType.ADMIN: False})
+        self.assertFalse(has_perm(self.member, self.other))
+        self.assertTrue(has_perm(self.member, self.org.pk))
+
+    def test_admin_user_is_admin(self):
+        self.assertTrue(has_perm(self.admin, self.org, PermissionType.ADMIN))
+        self.assertEqual(permission_resolver.permissions(self.admin), {
+            self.org.pk: PermissionType.ADMIN, self.other.pk: PermissionType.ADMIN})
+
+    def test_inactive_anonymous_and_superusers(self):
+        self.assertFalse(has_perm(AnonymousUser(), self.org))
+        self.member.is_active = False
+        self.assertFalse(has_perm(self.member, self.org))
+        root = User.objects.create_superuser(email="root@example.com", username="root", password="x")
+        self.assertTrue(has_perm(root, self.other, PermissionType.ADMIN))
+
+    def test_permissions_are_cached_until_a_membership_changes(self):
+        self.assertFalse(has_perm(self.member, self.org, PermissionType.DELETE))
+        user = self.fresh(self.member)
+        with self.assertNumQueries(0):
+            self.assertFalse(has_perm(user, self.org, PermissionType.DELETE))
+
+        self.membership.permission = str(PermissionType.DELETE)
+        self.membership.save()
+        self.assertTrue(has_perm(self.fresh(self.member), self.org, PermissionType.DELETE))
+
+        Membership.objects.create(user=self.member, org=self.other, permission=PermissionType.READ.value)
+        self.assertTrue(has_perm(self.fresh(self.member), self.other))
+
+        self.membership.delete()
+        self.assertFalse(has_perm(self.fresh(self.member), self.org))
+
+    def test_previous_admin_loses_the_org(self):
+        self.assertTrue(has_perm(self.admin, self.org, PermissionType.ADMIN))
+        self.org.admin_user = self.member
+        self.org.save()
+        self.assertFalse(has_perm(self.fresh(self.admin), self.org))
+        self.assertTrue(has_perm(self.fresh(self.member), self.org, PermissionType.ADMIN))
+
+    def test_filter_for_user(self):
+        invitation = MembershipInvitation.objects.create(user=self.admin, org=self.org, permission=PermissionType.READ.value)
+        MembershipInvitation.objects.create(user=self.member, org=self.other, permission=PermissionType.READ.value)
+        self.assertEqual(list(filter_for_user(MembershipInvitation.objects.all(), self.member)), [invitation])
+        self.assertEqual(list(filter_for_user(Org.objects.all(), self.member, PermissionType.DELETE, org_field="pk")), [])
+        self.assertEqual(
+            set(filter_for_user(Org.objects.all(), self.admin, PermissionType.ADMIN, org_field="pk")), {self.org, self.other})
+        self.assertEqual(list(filter_for_user(Org.objects.all(), AnonymousUser(), org_field="pk")), [])
@@ -2,6 +2,8 @@
 ASGI config for usop project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve the service log, event and metric streams from it, they are async views
+that don't hold a worker thread while a client reads them.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
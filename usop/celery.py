@@ -1,6 +1,6 @@
 import os
 
-from celery import Celery
+from celery import Celery, signals
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'usop.settings')
@@ -17,6 +17,36 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 
+@signals.worker_init.connect
+def start_metrics_server(**kwargs):
+    """ Serve the worker metrics on METRICS_WORKER_PORT, before the pool processes are forked """
+    from django.conf import settings
+    from usop import metrics
+    if settings.METRICS_WORKER_PORT:
+        metrics.reset_multiprocess_dir()
+        metrics.start_worker_server(settings.METRICS_WORKER_PORT)
+
+
+@signals.worker_process_shutdown.connect
+def mark_metrics_dead(pid=None, **kwargs):
+    from usop import metrics
+    metrics.mark_process_dead(pid or os.getpid())
+
+
+@signals.worker_ready.connect
+def warm_chart_cache(**kwargs):
+    """ Pull the charts in use into the cache of this worker, in the background so it starts consuming right away """
+    import threading
+    from usop.apps.services.tasks import warm_chart_cache
+    threading.Thread(target=warm_chart_cache, name="usop-chart-warmup", daemon=True).start()
+
+
+@signals.task_postrun.connect
+def update_metrics(**kwargs):
+    from usop import metrics
+    metrics.update_process_metrics()
+
+
 @app.task(bind=True, ignore_result=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
\ No newline at end of file
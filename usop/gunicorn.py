@@ -0,0 +1,21 @@
+"""
+    Gunicorn settings, run with: gunicorn usop.asgi -c python:usop.gunicorn
+    Workers serve the ASGI application, so the log and status streams send their entries as they come,
+    a WSGI worker would read the whole async stream before sending a byte.
+"""
+import os
+
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "8088")
+worker_class = "uvicorn_worker.UvicornWorker"
+
+
+def on_starting(server):
+    """ Drop the metrics of the previous master before any worker starts """
+    from usop import metrics
+    metrics.reset_multiprocess_dir()
+
+
+def child_exit(server, worker):
+    from usop import metrics
+    metrics.mark_process_dead(worker.pid)
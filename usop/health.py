@@ -0,0 +1,126 @@
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Callable, Dict, List, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, connections
+
+
+def check_database():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1")
+
+
+def check_cache():
+    cache.set("usop:health", 1, timeout=30)
+    if cache.get("usop:health") != 1:
+        raise Exception("Cache did not return the value just stored")
+
+
+def check_broker():
+    if not settings.CELERY_BROKER_URL:
+        return "not configured"
+    from usop.celery import app
+    with app.connection_for_write() as broker:
+        broker.ensure_connection(max_retries=1, timeout=settings.HEALTH_CHECK_TIMEOUT)
+
+
+def check_helm():
+    subprocess.run(
+        settings.HELM_COMMAND + ["version", "--short"],
+        check=True, capture_output=True, timeout=settings.HEALTH_CHECK_TIMEOUT)
+
+
+CHECKS: Dict[str, Callable] = {
+    "database": check_database,
+    "cache": check_cache,
+    "broker": check_broker,
+    "helm": check_helm,
+}
+""" Dependency checks that can be listed in HEALTH_CHECKS """
+
+
+def run_check(name: str) -> Dict:
+    started = time.perf_counter()
+    try:
+        detail = CHECKS[name]()
+        result = {"ok": True}
+        if detail:
+            result["detail"] = detail
+    except Exception as e:
+        result = {"ok": False, "error": str(e)[:200]}
+    finally:
+        # Checks run outside of any request, so nothing else closes the connections of their thread
+        connections.close_all()
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return result
+
+
+class HealthChecker:
+    """
+        Runs the dependency checks and keeps the report for ttl seconds, so frequent probes of many kubelets
+        don't multiply the load on the dependencies. Concurrent probes wait for the running checks and share them.
+        The checks run in parallel threads and a check that takes longer than timeout seconds fails, it keeps
+        running and the next reports wait for it instead of starting it again.
+    """
+
+    def __init__(self, names: List[str], ttl: float, timeout: float):
+        self.names = names
+        self.ttl = ttl
+        self.timeout = timeout
+        self._report = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(len(names), 1), thread_name_prefix="usop-health")
+        self._running: Dict[str, Future] = {}
+
+    def _submit(self, name: str) -> Future:
+        future = self._running.get(name)
+        if future is None or future.done():
+            future = self._running[name] = self._executor.submit(run_check, name)
+        return future
+
+    def run_checks(self) -> Tuple[bool, Dict]:
+        deadline = time.monotonic() + self.timeout
+        futures = {name: self._submit(name) for name in self.names}
+        checks = {}
+        for name, future in futures.items():
+            try:
+                checks[name] = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except TimeoutError:
+                checks[name] = {
+                    "ok": False, "error": f"Timed out after {self.timeout}s", "latency_ms": self.timeout * 1000}
+        ok = all(check["ok"] for check in checks.values())
+        return ok, {"status": "ok" if ok else "unavailable", "checks": checks}
+
+    def report(self) -> Tuple[bool, Dict]:
+        with self._lock:
+            if self._report is None or time.monotonic() >= self._expires:
+                self._report = self.run_checks()
+                self._expires = time.monotonic() + self.ttl
+            return self._report
+
+
+health_checker = HealthChecker(settings.HEALTH_CHECKS, settings.HEALTH_CHECK_CACHE_TTL, settings.HEALTH_CHECK_TIMEOUT)
+""" Process wide health checker """
+
+
+class ProbeMiddleware:
+    """
+        Answers the kubelet probes and the Prometheus scrapes before any other middleware. Both call the pod IP,
+        which is not an allowed host, so they must not reach the host validation of the common middleware.
+    """
+
+    def __init__(self, get_response):
+        from .views import health, metrics, ready
+        self.get_response = get_response
+        self.probes = {"/health/": health, "/ready/": ready, "/metrics/": metrics}
+
+    def __call__(self, request):
+        probe = self.probes.get(request.path)
+        if probe is not None:
+            return probe(request)
+        return self.get_response(request)
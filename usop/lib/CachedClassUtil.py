@@ -1,18 +1,24 @@
 import importlib
-import sys
+import threading
+from collections import OrderedDict
+
 
 class CachedClassUtil:
     """
     CachedClassUtil is a utility class that provides caching mechanisms for class instances and class objects.
+    Both caches are bounded LRU maps protected by a lock. Building a missing entry is single-flight:
+    concurrent callers asking for the same path wait for the first one instead of importing twice.
     Class Attributes:
-        _instance_cache (dict): A dictionary to cache instances of classes.
-        _class_cache (dict): A dictionary to cache class objects.
+        max_size (int): Maximum number of entries kept by each cache.
+        _instance_cache (OrderedDict): Cached instances of classes.
+        _class_cache (OrderedDict): Cached class objects.
     Class Methods:
-        get_instance(class_path: str) -> object:
+        get_instance(class_path: str, factory: callable = None) -> object:
             Retrieves an instance of the specified class. If the instance is already cached, it returns the cached instance.
             Otherwise, it imports the module, creates an instance of the class, caches it, and returns the instance.
             Args:
                 class_path (str): The full path of the class in the format 'module.submodule.ClassName'.
+                factory (callable): Optional callable receiving the class and returning the instance to cache.
             Returns:
                 object: An instance of the specified class.
         get_class(class_path: str) -> type:
@@ -22,29 +28,94 @@ class CachedClassUtil:
                 class_path (str): The full path of the class in the format 'module.submodule.ClassName'.
             Returns:
                 type: The class object of the specified class.
+        warm(class_paths: list, instance_paths: list = ()):
+            Imports the given classes, and builds instances of the given instance paths, ahead of the first request.
+        invalidate(class_path: str):
+            Drops the class and the instance cached for a path.
+        clear():
+            Drops all the cached entries and resets the statistics.
+        stats() -> dict:
+            Returns hits, misses and size of each cache.
     """
-    _instance_cache = {}
-    _class_cache = {}
+    max_size = 256
+    _instance_cache = OrderedDict()
+    _class_cache = OrderedDict()
+    _lock = threading.Lock()
+    _building = {}
+    _hits = {"class": 0, "instance": 0}
+    _misses = {"class": 0, "instance": 0}
 
     @classmethod
-    def get_instance(cls, class_path):
-        if class_path in cls._instance_cache:
-            return cls._instance_cache[class_path]
-
+    def _import(cls, class_path):
         module_name, class_name = class_path.rsplit('.', 1)
         module = importlib.import_module(module_name)
-        class_ = getattr(module, class_name)
-        instance = class_()
-        cls._instance_cache[class_path] = instance
-        return instance
-    
+        return getattr(module, class_name)
+
+    @classmethod
+    def _get(cls, kind, cache, key, build):
+        with cls._lock:
+            if key in cache:
+                cache.move_to_end(key)
+                cls._hits[kind] += 1
+                return cache[key]
+            build_lock = cls._building.setdefault((kind, key), threading.Lock())
+
+        with build_lock:
+            with cls._lock:
+                if key in cache:
+                    # Built by a concurrent caller while waiting for the lock
+                    cls._hits[kind] += 1
+                    return cache[key]
+                cls._misses[kind] += 1
+            try:
+                value = build()
+                with cls._lock:
+                    cache[key] = value
+                    while len(cache) > cls.max_size:
+                        cache.popitem(last=False)
+            finally:
+                # A failed build leaves nothing behind, the next caller retries it
+                with cls._lock:
+                    cls._building.pop((kind, key), None)
+        return value
+
+    @classmethod
+    def get_instance(cls, class_path, factory=None):
+        def build():
+            class_ = cls.get_class(class_path)
+            return factory(class_) if factory else class_()
+        return cls._get("instance", cls._instance_cache, class_path, build)
+
     @classmethod
     def get_class(cls, class_path):
-        if class_path in cls._class_cache:
-            return cls._class_cache[class_path]
-        module_name, class_name = class_path.rsplit('.', 1)
-        module = importlib.import_module(module_name)
-        class_ = getattr(module, class_name)
-        cls._class_cache[class_path] = class_
-        return class_
-        
\ No newline at end of file
+        return cls._get("class", cls._class_cache, class_path, lambda: cls._import(class_path))
+
+    @classmethod
+    def warm(cls, class_paths, instance_paths=()):
+        for class_path in class_paths:
+            cls.get_class(class_path)
+        for class_path in instance_paths:
+            cls.get_instance(class_path)
+
+    @classmethod
+    def invalidate(cls, class_path):
+        with cls._lock:
+            cls._class_cache.pop(class_path, None)
+            cls._instance_cache.pop(class_path, None)
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._class_cache.clear()
+            cls._instance_cache.clear()
+            for kind in cls._hits:
+                cls._hits[kind] = 0
+                cls._misses[kind] = 0
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                "class": {"hits": cls._hits["class"], "misses": cls._misses["class"], "size": len(cls._class_cache)},
+                "instance": {"hits": cls._hits["instance"], "misses": cls._misses["instance"], "size": len(cls._instance_cache)},
+            }
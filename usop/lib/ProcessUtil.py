@@ -0,0 +1,99 @@
+import subprocess
+import threading
+from collections import deque
+from typing import Callable, Dict, Iterator, List, Optional
+
+
+class ProcessOutput:
+    """
+    ProcessOutput keeps a bounded capture of the output of processes: the last lines in a ring buffer,
+    and optionally every line appended to a spill file, so memory stays flat whatever the process prints.
+    The spill file is line buffered so it can be followed while the process runs. It is opened on the first
+    write and closed by close, the next write opens it again for append, so a ProcessOutput shared by many
+    commands holds no file between them.
+    Args:
+        max_lines (int): Number of lines kept in memory.
+        spill_path (str): Optional file receiving the whole output.
+    """
+
+    def __init__(self, max_lines: int = 200, spill_path: Optional[str] = None):
+        self.lines = deque(maxlen=max_lines)
+        self.spill_path = spill_path
+        self._spill = None
+
+    def write(self, line: str):
+        self.lines.append(line)
+        if self.spill_path:
+            if self._spill is None:
+                self._spill = open(self.spill_path, "a", encoding="utf-8", buffering=1)
+            self._spill.write(line + "\n")
+
+    @property
+    def tail(self) -> str:
+        return "\n".join(self.lines)
+
+    def close(self):
+        if self._spill:
+            self._spill.close()
+            self._spill = None
+
+
+class ProcessUtil:
+    """
+    ProcessUtil runs commands streaming their output line by line, instead of buffering it until they exit.
+    Class Methods:
+        stream(command: list, timeout: float = None, env: dict = None) -> Iterator[str]:
+            Yields the lines printed by the command, stdout and stderr merged, as they arrive.
+            Kills the command and raises subprocess.TimeoutExpired when it runs longer than timeout seconds,
+            and raises subprocess.CalledProcessError when it exits with an error.
+            The command runs with env as its environment when given, otherwise with the one of the process.
+        run(command: list, output: ProcessOutput = None, timeout: float = None, on_line: callable = None,
+            env: dict = None) -> int:
+            Runs the command to completion writing every line to output and on_line, returns the exit code.
+            Raises subprocess.TimeoutExpired like stream.
+    """
+
+    @classmethod
+    def stream(cls, command: List[str], timeout: Optional[float] = None,
+               env: Optional[Dict[str, str]] = None) -> Iterator[str]:
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, errors="replace",
+            env=env)
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            process.kill()
+
+        watchdog = threading.Timer(timeout, kill) if timeout else None
+        if watchdog:
+            watchdog.daemon = True
+            watchdog.start()
+        try:
+            for line in process.stdout:
+                yield line.rstrip("\n")
+            process.wait()
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(command, timeout)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+    @classmethod
+    def run(cls, command: List[str], output: Optional[ProcessOutput] = None, timeout: Optional[float] = None,
+            on_line: Optional[Callable[[str], None]] = None, env: Optional[Dict[str, str]] = None) -> int:
+        try:
+            for line in cls.stream(command, timeout=timeout, env=env):
+                if output is not None:
+                    output.write(line)
+                if on_line is not None:
+                    on_line(line)
+        except subprocess.CalledProcessError as e:
+            return e.returncode
+        return 0
@@ -0,0 +1,35 @@
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryCountUtil:
+    """
+    QueryCountUtil is a test helper to detect code paths whose number of queries grows with the number of rows (N+1).
+    Class Methods:
+        count_queries(code_path: callable, using: str = 'default') -> int:
+            Runs the code path and returns the number of queries it issued.
+        assert_constant_queries(code_path: callable, add_rows: callable, steps: tuple = (1, 10), using: str = 'default'):
+            Calls add_rows(n) for every step, counting the queries of the code path after each call,
+            and raises AssertionError if the counts differ.
+            Args:
+                code_path (callable): Code to measure, it must evaluate the querysets it builds.
+                add_rows (callable): Receives a number of rows to add to the data set.
+                steps (tuple): Number of rows added before each measure.
+    """
+
+    @classmethod
+    def count_queries(cls, code_path, using=DEFAULT_DB_ALIAS):
+        with CaptureQueriesContext(connections[using]) as context:
+            code_path()
+        return len(context.captured_queries)
+
+    @classmethod
+    def assert_constant_queries(cls, code_path, add_rows, steps=(1, 10), using=DEFAULT_DB_ALIAS):
+        counts = []
+        for rows in steps:
+            add_rows(rows)
+            counts.append(cls.count_queries(code_path, using=using))
+        if len(set(counts)) > 1:
+            raise AssertionError(
+                f"Query count grows with the number of rows, {counts} queries after adding {list(steps)} rows")
+        return counts[0]
@@ -0,0 +1,51 @@
+import json
+from typing import AsyncIterator, Iterator, Optional
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class StreamUtil:
+    """
+    StreamUtil adapts blocking iterators to async views and formats their items for streaming responses.
+    Class Methods:
+        aiterate(iterator: Iterator) -> AsyncIterator:
+            Yields the items of a blocking iterator, advancing it from a worker thread so the event loop
+            is never blocked. The iterator is closed when the consumer stops, ex: the client disconnects.
+        sse(data, event_id: str = None, event: str = None) -> str:
+            Formats an item as a server-sent event, the id lets browsers resume with Last-Event-ID.
+        ndjson(data) -> str:
+            Formats an item as a line of newline delimited JSON.
+    """
+
+    @classmethod
+    async def aiterate(cls, iterator: Iterator) -> AsyncIterator:
+        end = object()
+        advance = sync_to_async(next, thread_sensitive=False)
+        try:
+            while True:
+                item = await advance(iterator, end)
+                if item is end:
+                    break
+                yield item
+        finally:
+            close = getattr(iterator, "close", None)
+            if close:
+                try:
+                    await sync_to_async(close, thread_sensitive=False)()
+                except ValueError:
+                    # Still running in the worker thread, it is collected when that call returns
+                    pass
+
+    @classmethod
+    def sse(cls, data, event_id: Optional[str] = None, event: Optional[str] = None) -> str:
+        message = ""
+        if event_id:
+            message += f"id: {event_id}\n"
+        if event:
+            message += f"event: {event}\n"
+        return message + f"data: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+    @classmethod
+    def ndjson(cls, data) -> str:
+        return json.dumps(data, cls=DjangoJSONEncoder) + "\n"
@@ -0,0 +1,175 @@
+import os
+import shutil
+import time
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+from django.db.models import Count
+from prometheus_client import CollectorRegistry, Gauge, Histogram, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+from .lib.CachedClassUtil import CachedClassUtil
+
+
+TRANSITION_SECONDS = Histogram(
+    "usop_service_transition_seconds", "Duration of the controller transitions, without the wait for a limiter slot",
+    ["operation", "region", "outcome"],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 900, 1800, float("inf")))
+
+REQUEST_DB_QUERIES = Histogram(
+    "usop_request_db_queries", "Database queries issued by each request", ["view"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, float("inf")))
+
+REQUEST_DB_SECONDS = Histogram(
+    "usop_request_db_seconds", "Time spent in database queries by each request", ["view"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float("inf")))
+
+CLASS_CACHE_LOOKUPS = Gauge(
+    "usop_class_cache_lookups", "Lookups of CachedClassUtil since each live process started", ["cache", "result"],
+    multiprocess_mode="livesum")
+
+CLASS_CACHE_SIZE = Gauge(
+    "usop_class_cache_size", "Entries cached by CachedClassUtil in the live processes", ["cache"],
+    multiprocess_mode="livesum")
+
+
+def multiprocess_dir():
+    """ Shared directory of the process metrics, set when gunicorn or celery run several processes """
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+
+def reset_multiprocess_dir():
+    """ Drop the files of previous runs, called by the parent process before it forks """
+    path = multiprocess_dir()
+    if path and os.path.isdir(path):
+        for name in os.listdir(path):
+            entry = os.path.join(path, name)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            else:
+                os.remove(entry)
+
+
+def mark_process_dead(pid):
+    """ Drop the live gauges of a finished child process """
+    if multiprocess_dir():
+        multiprocess.mark_process_dead(pid)
+
+
+def update_process_metrics():
+    """ Copy the counters kept by the process into its gauges, cheap enough to run after every request or task """
+    for cache, stats in CachedClassUtil.stats().items():
+        CLASS_CACHE_LOOKUPS.labels(cache, "hit").set(stats["hits"])
+        CLASS_CACHE_LOOKUPS.labels(cache, "miss").set(stats["misses"])
+        CLASS_CACHE_SIZE.labels(cache).set(stats["size"])
+
+
+@contextmanager
+def time_transition(service, operation: str):
+    """ Observe the duration of a transition, labeled by the region of the service and wether it raised """
+    started = time.perf_counter()
+    outcome = "failure"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        region = service.region.name if service.region_id else ""
+        TRANSITION_SECONDS.labels(operation, region, outcome).observe(time.perf_counter() - started)
+
+
+class StateCollector:
+    """
+        Counts of services per status and region, and of the pending operations, read from the database on every
+        scrape. Every web replica reports the same values, aggregate them with max instead of sum.
+    """
+
+    def collect(self):
+        from .apps.services.models import Service, ServiceOperation
+        from .apps.services.tasks import ACTIVE_OPERATION_STATUSES
+
+        services = GaugeMetricFamily("usop_services", "Services per status and region", labels=["status", "region"])
+        for row in Service.objects.values("status", "region__name").annotate(count=Count("pk")).order_by():
+            services.add_metric([row["status"], row["region__name"] or ""], row["count"])
+        yield services
+
+        operations = GaugeMetricFamily(
+            "usop_operations", "Queued and running service operations", labels=["operation", "status"])
+        rows = (
+            ServiceOperation.objects.filter(status__in=ACTIVE_OPERATION_STATUSES)
+            .values("operation", "status").annotate(count=Count("pk")).order_by()
+        )
+        for row in rows:
+            operations.add_metric([row["operation"], row["status"]], row["count"])
+        yield operations
+
+
+def process_registry() -> CollectorRegistry:
+    """ Metrics of every process of the pod in multiprocess mode, otherwise the ones of the current process """
+    if multiprocess_dir():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    from prometheus_client import REGISTRY
+    return REGISTRY
+
+
+def render_metrics(state: bool = True) -> bytes:
+    update_process_metrics()
+    output = generate_latest(process_registry())
+    if state:
+        registry = CollectorRegistry(auto_describe=False)
+        registry.register(StateCollector())
+        output += generate_latest(registry)
+    return output
+
+
+def start_worker_server(port: int):
+    """ Serve the metrics of a celery worker and its pool processes, the worker has no web server of its own """
+    from prometheus_client import start_http_server
+    start_http_server(port, registry=process_registry())
+
+
+@contextmanager
+def observe_queries(request):
+    """ Observe the number of queries of the block, and the time spent in them, labeled by the url route """
+    counter = {"queries": 0, "seconds": 0.0}
+
+    def observe(execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            counter["queries"] += 1
+            counter["seconds"] += time.perf_counter() - started
+
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(observe))
+        yield
+    match = getattr(request, "resolver_match", None)
+    view = match.route if match else "unmatched"
+    REQUEST_DB_QUERIES.labels(view).observe(counter["queries"])
+    REQUEST_DB_SECONDS.labels(view).observe(counter["seconds"])
+    update_process_metrics()
+
+
+class QueryMetricsMiddleware:
+    """ Observes the queries of every request, async capable so the streaming views stay on the event loop """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with observe_queries(request):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with observe_queries(request):
+            return await self.get_response(request)
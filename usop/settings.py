@@ -51,6 +51,8 @@ INSTALLED_APPS = [
     # Custom apps and services
 ]
 MIDDLEWARE = [
+    "usop.health.ProbeMiddleware",
+    "usop.metrics.QueryMetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -80,6 +82,7 @@ TEMPLATES = [
 ]
 SITE_ID = 1
 WSGI_APPLICATION = "usop.wsgi.application"
+ASGI_APPLICATION = "usop.asgi.application"
 
 
 # Database
@@ -87,6 +90,17 @@ WSGI_APPLICATION = "usop.wsgi.application"
 DATABASES = {"default": env.db_url("DATABASE_URL", default="sqlite:///db.sqlite3")}
 
 
+# Cache, use the Redis instance of the broker in production, ex: CACHE_URL=rediscache://redis:6379/1
+# The local memory default is not shared, the template catalog of a process never sees the writes of the others
+CACHES = {"default": env.cache_url("CACHE_URL", default="locmemcache://")}
+HEALTH_CHECKS = env.list("HEALTH_CHECKS", default=["database", "cache", "broker", "helm"])
+HEALTH_CHECK_TIMEOUT = env.float("HEALTH_CHECK_TIMEOUT", default=2)
+HEALTH_CHECK_CACHE_TTL = env.float("HEALTH_CHECK_CACHE_TTL", default=5)
+METRICS_TOKEN = env("METRICS_TOKEN", default="")
+METRICS_WORKER_PORT = env.int("METRICS_WORKER_PORT", default=0)
+PERMISSION_CACHE_TTL = env.int("PERMISSION_CACHE_TTL", default=60)
+
+
 # AUTH setup
 AUTH_USER_MODEL = "users.User"
 DJANGO_ADMIN_FORCE_ALLAUTH = True
@@ -167,12 +181,93 @@ CELERY_BROKER_URL = env("CELERY_BROKER_URL")
 CELERY_BROKER_TRANSPORT_OPTIONS = {
     "visibility_timeout": 3600,
 }
+CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
+CELERY_BEAT_SCHEDULE = {
+    "reconcile-service-statuses": {
+        "task": "usop.apps.services.tasks.reconcile_service_statuses",
+        "schedule": env.float("RECONCILE_INTERVAL", default=60),
+        "options": {"expires": env.float("RECONCILE_INTERVAL", default=60)},
+    },
+    "sweep-service-operations": {
+        "task": "usop.apps.services.tasks.sweep_service_operations",
+        "schedule": env.float("OPERATION_SWEEP_INTERVAL", default=60),
+        "options": {"expires": env.float("OPERATION_SWEEP_INTERVAL", default=60)},
+    },
+}
+# Backups of every running service, a crontab expression such as "0 2 * * *", disabled when empty
+BACKUP_CRONTAB = env("BACKUP_CRONTAB", default="")
+if BACKUP_CRONTAB:
+    from celery.schedules import crontab
+    minute, hour, day_of_month, month_of_year, day_of_week = BACKUP_CRONTAB.split()
+    CELERY_BEAT_SCHEDULE["backup-services"] = {
+        "task": "usop.apps.services.tasks.backup_services",
+        "schedule": crontab(minute, hour, day_of_week, day_of_month, month_of_year),
+    }
 
 
 # SERVICE DEPLOYMENT SETTINGS
 # TODO expmplain in docs this settings
 DRY_RUN = env("DRY_RUN", default=False)
 DEFAULT_CONTROLLER = env("DEFAULT_CONTROLLER", default="usop.apps.services.controller.ServiceController")
+SERVICE_CONTROLLER = env("SERVICE_CONTROLLER", default=DEFAULT_CONTROLLER)
+BILLING_CONTROLLER = env("BILLING_CONTROLLER", default="usop.apps.services.controller.DefaultBillingController")
+BILLING_CACHE_TTL = env.int("BILLING_CACHE_TTL", default=30)
 HELM_COMMAND = ["microk8s","helm"]
 KUBECTL_COMMAND = ["microk8s","kubectl"]
+KUBERNETES_API_URL = env("KUBERNETES_API_URL", default="")
+KUBERNETES_TOKEN = env("KUBERNETES_TOKEN", default="")
+KUBERNETES_CA_FILE = env("KUBERNETES_CA_FILE", default="")
+KUBERNETES_VERIFY_SSL = env.bool("KUBERNETES_VERIFY_SSL", default=True)
+KUBERNETES_POOL_SIZE = env.int("KUBERNETES_POOL_SIZE", default=10)
+KUBERNETES_TIMEOUT = env.float("KUBERNETES_TIMEOUT", default=30)
 DEFAULT_NAMESPACE = env("DEFAULT_NAMESPACE", default="usop_default")
+HELM_VALUES_DIR = env("HELM_VALUES_DIR", default="")
+HELM_VALUES_CACHE_SIZE = env.int("HELM_VALUES_CACHE_SIZE", default=1024)
+HELM_CHART_CACHE_DIR = env("HELM_CHART_CACHE_DIR", default="")
+HELM_CHART_PREPULL = env.bool("HELM_CHART_PREPULL", default=True)
+HELM_CHART_PULL_TIMEOUT = env.float("HELM_CHART_PULL_TIMEOUT", default=120)
+HELM_HOME_DIR = env("HELM_HOME_DIR", default="")
+BACKUP_STORE = env("BACKUP_STORE", default="usop.apps.services.backup.LocalObjectStore")
+BACKUP_STORE_ROOT = env("BACKUP_STORE_ROOT", default="")
+BACKUP_CHUNK_SIZE = env.int("BACKUP_CHUNK_SIZE", default=4 * 1024 * 1024)
+BACKUP_COMPRESSION_LEVEL = env.int("BACKUP_COMPRESSION_LEVEL", default=6)
+BACKUP_UPLOAD_CONCURRENCY = env.int("BACKUP_UPLOAD_CONCURRENCY", default=8)
+BACKUP_DOWNLOAD_CONCURRENCY = env.int("BACKUP_DOWNLOAD_CONCURRENCY", default=8)
+BACKUP_VOLUME_TIMEOUT = env.float("BACKUP_VOLUME_TIMEOUT", default=6 * 3600)
+NODE_DEFAULT_CPU_REQUEST = env("NODE_DEFAULT_CPU_REQUEST", default="100m")
+NODE_DEFAULT_MEMORY_REQUEST = env("NODE_DEFAULT_MEMORY_REQUEST", default="128Mi")
+NODE_INDEX_TTL = env.float("NODE_INDEX_TTL", default=60)
+CATALOG_CACHE_TIMEOUT = env.int("CATALOG_CACHE_TIMEOUT", default=3600)
+CATALOG_LOCAL_TTL = env.float("CATALOG_LOCAL_TTL", default=5)
+CATALOG_LOCAL_SIZE = env.int("CATALOG_LOCAL_SIZE", default=1024)
+LIFECYCLE_EVENT_SINKS = env.list("LIFECYCLE_EVENT_SINKS", default=[
+    "usop.apps.services.events.LoggingEventSink",
+    "usop.apps.services.events.PubSubEventSink",
+])
+LIFECYCLE_EVENT_BATCH_SIZE = env.int("LIFECYCLE_EVENT_BATCH_SIZE", default=200)
+LIFECYCLE_EVENT_FLUSH_INTERVAL = env.float("LIFECYCLE_EVENT_FLUSH_INTERVAL", default=2.0)
+LIFECYCLE_EVENT_QUEUE_SIZE = env.int("LIFECYCLE_EVENT_QUEUE_SIZE", default=10000)
+BULK_CONCURRENCY = env.int("BULK_CONCURRENCY", default=16)
+BULK_REGION_CONCURRENCY = env.int("BULK_REGION_CONCURRENCY", default=8)
+BULK_NAMESPACE_CONCURRENCY = env.int("BULK_NAMESPACE_CONCURRENCY", default=4)
+BULK_RESTART_BATCH_SIZE = env.int("BULK_RESTART_BATCH_SIZE", default=50)
+SERVICE_LOG_MAX_STREAMS = env.int("SERVICE_LOG_MAX_STREAMS", default=20)
+SERVICE_STREAM_PAGE_SIZE = env.int("SERVICE_STREAM_PAGE_SIZE", default=500)
+OPERATION_TIMEOUT = env.float("OPERATION_TIMEOUT", default=900)
+OPERATION_HEARTBEAT_INTERVAL = env.float("OPERATION_HEARTBEAT_INTERVAL", default=30)
+OPERATION_DISPATCH_TIMEOUT = env.float("OPERATION_DISPATCH_TIMEOUT", default=300)
+OPERATION_OUTPUT_LINES = env.int("OPERATION_OUTPUT_LINES", default=200)
+OPERATION_OUTPUT_FLUSH_INTERVAL = env.float("OPERATION_OUTPUT_FLUSH_INTERVAL", default=5)
+OPERATION_OUTPUT_DIR = env("OPERATION_OUTPUT_DIR", default="")
+PUBSUB_REDIS_URL = env("PUBSUB_REDIS_URL", default="")
+STATUS_STREAM_HEARTBEAT = env.float("STATUS_STREAM_HEARTBEAT", default=15)
+STATUS_LONG_POLL_TIMEOUT = env.float("STATUS_LONG_POLL_TIMEOUT", default=55)
+LIMITER_REDIS_URL = env("LIMITER_REDIS_URL", default="")
+LIMITER_REGION_CONCURRENCY = env.int("LIMITER_REGION_CONCURRENCY", default=20)
+LIMITER_NAMESPACE_CONCURRENCY = env.int("LIMITER_NAMESPACE_CONCURRENCY", default=5)
+LIMITER_ORG_CONCURRENCY = env.int("LIMITER_ORG_CONCURRENCY", default=3)
+LIMITER_REGION_OPERATIONS_PER_MINUTE = env.int("LIMITER_REGION_OPERATIONS_PER_MINUTE", default=0)
+LIMITER_LEASE_SECONDS = env.int("LIMITER_LEASE_SECONDS", default=120)
+LIMITER_POLL_INTERVAL = env.float("LIMITER_POLL_INTERVAL", default=0.5)
+LIMITER_WAIT_TIMEOUT = env.float("LIMITER_WAIT_TIMEOUT", default=30)
+LIMITER_RETRY_DELAY = env.int("LIMITER_RETRY_DELAY", default=15)
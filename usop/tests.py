@@ -0,0 +1,118 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from prometheus_client import REGISTRY
+
+from .apps.services.models import ServiceOperation
+from .apps.services.status import OperationStatus, ServiceStatus
+from .apps.services.tests import create_services
+from .health import CHECKS, HealthChecker
+from .metrics import render_metrics, reset_multiprocess_dir, time_transition
+
+
+class HealthCheckerTests(TestCase):
+
+    def test_slow_checks_fail_after_the_timeout_and_are_not_started_again(self):
+        release = threading.Event()
+        slow = mock.Mock(side_effect=lambda: release.wait(5))
+        self.addCleanup(release.set)
+        checker = HealthChecker(["slow", "fast"], ttl=0, timeout=0.2)
+        with mock.patch.dict(CHECKS, {"slow": slow, "fast": lambda: "fine"}):
+            started = time.monotonic()
+            ok, report = checker.report()
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertFalse(ok)
+            self.assertEqual(report["status"], "unavailable")
+            self.assertEqual(report["checks"]["slow"]["error"], "Timed out after 0.2s")
+            self.assertEqual((report["checks"]["fast"]["ok"], report["checks"]["fast"]["detail"]), (True, "fine"))
+            checker.report()
+            slow.assert_called_once()
+
+    def test_reports_are_cached_for_the_ttl(self):
+        check = mock.Mock(return_value=None)
+        checker = HealthChecker(["check"], ttl=60, timeout=1)
+        with mock.patch.dict(CHECKS, {"check": check}):
+            self.assertEqual(checker.report(), checker.report())
+            check.assert_called_once()
+            checker._expires = 0
+            checker.report()
+        self.assertEqual(check.call_count, 2)
+
+    def test_errors_are_reported(self):
+        checker = HealthChecker(["broken"], ttl=0, timeout=1)
+        with mock.patch.dict(CHECKS, {"broken": mock.Mock(side_effect=Exception("connection refused"))}):
+            ok, report = checker.report()
+        self.assertFalse(ok)
+        self.assertEqual(report["checks"]["broken"]["error"], "connection refused")
+
+
+@override_settings(ALLOWED_HOSTS=["example.com"])
+class ProbeMiddlewareTests(TestCase):
+
+    def test_ready_fails_when_a_check_fails_and_health_does_not(self):
+        report = {"status": "unavailable", "checks": {"database": {"ok": False, "error": "down", "latency_ms": 1}}}
+        with mock.patch("usop.views.health_checker.report", return_value=(False, report)):
+            # Kubelets call the pod IP, which is not an allowed host
+            response = self.client.get("/ready/", HTTP_HOST="10.0.0.1")
+            self.assertEqual((response.status_code, response.json()), (503, report))
+            self.assertEqual(self.client.get("/health/", HTTP_HOST="10.0.0.1").status_code, 200)
+
+    def test_ready_passes_when_every_check_passes(self):
+        report = {"status": "ok", "checks": {}}
+        with mock.patch("usop.views.health_checker.report", return_value=(True, report)):
+            self.assertEqual(self.client.get("/ready/", HTTP_HOST="10.0.0.1").status_code, 200)
+
+
+class MetricsTests(TestCase):
+
+    def transitions(self, outcome):
+        labels = {"operation": "deploy", "region": "region", "outcome": outcome}
+        return REGISTRY.get_sample_value("usop_service_transition_seconds_count", labels) or 0
+
+    def test_transitions_are_timed_by_outcome(self):
+        service, = create_services()
+        succeeded, failed = self.transitions("success"), self.transitions("failure")
+        with time_transition(service, "deploy"):
+            pass
+        with self.assertRaises(ValueError), time_transition(service, "deploy"):
+            raise ValueError("helm failed")
+        self.assertEqual((self.transitions("success"), self.transitions("failure")), (succeeded + 1, failed + 1))
+
+    def test_services_and_operations_are_counted_on_scrape(self):
+        first, second = create_services(2)
+        ServiceOperation.objects.create(service=first, operation="deploy")
+        ServiceOperation.objects.create(service=second, operation="deploy")
+        ServiceOperation.objects.create(service=second, operation="stop", status=OperationStatus.SUCCEEDED)
+        output = render_metrics().decode()
+        self.assertIn(f'usop_services{{region="region",status="{ServiceStatus.NEW}"}} 2.0', output)
+        self.assertIn('usop_operations{operation="deploy",status="QUEUED"} 2.0', output)
+        self.assertNotIn('operation="stop"', output)
+        self.assertIn("usop_class_cache_size", output)
+
+    def test_metrics_of_every_process_are_exported(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": directory.name}
+        for _ in range(2):
+            subprocess.run([
+                sys.executable, "-c",
+                "from prometheus_client import Counter; Counter('usop_child', 'Child process counter').inc(3)",
+            ], env=env, check=True)
+        with mock.patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": directory.name}):
+            self.assertIn("usop_child_total 6.0", render_metrics(state=False).decode())
+            reset_multiprocess_dir()
+            self.assertEqual(os.listdir(directory.name), [])
+            self.assertNotIn("usop_child_total", render_metrics(state=False).decode())
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_scrapes_need_the_token(self):
+        self.assertEqual(self.client.get("/metrics/", HTTP_HOST="10.0.0.1").status_code, 401)
+        response = self.client.get("/metrics/", HTTP_HOST="10.0.0.1", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"usop_services", response.content)
@@ -8,7 +8,7 @@ from viewflow.urls import Application, Site, ModelViewset
 from django.views.generic.base import TemplateView
 
 from .apps.services import views as ServiceViews
-from .views import health, ready
+from .views import health, metrics, ready
 
 site = Site(
     title="USOP", 
@@ -22,6 +22,13 @@ urlpatterns = [
     path('accounts/', include('allauth.urls')),
     path('health/', health),
     path('ready/', ready),
+    path('metrics/', metrics),
+    path('services/<uuid:pid>/logs/', ServiceViews.service_logs, name="service_logs"),
+    path('services/<uuid:pid>/events/', ServiceViews.service_events, name="service_events"),
+    path('services/<uuid:pid>/metrics/', ServiceViews.service_metrics, name="service_metrics"),
+    path('services/<uuid:pid>/status/', ServiceViews.service_status, name="service_status"),
+    path('orgs/<uuid:extid>/status/', ServiceViews.org_status, name="org_status"),
+    path('orgs/<uuid:extid>/catalog/', ServiceViews.org_catalog, name="org_catalog"),
     path("i18n/", include("django.conf.urls.i18n")),
     path("", TemplateView.as_view(template_name="index.html")),
     # path('', site.urls),
@@ -1,9 +1,24 @@
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from .health import health_checker
+from .metrics import render_metrics
 
 
 def health(request):
-    return HttpResponse("ok", content_type="text/plain")
+    """ Liveness, the process answers requests. Dependencies are left to ready so an outage doesn't restart pods """
+    return JsonResponse({"status": "ok"})
 
 
 def ready(request):
-    return HttpResponse("ok", content_type="text/plain")
\ No newline at end of file
+    """ Readiness, every dependency answered within HEALTH_CHECK_TIMEOUT, with the latency of each check """
+    ok, report = health_checker.report()
+    return JsonResponse(report, status=200 if ok else 503)
+
+
+def metrics(request):
+    """ Prometheus metrics of every process of the pod, with a bearer token when METRICS_TOKEN is set """
+    if settings.METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {settings.METRICS_TOKEN}":
+        return HttpResponse(status=401)
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)